@@ -1,24 +1,129 @@
 import os
 import sys
-from datetime import datetime
+import hashlib
+import json
+import shutil
 
-import arrow
 import numpy as np
-import metpy.calc as mpcalc
-from metpy.units import units
+import torch
 from torch.utils import data
 
 proj_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(proj_dir)
 
 from util import config, file_dir
+from metcalc import wind_direction, wind_speed
+from overlay import HourIndexed, OverlayDataset, overlay_fp
+from stats import NormStats, norm_stats_fp
+from timeaxis import HourAxis, config_hour
+
+# bump when _feature_rows changes, so stale feature stores are rebuilt
+FEATURE_STORE_VERSION = 1
+STORAGE_DTYPES = ('float32', 'float16')
+# knowair channel kept as frp500 (index 11 of the default metero_var)
+FRP_COL = config['data'].get('frp_col', 'frp_100km_idw')
+
+
+def open_knowair():
+    """ The knowair cube of the config, memory-mapped or, with knowair_overlay, composed lazily. """
+    overlay = file_dir.get('knowair_overlay') # named OverlayDataset of overlays.yaml, read lazily
+    return OverlayDataset.from_yaml(overlay) if overlay else np.load(file_dir['knowair_fp'], mmap_mode='r')
+
+
+def data_key(knowair, node_num, storage_dtype='float32'):
+    """ Hash of everything the processed features of knowair depend on. """
+    arrays = [knowair.base] + [o.source for o in knowair.overlays] if isinstance(knowair, OverlayDataset) else [knowair]
+    files = sorted({os.path.abspath(a.filename) for a in arrays if getattr(a, 'filename', None)})
+    key = {'version': FEATURE_STORE_VERSION,
+           'metero_use': config['experiments']['metero_use'],
+           'metero_var': config['data']['metero_var'],
+           'frp_col': FRP_COL,
+           'data_start': config['dataset']['data_start'],
+           'data_end': config['dataset']['data_end'],
+           'node_num': node_num,
+           'files': [(fp, os.path.getsize(fp), os.stat(fp).st_mtime_ns) for fp in files]}
+    if storage_dtype != 'float32':
+        key['storage_dtype'] = storage_dtype
+    h = hashlib.sha1(json.dumps(key, sort_keys=True).encode())
+    overlay = file_dir.get('knowair_overlay')
+    if overlay:
+        with open(overlay_fp, 'rb') as f:
+            h.update(overlay.encode() + f.read())
+    return h.hexdigest()[:16]
+
+
+def stats_key(data_key, split_start, split_len):
+    """ Key of the normalization statistics of hours [split_start, split_start + split_len) of the data with data_key. """
+    return hashlib.sha1(json.dumps([data_key, split_start, split_len]).encode()).hexdigest()
+
+
+def norm_stats_key(graph, flag, dataset_num=1, storage_dtype=None):
+    """
+    Key of the statistics a HazeData(graph, dataset_num=dataset_num, flag=flag)
+    saves with the config in use, for loading them elsewhere (simulate.py,
+    dataset_exp1.py). storage_dtype is that of the feature store they are
+    computed from, by default the config's if train.feature_store is set.
+    """
+    if storage_dtype is None:
+        storage_dtype = config['train'].get('storage_dtype', 'float32') if config['train'].get('feature_store') else 'float32'
+    axis = HourAxis.from_config()
+    split = config['dataset'][dataset_num]
+    start = int(axis.index(config_hour(split[flag.lower() + '_start'])))
+    end = int(axis.index(config_hour(split[flag.lower() + '_end'])))
+    return stats_key(data_key(open_knowair(), graph.node_num, storage_dtype), start, end + 1 - start)
+
+
+def find_norm_stats(graph, flag, dataset_num=1, model_fp=None, fp=norm_stats_fp):
+    """
+    Statistics of the flag split a model was trained and tested with, for
+    running it on data knowair_fp may no longer point at (a simulated cube, an
+    overlay): those saved next to model_fp, else those of this config's data
+    in fp; None if there are neither, as for runs from before norm_stats.npz.
+    """
+    return NormStats.find(flag, norm_stats_key(graph, flag, dataset_num), model_fp, fp)
+
+
+class LazyRows(HourIndexed):
+    """ Rows [offset, offset + shape[0]) of read(start, end), read only when indexed. """
+    def __init__(self, read, shape, offset=0, dtype=np.float32):
+        self._read = read
+        self.shape = tuple(shape)
+        self.offset = offset
+        self.dtype = np.dtype(dtype)
+        self.ndim = len(self.shape)
+
+    def read(self, start, end):
+        return self._read(start + self.offset, end + self.offset)
+
 
 class HazeData(data.Dataset):
+    """
+    :Parameters:
+        mmap: open the knowair cube memory-mapped and keep only the split's
+            time arrays in memory; feature, pm25 and their _full arrays are then
+            LazyRows that process and normalize the hours they are indexed with.
+        feature_store: read the processed float32 features of every hour from
+            feature_store/<key>/ next to knowair_fp, built on first use; <key>
+            hashes metero_use, metero_var, the data range and the knowair files.
+            Every split is then a time-range view of the same memory-mapped arrays.
+        storage_dtype: dtype the feature store keeps the features in. float16
+            halves its size and disk reads; every channel is stored rescaled to
+            [-1, 1] over its range, which keeps about 3 significant digits of
+            the range, and is decoded to float32 on read.
+
+    The normalization statistics are streamed over the split once (see
+    stats.NormStats) and saved in data/norm_stats.npz under the flag and a
+    key of the split's hours and the data (norm_stats_key); later datasets of
+    the same split of the same data load them from there.
+    """
     def __init__(self, graph,
                        hist_len=1,
                        pred_len=24,
                        dataset_num=1,
                        flag='Train',
+                       mmap=False,
+                       feature_store=False,
+                       storage_dtype='float32',
                        ):
         if flag == 'Train':
             start_time_str = 'train_start'
@@ -31,36 +136,101 @@ class HazeData(data.Dataset):
             end_time_str = 'test_end'
         else:
             raise Exception('Wrong Flag!')
+        if storage_dtype not in STORAGE_DTYPES:
+            raise Exception('Wrong storage_dtype: %s' % storage_dtype)
 
         self.start_time = self._get_time(config['dataset'][dataset_num][start_time_str])
         self.end_time = self._get_time(config['dataset'][dataset_num][end_time_str])
-        self.data_start = self._get_time(config['dataset']['data_start'])
-        self.data_end = self._get_time(config['dataset']['data_end'])
+        self.axis = HourAxis.from_config()
         self.knowair_fp = file_dir['knowair_fp']
         self.graph = graph
-        self._load_npy()
-        self._gen_time_arr()
-        self._process_time()
-        self._process_feature()
-        # Use .astype() for clarity, although np.float32() also works
-        self.feature = self.feature.astype(np.float32)
-        self.pm25 = self.pm25.astype(np.float32)
-        self.frp500 = self.frp500.astype(np.float32) # uncomment for 'train_ambient.py'
-        self._calc_mean_std()
+        self.hist_len = hist_len
+        self.pred_len = pred_len
+        self.edge_weight_full = None
+        self.mmap = mmap
+        self.store = None
+        self.flag = flag
+        self.storage_dtype = storage_dtype
         seq_len = hist_len + pred_len
-        self._add_time_dim(seq_len)
-        self._norm()
-        self._dictionary()
+        if feature_store:
+            self._open_store()
+            self._open_split()
+            if self.mmap:
+                self._calc_mean_std(self._raw_rows, self.split_len)
+                self._add_lazy_time_dim(seq_len)
+            else:
+                split = slice(self.split_start, self.split_start + self.split_len)
+                self.feature = self._store_feature(split.start, split.stop)
+                self.pm25 = np.array(self.store['pm25'][split])
+                self._calc_mean_std()
+                self._add_time_dim(seq_len)
+                self._norm()
+        elif self.mmap:
+            self._gen_time_arr()
+            self._open_split()
+            self._calc_mean_std(self._raw_rows, self.split_len)
+            self._add_lazy_time_dim(seq_len)
+        else:
+            self._load_npy()
+            self._gen_time_arr()
+            self._process_time()
+            self._process_feature()
+            # float32 copies of the split's hours, the float64 cube itself stays memory-mapped
+            self.pm25 = self.pm25.astype(np.float32)
+            self.frp500 = self.frp500.astype(np.float32) # uncomment for 'train_ambient.py'
+            self._calc_mean_std()
+            self._add_time_dim(seq_len)
+            self._norm()
+        self.full_axis = HourAxis.from_timestamps(self.time_arr_full)
         print(f"[{flag} Dataset] Initialized. Shapes - PM2.5: {self.pm25.shape}, Feature: {self.feature.shape}, Time: {self.time_arr.shape}")
 
 
-    def _dictionary(self):
-        self.time_index = {}
-        for i in range(self.time_arr_full.shape[0]):
-            # Ensure the key is a basic number type (it should be from timestamp)
-            key = self.time_arr_full[i].item() if isinstance(self.time_arr_full[i], np.generic) else self.time_arr_full[i]
-            self.time_index[key] = i
+    def time_index(self, time_arr):
+        """ Indices in the _full arrays of the hours with unix timestamps time_arr, -1 for hours outside them. """
+        return self.full_axis.timestamp_index(time_arr)
+
 
+    def edge_weights(self, wind_mean, wind_std):
+        """
+        Precomputes the (hours, edges) PM25_GNN advection weights of every hour of
+        feature_full, de-normalized with the wind statistics the model is given.
+        """
+        if self.mmap:
+            # computed from the features of the hours gathered, like the features themselves
+            self.edge_weight_full = LazyRows(lambda a, b: self.graph.advection_weights(self.feature_full.read(a, b), wind_mean, wind_std),
+                                             (len(self.feature_full), self.graph.edge_num))
+        else:
+            self.edge_weight_full = self.graph.advection_weights(self.feature_full, wind_mean, wind_std)
+        return self.edge_weight_full
+
+    def gather(self, end):
+        """
+        Batch of the windows ending at hours `end` of the _full arrays (dataset index + hist_len
+        + pred_len, see sampler.EndIndexBatchSampler), each array gathered with one index over
+        the hours of all the windows, as tensors:
+            pm25_hist (B, hist_len, N, 1), pm25_label (B, pred_len, N, 1), feature (B, seq_len, N, C),
+            pm25 (B, seq_len, N, 1), edge_weight (B, seq_len, edges) or None before edge_weights(),
+            frp500 (B, seq_len, N) and the timestamps of the window ends (B,)
+        """
+        end = np.asarray(end)
+        hours = end[:, None] + np.arange(1 - self.hist_len - self.pred_len, 1)
+        pm25 = torch.from_numpy(np.asarray(self.pm25_full[hours], dtype=np.float32))
+        feature = torch.from_numpy(np.asarray(self.feature_full[hours], dtype=np.float32))
+        edge_weight = None
+        if self.edge_weight_full is not None:
+            edge_weight = torch.from_numpy(np.asarray(self.edge_weight_full[hours], dtype=np.float32))
+        frp500 = torch.from_numpy(np.asarray(self.frp500[hours], dtype=np.float32))
+        time = torch.from_numpy(np.asarray(self.time_arr_full[end]))
+        return pm25[:, :self.hist_len], pm25[:, self.hist_len:], feature, pm25, edge_weight, frp500, time
+
+    def window_any(self, hour_flags):
+        """
+        For every window, whether any of its hours is flagged. hour_flags has one
+        entry per hour of the full arrays; window i covers hours i+1 .. i+seq_len.
+        """
+        count = np.concatenate([[0], np.cumsum(np.asarray(hour_flags, dtype=np.int64))])
+        start = np.arange(len(self)) + 1
+        return count[start + self.hist_len + self.pred_len] > count[start]
 
     def _norm(self):
         self.feature = (self.feature - self.feature_mean) / self.feature_std
@@ -80,25 +250,37 @@ class HazeData(data.Dataset):
         self.time_arr = self.time_arr[seq_len:]
 
 
-    def _calc_mean_std(self):
-        self.feature_mean = self.feature.mean(axis=(0,1))
-        self.feature_std = self.feature.std(axis=(0,1))
-        # Ensure indices 7, 8 are correct for wind components after _process_feature
-        # Check self.feature.shape[-1] after _process_feature if unsure
-        wind_u_idx = config['experiments']['metero_use'].index('u_component_of_wind+950')
-        wind_v_idx = config['experiments']['metero_use'].index('v_component_of_wind+950')
-        self.wind_mean = self.feature_mean[[wind_u_idx, wind_v_idx]]
-        self.wind_std = self.feature_std[[wind_u_idx, wind_v_idx]]
-        self.pm25_mean = self.pm25.mean()
-        self.pm25_std = self.pm25.std()
+    def _calc_mean_std(self, read=None, hours=None, chunk_hours=24*30):
+        """
+        Statistics of the split streamed over chunks of hours of read(start, end) -> (feature, pm25),
+        the split's arrays by default, or those saved for the same split of the same data.
+        """
+        key = stats_key(self.data_key, self.split_start, self.split_len)
+        self.stats = NormStats.load(self.flag, key)
+        if self.stats is None:
+            if read is None:
+                read, hours = lambda a, b: (self.feature[a:b], self.pm25[a:b]), len(self.feature)
+            self.stats = NormStats.compute(read, hours, chunk_hours, key=key)
+            self.stats.save(self.flag)
+        self.feature_mean, self.feature_std = self.stats.feature_mean, self.stats.feature_std
+        self.wind_mean, self.wind_std = self.stats.wind_mean, self.stats.wind_std
+        self.pm25_mean, self.pm25_std = self.stats.pm25_mean, self.stats.pm25_std
         print(f"Calculated Mean/Std - PM2.5 Mean: {self.pm25_mean}, PM2.5 Std: {self.pm25_std}")
 
 
     def _process_feature(self):
+        h_arr = self.axis.hour(self.time_idx)
+        w_arr = self.axis.isoweekday(self.time_idx) # Monday=1 to Sunday=7
+        self.feature = self._feature_rows(self.feature, h_arr, w_arr)
+
+    def _feature_rows(self, feature, h_arr, w_arr):
+        """
+        float32 metero_use channels of raw feature rows (hours, nodes, metero_var) with hour,
+        weekday, wind speed and direction appended; the wind is derived from the raw values.
+        """
         metero_var = config['data']['metero_var']
         metero_use = config['experiments']['metero_use']
         metero_idx = [metero_var.index(var) for var in metero_use]
-        self.feature = self.feature[:,:,metero_idx]
 
         # Find indices dynamically based on metero_use config
         try:
@@ -107,73 +289,165 @@ class HazeData(data.Dataset):
         except ValueError:
             raise ValueError("u_component_of_wind+950 or v_component_of_wind+950 not found in metero_use config")
 
-        u = self.feature[:, :, u_idx] * units.meter / units.second
-        v = self.feature[:, :, v_idx] * units.meter / units.second
-        speed = 3.6 * mpcalc.wind_speed(u, v)._magnitude
-        direc = mpcalc.wind_direction(u, v)._magnitude
-        h_arr = []
-        w_arr = []
-        for i in self.time_arrow:
-            h_arr.append(i.hour)
-            w_arr.append(i.isoweekday()) # Monday=1 to Sunday=7
-        h_arr = np.array(h_arr) # Use np.array instead of np.stack for 1D
-        w_arr = np.array(w_arr)
-        h_arr = np.repeat(h_arr[:, None], self.graph.node_num, axis=1)
-        w_arr = np.repeat(w_arr[:, None], self.graph.node_num, axis=1)
+        u = feature[:, :, metero_idx[u_idx]] # m/s
+        v = feature[:, :, metero_idx[v_idx]] # m/s
         # Add julian_date and time_of_day if they are in metero_use, otherwise add calculated ones
         # Assuming julian_date and time_of_day might already be handled if present in metero_use
         # If they are NOT in metero_use, we add hour and weekday here.
         # Consider adding them as sin/cos transforms for cyclical nature.
-        self.feature = np.concatenate([self.feature, h_arr[:, :, None], w_arr[:, :, None],
-                                       speed[:, :, None], direc[:, :, None]
-                                       ], axis=-1)
-
+        m = len(metero_idx)
+        out = np.empty(feature.shape[:2] + (m + 4,), dtype=np.float32)
+        out[:, :, :m] = feature[:, :, metero_idx]
+        out[:, :, m] = np.asarray(h_arr)[:, None]
+        out[:, :, m + 1] = np.asarray(w_arr)[:, None]
+        out[:, :, m + 2] = 3.6 * wind_speed(u, v)
+        out[:, :, m + 3] = wind_direction(u, v)
+        return out
 
     def _process_time(self):
         start_idx = self._get_idx(self.start_time)
         end_idx = self._get_idx(self.end_time)
+        self.split_start, self.split_len = start_idx, end_idx + 1 - start_idx
         self.pm25 = self.pm25[start_idx: end_idx+1, :]
         self.feature = self.feature[start_idx: end_idx+1, :]
         self.frp500 = self.frp500[start_idx: end_idx+1, :] # uncomment for 'train_ambient.py'
         self.time_arr = self.time_arr[start_idx: end_idx+1]
-        self.time_arrow = self.time_arrow[start_idx: end_idx + 1]
+        self.time_idx = self.time_idx[start_idx: end_idx + 1]
 
     def _gen_time_arr(self):
-        self.time_arrow = []
-        time_stamps = []
         # determines time granularity (in this case, 1 hour)
-        # Correct interval generation: end date is exclusive, shift by +1 interval unit
-        for time_arrow_tuple in arrow.Arrow.interval('hour', self.data_start, self.data_end.shift(hours=+1), 1):
-             # interval returns a tuple (start_time, end_time) for each interval
-             current_time = time_arrow_tuple[0]
-             self.time_arrow.append(current_time)
-             time_stamps.append(current_time.timestamp()) # Use .timestamp() directly
-        self.time_arr = np.array(time_stamps) # Use np.array for 1D
+        self.time_idx = np.arange(len(self.axis))
+        self.time_arr = self.axis.timestamps(self.time_idx)
+
+
+    def _open_store(self):
+        """
+        Memory-maps the feature store (feature, pm25, frp500 and time of every hour, and the
+        per-channel offset and scale of float16 features), building it first if needed.
+        """
+        knowair = open_knowair()
+        self.data_key = data_key(knowair, self.graph.node_num, self.storage_dtype)
+        # feature_store/<key> next to knowair_fp
+        store_dir = os.path.join(os.path.dirname(os.path.abspath(self.knowair_fp)), 'feature_store', self.data_key)
+        if not os.path.isdir(store_dir):
+            self._build_store(knowair, store_dir)
+        names = ('feature', 'pm25', 'frp500', 'time') + (('feature_scale',) if self.storage_dtype != 'float32' else ())
+        self.store = {name: np.load(os.path.join(store_dir, name + '.npy'), mmap_mode='r') for name in names}
+        self.time_arr = np.array(self.store['time'])
+
+    def _store_feature(self, start, end):
+        """ float32 features of store hours [start, end). """
+        feature = np.asarray(self.store['feature'][start:end])
+        if 'feature_scale' not in self.store:
+            return feature
+        offset, scale = self.store['feature_scale']
+        return feature.astype(np.float32) * scale + offset
+
+    def _build_store(self, knowair, store_dir, chunk_hours=24*30):
+        print(f"Building feature store {store_dir}")
+        self._gen_time_arr()
+        hours = min(len(self.time_arr), len(knowair))
+        h_arr = self.axis.hour(self.time_idx)
+        w_arr = self.axis.isoweekday(self.time_idx)
+        feature_dim = len(config['experiments']['metero_use']) + 4
+        tmp_dir = store_dir + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        offset, scale = np.float32(0), np.float32(1)
+        if self.storage_dtype != 'float32':
+            # rescale every channel to [-1, 1] over its range, float16 could not hold e.g. the surface pressure in Pa
+            lo, hi = np.full(feature_dim, np.inf, dtype=np.float32), np.full(feature_dim, -np.inf, dtype=np.float32)
+            for a in range(0, hours, chunk_hours):
+                b = min(a + chunk_hours, hours)
+                rows = self._feature_rows(np.asarray(knowair[a:b])[:, :, :-1], h_arr[a:b], w_arr[a:b])
+                lo, hi = np.fmin(lo, np.fmin.reduce(rows, axis=(0, 1))), np.fmax(hi, np.fmax.reduce(rows, axis=(0, 1)))
+            offset, scale = (hi + lo) / 2, (hi - lo) / 2
+            scale[~(scale > 0)] = 1
+            np.save(os.path.join(tmp_dir, 'feature_scale.npy'), np.stack([offset, scale]))
+        feature = np.lib.format.open_memmap(os.path.join(tmp_dir, 'feature.npy'), mode='w+', dtype=self.storage_dtype, shape=(hours, self.graph.node_num, feature_dim))
+        pm25 = np.lib.format.open_memmap(os.path.join(tmp_dir, 'pm25.npy'), mode='w+', dtype=np.float32, shape=(hours, self.graph.node_num, 1))
+        frp500 = np.lib.format.open_memmap(os.path.join(tmp_dir, 'frp500.npy'), mode='w+', dtype=np.float32, shape=(hours, self.graph.node_num))
+        frp_col_index = config['data']['metero_var'].index(FRP_COL)
+        for a in range(0, hours, chunk_hours):
+            b = min(a + chunk_hours, hours)
+            rows = np.asarray(knowair[a:b])
+            feature[a:b] = (self._feature_rows(rows[:, :, :-1], h_arr[a:b], w_arr[a:b]) - offset) / scale
+            pm25[a:b] = rows[:, :, -1:]
+            frp500[a:b] = rows[:, :, frp_col_index]
+        for arr in (feature, pm25, frp500):
+            arr.flush()
+        np.save(os.path.join(tmp_dir, 'time.npy'), self.time_arr[:hours])
+        os.replace(tmp_dir, store_dir)
 
+    def _open_split(self, chunk_hours=24*30):
+        """
+        The split's hours of the memory-mapped cube or feature store; only frp500
+        and the time arrays are loaded.
+        """
+        start_idx = self._get_idx(self.start_time)
+        end_idx = self._get_idx(self.end_time)
+        self.split_start, self.split_len = start_idx, end_idx + 1 - start_idx
+        self.time_arr = self.time_arr[start_idx: end_idx+1]
+        if self.store is not None:
+            self.frp500 = np.array(self.store['frp500'][start_idx: end_idx+1])
+            return
+        self.knowair = open_knowair()
+        self.data_key = data_key(self.knowair, self.graph.node_num)
+        self.time_idx = self.time_idx[start_idx: end_idx + 1]
+        self.h_arr = self.axis.hour(self.time_idx)
+        self.w_arr = self.axis.isoweekday(self.time_idx)
+        frp_col_index = config['data']['metero_var'].index(FRP_COL)
+        self.frp500 = np.concatenate([np.asarray(self.knowair[start_idx + a:start_idx + min(a + chunk_hours, self.split_len), :, frp_col_index], dtype=np.float32)
+                                      for a in range(0, self.split_len, chunk_hours)])
+
+    def _raw_rows(self, start, end):
+        """ mmap mode: un-normalized float32 (feature, pm25) of split hours [start, end). """
+        if self.store is not None:
+            rows = slice(self.split_start + start, self.split_start + end)
+            return self._store_feature(rows.start, rows.stop), np.asarray(self.store['pm25'][rows])
+        rows = np.asarray(self.knowair[self.split_start + start:self.split_start + end])
+        feature = self._feature_rows(rows[:, :, :-1], self.h_arr[start:end], self.w_arr[start:end])
+        return feature, rows[:, :, -1:].astype(np.float32)
+
+    def _norm_feature(self, start, end):
+        return (self._raw_rows(start, end)[0] - self.feature_mean) / self.feature_std
+
+    def _norm_pm25(self, start, end):
+        source = self.store['pm25'] if self.store is not None else self.knowair
+        rows = np.asarray(source[self.split_start + start:self.split_start + end, :, -1:], dtype=np.float32)
+        return (rows - self.pm25_mean) / self.pm25_std
+
+    def _add_lazy_time_dim(self, seq_len):
+        """ _add_time_dim and _norm of mmap mode: views that read and normalize the hours they are indexed with. """
+        feature_dim = len(config['experiments']['metero_use']) + 4
+        feature_shape = (self.split_len, self.graph.node_num, feature_dim)
+        pm25_shape = (self.split_len, self.graph.node_num, 1)
+        self.feature_full = LazyRows(self._norm_feature, feature_shape)
+        self.pm25_full = LazyRows(self._norm_pm25, pm25_shape)
+        self.time_arr_full = np.copy(self.time_arr)
+        self.feature = LazyRows(self._norm_feature, (self.split_len - seq_len,) + feature_shape[1:], offset=seq_len)
+        self.pm25 = LazyRows(self._norm_pm25, (self.split_len - seq_len,) + pm25_shape[1:], offset=seq_len)
+        self.time_arr = self.time_arr[seq_len:]
 
     def _load_npy(self):
-        self.knowair = np.load(self.knowair_fp)
+        self.knowair = open_knowair()
+        self.data_key = data_key(self.knowair, self.graph.node_num)
         # Assuming last column is PM2.5, 12th (index 11 or 12?) is FRP
         # Verify indices based on actual data structure
         self.feature = self.knowair[:,:,:-1]
         self.pm25 = self.knowair[:,:,-1:]
-        # Ensure correct index for FRP - Python uses 0-based indexing
-        # If it's the 12th column, the index is 11. If it's column *named* 12, check data.
-        frp_col_index = 11 # Assuming 12th column means index 11
+        frp_col_index = config['data']['metero_var'].index(FRP_COL)
         self.frp500 = self.knowair[:,:,frp_col_index] # Slicing with integer keeps dims, need [:, :, frp_col_index]
 
     def _get_idx(self, t):
-        t0 = self.data_start
-        # determines time granularity (1 hour = 3600 seconds)
-        return int((t.timestamp() - t0.timestamp()) / 3600)
+        # determines time granularity (1 hour)
+        return int(self.axis.index(t))
 
 
     def _get_time(self, time_yaml):
         # time_yaml format: [[YYYY, M, D], 'Timezone']
         # Example: [[2017, 1, 2], 'UTC']
-        dt = datetime(time_yaml[0][0], time_yaml[0][1], time_yaml[0][2])
-        arrow_time = arrow.get(dt, time_yaml[1])
-        return arrow_time
+        return config_hour(time_yaml)
 
     def __len__(self):
         # Length should be the number of possible start times for sequences
@@ -6,17 +6,20 @@ sys.path.append(proj_dir)
 from util import config, file_dir
 import numpy as np
 import pandas as pd
-import math
-import metpy.calc as mpcalc
-from metpy.units import units
-from datetime import datetime, timedelta
-import geopy.distance
-import metpy.calc as mpcalc
-from metpy.units import units
 from torch.utils import data
-import arrow
 import pdb
 import pickle
+import tempfile
+import warnings
+from tqdm import tqdm
+
+from metcalc import wind_direction, wind_speed
+from overlay import OverlayDataset
+from fire_catalog import FireCatalog
+from frp import FRP_CHANNELS, GeometryCache, WindGrid, frp_influence_pairs, map_shards
+from stats import NormStats
+from dataset import find_norm_stats
+from timeaxis import HourAxis, config_hour
 
 wind_u_fp = os.path.join(proj_dir, 'data/wind_u_10_grid.npy')
 wind_v_fp = os.path.join(proj_dir, 'data/wind_v_10_grid.npy')
@@ -25,9 +28,8 @@ grid_dict_lon_fp = os.path.join(proj_dir, 'data/dict_wind_grid_lon.pkl')
 lat_wind_fp = os.path.join(proj_dir,'data/lat_wind.npy')
 lon_wind_fp = os.path.join(proj_dir,'data/lon_wind.npy')
 
-frp_dict_fp = os.path.join(proj_dir, 'data/frp_dict.pkl')
 location_fp = os.path.join(proj_dir, 'data/latlon.csv')
-time_dict_fp = os.path.join(proj_dir, 'data/time_dict.pkl')
+geometry_cache_dir = os.path.join(proj_dir, 'data/geometry_cache')
 
 pm25_input_fp = os.path.join(proj_dir,'data/input_exp1/pm25.npy') 
 feature_input_fp = os.path.join(proj_dir,'data/input_exp1/feature.npy') 
@@ -61,22 +63,23 @@ class HazeData(data.Dataset):
         else:
             raise Exception('Wrong Flag!')
 
+        self.dataset_num = dataset_num
         self.start_time = self._get_time(config['dataset'][dataset_num][start_time_str])
         self.end_time = self._get_time(config['dataset'][dataset_num][end_time_str])
-        self.data_start = self._get_time(config['dataset']['data_start'])
-        self.data_end = self._get_time(config['dataset']['data_end'])
+        self.axis = HourAxis.from_config(fields=5)
+        self.knowair_axis = HourAxis.from_config() # hours of the knowair cube, the time_dict.pkl indices
         self.sim_window_start = config['dataset'][dataset_num][start_time_sim_window]
         self.sim_window_end = config['dataset'][dataset_num][end_time_sim_window]
         self.window = self._get_window(self.sim_window_start, self.sim_window_end)
         
         self.wu, self.wv = np.load(wind_u_fp), np.load(wind_v_fp)
-        self.time_dict = pickle.load( open(time_dict_fp, "rb" ) )
-        self.frp_dict = pickle.load( open(frp_dict_fp, "rb" ) )
+        self.catalog = FireCatalog.open()
         self.grid_dict_lat = pickle.load( open(grid_dict_lat_fp, "rb" ) )
         self.grid_dict_lon = pickle.load( open(grid_dict_lon_fp, "rb" ) )
 
         self.siteloc = np.asarray( pd.read_csv(location_fp).drop("Unnamed: 0", axis=1) )
         self.lat_grid, self.lon_grid = np.load(lat_wind_fp), np.load(lon_wind_fp)
+        self.wind_grid = WindGrid(self.lat_grid, self.lon_grid, self.grid_dict_lat, self.grid_dict_lon)
 
         self.knowair_fp = file_dir['knowair_fp']
         self.graph = graph
@@ -111,119 +114,117 @@ class HazeData(data.Dataset):
         self.pm25 = np.float32(self.pm25)
 
     def _replace_pm25(self):
-        for i in range(self.pm25.shape[0]):
-            for w in range(self.feature.shape[1]):
-                 timeind = self.time_dict[self.window[w]] # pm2.5 value of simulation window
-                 self.pm25[i, w, :, 0] = self.knowair[timeind, :, -1]
+        timeind = self.knowair_axis.index(self.window) # pm2.5 value of simulation window, the same for every sample
+        self.pm25[:, :, :, 0] = self.knowair[timeind, :, -1][None]
 
-    def _recalculate_frp(self):
+    def _recalculate_frp(self, workers=1):
         assert self.feature.shape[1] == len(self.window)
-
-        for i in range(self.feature.shape[0]): # loop for all time
-            for w in range(self.feature.shape[1]): # loop for window length
-                if self.window[w][:10] not in self.frp_dict.keys():
-                    continue
-                for j in range(len(self.siteloc[0])): # loop over locations
-                    latsite, lonsite = self.siteloc[0][j], self.siteloc[1][j]
-                    
-                    for fire in self.frp_dict[self.window[w][:10]]: # loop over all fires in the simulation window 
-                        latf, lonf, frp = fire[0], fire[1], fire[2]
-
-                        timeind = self.time_dict[str(datetime.fromtimestamp(self.time_arr[i,w]))[0:13]] # wind values collected at actual time, not simulated
-                        latind = self.grid_dict_lat[self._find_nearest(self.lat_grid, latf)]
-                        lonind = self.grid_dict_lon[self._find_nearest(self.lon_grid, lonf)]
-
-                        firewindu = self.wu[timeind][latind][lonind] * units.meter / units.second
-                        firewindv = self.wv[timeind][latind][lonind] * units.meter / units.second
-
-                        # get angle between fire location and site location
-                        bearingangle = self._calculate_initial_compass_bearing((latf, lonf), (latsite, lonsite))
-                        # get angle of wind u and v component at fire location
-                        wind_fire_angle = self._wind_uv_to_dir(firewindu, firewindv)._magnitude
-
-
-                        if abs(bearingangle-wind_fire_angle)<90:
-                            weight1 = self._wind_uv_to_spd(firewindu, firewindv)._magnitude
-                            dist = self._getdistance(latf, lonf, latsite, lonsite)
-                            weight2 = 1/ (dist*dist*4*math.pi)
-                            weight3 = math.cos( math.radians( abs(bearingangle-wind_fire_angle) ) )
-
-                            if dist <=25:
-                                self.feature[i,w,j,9] += frp*weight1*weight2*weight3 # FRP 25KM
-                            if dist <=50:
-                                self.feature[i,w,j,10] += frp*weight1*weight2*weight3 # FRP 50KM
-                            if dist <=100:
-                                self.feature[i,w,j,11] += frp*weight1*weight2*weight3 # FRP 100KM
-                            if dist <=500:
-                                self.feature[i,w,j,12] += frp*weight1*weight2*weight3 # FRP 500KM
-                                self.feature[i,w,j,13] += 1 # Number of fires within 500KM
+        geometry = GeometryCache(geometry_cache_dir, self.siteloc[0], self.siteloc[1])
+
+        fires = {}
+        for day in self.window:
+            if day[:10] in self.catalog and day[:10] not in fires:
+                fires[day[:10]] = self.catalog.fires(day[:10])
+        if not fires:
+            return
+        geometry.rows(np.concatenate([f[0] for f in fires.values()]), np.concatenate([f[1] for f in fires.values()]))
+
+        fire_geometry = {}
+        for day, (latf, lonf, frp) in fires.items():
+            latind, lonind = self.wind_grid.index(latf, lonf)
+            fire_geometry[day] = (frp, latind, lonind) + geometry.pairs(latf, lonf)
+
+        # wind values are collected at the actual hour of each window position, look up every hour once
+        times, hour = np.unique(self.time_arr, return_inverse=True)
+        hour = hour.reshape(self.time_arr.shape)
+        timeind = self.knowair_axis.index(times.astype(np.int64).astype('datetime64[s]'))
+
+        # shard by fire day, each shard adds the window positions of its days to a shared memmap
+        days = sorted(fire_geometry.keys())
+        shards = [days[k::workers] for k in range(max(1, workers))]
+        with tempfile.TemporaryDirectory() as tmp:
+            contrib_fp = os.path.join(tmp, 'frp.npy')
+            contrib = np.lib.format.open_memmap(contrib_fp, mode='w+', dtype=np.float64,
+                                                shape=self.feature.shape[:3] + (FRP_CHANNELS.stop - FRP_CHANNELS.start,))
+            del contrib
+
+            def _run_shard(shard, days):
+                contrib = np.load(contrib_fp, mmap_mode='r+')
+                for day in tqdm(days, desc='frp shard %d' % shard, position=shard, leave=False):
+                    frp, latind, lonind, fire_idx, site_idx, dist, bearing = fire_geometry[day] # all fires of the simulated day
+                    ws = [w for w in range(self.feature.shape[1]) if self.window[w][:10] == day]
+
+                    # one kernel call over the distinct hours of the day's window positions
+                    day_hours, inverse = np.unique(hour[:, ws], return_inverse=True)
+                    firewindu = self.wind_grid.gather(self.wu, timeind[day_hours], latind, lonind)
+                    firewindv = self.wind_grid.gather(self.wv, timeind[day_hours], latind, lonind)
+                    influence = frp_influence_pairs(frp, fire_idx, site_idx, dist, bearing,
+                                                    firewindu, firewindv, len(self.siteloc[0]))
+                    contrib[:, ws] = influence[inverse.reshape(len(hour), len(ws))]
+                contrib.flush()
+
+            map_shards(_run_shard, [days for days in shards if days], workers)
+            self.feature[..., FRP_CHANNELS] += np.load(contrib_fp)
 
     def _norm(self, flag):
         if flag == 'Test':
-            self.feature_mean = np.load(test_feat_mean_fp)
-            self.feature_std = np.load(test_feat_std_fp)
-            self.pm25_mean = np.load(test_pm25_mean_fp)
-            self.pm25_std = np.load(test_pm25_std_fp)
+            # statistics of the observed test split (see dataset.find_norm_stats); the separate npy files
+            # of runs from before norm_stats.npz otherwise
+            stats = find_norm_stats(self.graph, 'Test', self.dataset_num, file_dir.get('model_fp'))
+            if stats is not None:
+                self.feature_mean, self.feature_std = stats.feature_mean, stats.feature_std
+                self.pm25_mean, self.pm25_std = stats.pm25_mean, stats.pm25_std
+            else:
+                warnings.warn('No Test normalization statistics next to model_fp or for the data of this config, '
+                              'using %s, %s, %s and %s' % (test_feat_mean_fp, test_feat_std_fp, test_pm25_mean_fp, test_pm25_std_fp))
+                self.feature_mean = np.load(test_feat_mean_fp)
+                self.feature_std = np.load(test_feat_std_fp)
+                self.pm25_mean = np.load(test_pm25_mean_fp)
+                self.pm25_std = np.load(test_pm25_std_fp)
 
         self.feature = (self.feature - self.feature_mean) / self.feature_std
         self.pm25 = (self.pm25 - self.pm25_mean) / self.pm25_std
 
-    def _add_time_dim(self, seq_len):
+    def _add_time_dim(self, seq_len, stride=24):
 
         def _add_t(arr, seq_len):
             t_len = arr.shape[0]
             assert t_len > seq_len
-            arr_ts = []
-            for i in range(seq_len, t_len):
-                arr_t = arr[i-seq_len:i]
-                arr_ts.append(arr_t)
-            arr_ts = np.stack(arr_ts, axis=0)
-            return arr_ts
+            # windows arr[s:s+seq_len] for s = 0, stride, ... < t_len-seq_len-1, as a strided view of arr;
+            # only the kept windows are copied
+            windows = np.lib.stride_tricks.sliding_window_view(arr, seq_len, axis=0)[:t_len-seq_len-1:stride]
+            return np.ascontiguousarray(np.moveaxis(windows, -1, 1))
 
         self.pm25 = _add_t(self.pm25, seq_len)
         self.feature = _add_t(self.feature, seq_len)
         self.time_arr = _add_t(self.time_arr, seq_len)
 
-        keep = np.arange(0, self.pm25.shape[0]-1, 24)
-        l = self.pm25.shape[0]
-        for i in range(l-1, -1, -1):
-            if i not in keep:
-                self.pm25 = np.delete(self.pm25, i, 0)
-                self.feature = np.delete(self.feature,i,0)
-                self.time_arr = np.delete(self.time_arr, i,0)
-
-    def _calc_mean_std(self):
-        self.feature_mean = self.feature.mean(axis=(0,1))
-        self.feature_std = self.feature.std(axis=(0,1))
-        self.wind_mean = self.feature_mean[7:9] # 7 and 8 index of u and v component_of_wind+950
-        self.wind_std = self.feature_std[7:9] # 7 and 8 index of u and v component_of_wind+950
-        self.pm25_mean = self.pm25.mean()
-        self.pm25_std = self.pm25.std()
+    def _calc_mean_std(self, chunk_samples=64):
+        # streamed over chunks of windows (samples, seq_len, sites, channels), the hours of each chunk stacked
+        flat = lambda arr: arr.reshape((-1,) + arr.shape[-2:])
+        stats = NormStats.compute(lambda a, b: (flat(self.feature[a:b]), flat(self.pm25[a:b])), len(self.feature), chunk_samples)
+        # per site and channel, as mean(axis=(0,1)) of the windows; PM2.5 over all sites
+        self.feature_mean, self.feature_std = stats.feature_site_mean, stats.feature_site_std
+        self.wind_mean, self.wind_std = stats.feature_site_mean[:, stats.wind_idx], stats.feature_site_std[:, stats.wind_idx]
+        self.pm25_mean, self.pm25_std = stats.pm25_mean, stats.pm25_std
 
     def _process_feature(self):
         metero_var = config['data']['metero_var']
         metero_use = config['experiments']['metero_use']
         metero_idx = [metero_var.index(var) for var in metero_use]
-        self.feature = self.feature[:,:,metero_idx]
-
-        u = self.feature[:, :, 7] * units.meter / units.second # 7 is the index of u_component_of_wind+950
-        v = self.feature[:, :, 8] * units.meter / units.second # 8 is the index of v_component_of_wind+950
-        speed = 3.6 * mpcalc.wind_speed(u, v)._magnitude
-        direc = mpcalc.wind_direction(u, v)._magnitude
-
-        h_arr = []
-        w_arr = []
-        for i in self.time_arrow:
-            h_arr.append(i.hour)
-            w_arr.append(i.isoweekday())
-        h_arr = np.stack(h_arr, axis=-1)
-        w_arr = np.stack(w_arr, axis=-1)
-        h_arr = np.repeat(h_arr[:, None], self.graph.node_num, axis=1)
-        w_arr = np.repeat(w_arr[:, None], self.graph.node_num, axis=1)
-
-        self.feature = np.concatenate([self.feature, h_arr[:, :, None], w_arr[:, :, None],
-                                       speed[:, :, None], direc[:, :, None]
-                                       ], axis=-1)
+
+        u = self.feature[:, :, metero_idx[7]] # 7 is the index of u_component_of_wind+950 (m/s)
+        v = self.feature[:, :, metero_idx[8]] # 8 is the index of v_component_of_wind+950 (m/s)
+
+        # float32 from the start, the wind is derived from the raw values
+        m = len(metero_idx)
+        feature = np.empty(self.feature.shape[:2] + (m + 4,), dtype=np.float32)
+        feature[:, :, :m] = self.feature[:, :, metero_idx]
+        feature[:, :, m] = self.axis.hour(self.time_idx)[:, None]
+        feature[:, :, m + 1] = self.axis.isoweekday(self.time_idx)[:, None]
+        feature[:, :, m + 2] = 3.6 * wind_speed(u, v)
+        feature[:, :, m + 3] = wind_direction(u, v)
+        self.feature = feature
 
     def _process_time(self):
         start_idx = self._get_idx(self.start_time)
@@ -231,37 +232,31 @@ class HazeData(data.Dataset):
         self.pm25 = self.pm25[start_idx: end_idx+1, :]
         self.feature = self.feature[start_idx: end_idx+1, :]
         self.time_arr = self.time_arr[start_idx: end_idx+1]
-        self.time_arrow = self.time_arrow[start_idx: end_idx + 1]
+        self.time_idx = self.time_idx[start_idx: end_idx + 1]
 
 
     def _gen_time_arr(self):
-        self.time_arrow = []
-        self.time_arr = []
         # determines time granularity (1 hour)
-        for time_arrow in arrow.Arrow.interval('hour', self.data_start, self.data_end.shift(hours=+1), 1):
-            self.time_arrow.append(time_arrow[0])
-            self.time_arr.append(time_arrow[0].timestamp)
-        self.time_arr = np.stack(self.time_arr, axis=-1)
+        self.time_idx = np.arange(len(self.axis))
+        self.time_arr = self.axis.timestamps(self.time_idx)
 
     def _load_npy(self):
-        self.knowair = np.load(self.knowair_fp)
+        overlay = file_dir.get('knowair_overlay') # named OverlayDataset of overlays.yaml, read lazily
+        self.knowair = OverlayDataset.from_yaml(overlay) if overlay else np.load(self.knowair_fp)
         self.feature = self.knowair[:,:,:-1]
         self.pm25 = self.knowair[:,:,-1:]
 
     def _get_idx(self, t):
-        t0 = self.data_start
         # determines time granularity
-        return int((t.timestamp - t0.timestamp) / (60 * 60))
+        return int(self.axis.index(t))
 
     def _get_window(self, start, end):
-        window = np.arange(datetime(start[0][0],start[0][1],start[0][2],0), datetime(end[0][0],end[0][1],end[0][2],0), timedelta(hours=1)).astype(datetime)
-        for i in range(len(window)):
-            window[i] = window[i].strftime('%Y-%m-%d %H')
-        return window
+        # 'YYYY-MM-DD HH' labels of the simulation window hours
+        start, end = config_hour(start), config_hour(end)
+        return HourAxis(start, int((end - start) // np.timedelta64(1, 'h'))).labels()
 
     def _get_time(self, time_yaml):
-        arrow_time = arrow.get(datetime(*time_yaml[0]), time_yaml[1])
-        return arrow_time
+        return config_hour(time_yaml, fields=5)
 
     def __len__(self):
         return len(self.pm25)
@@ -269,82 +264,6 @@ class HazeData(data.Dataset):
     def __getitem__(self, index):
         return self.pm25[index], self.feature[index], self.time_arr[index]
 
-    def _getdistance(self, lat1, lon1, lat2, lon2):
-        coords_1 = (lat1, lon1)
-        coords_2 = (lat2, lon2)
-        return (geopy.distance.distance(coords_1, coords_2).km)
-
-    def _find_nearest(self, array, value):
-        array = np.asarray(array)
-        idx = (np.abs(array - value)).argmin()
-        return array[idx]
-
-
-    def _calculate_initial_compass_bearing(self, pointA, pointB):
-        """
-        Calculates the bearing between two points.
-        The formulae used is the following:
-            θ = atan2(sin(Δlong).cos(lat2),
-                      cos(lat1).sin(lat2) − sin(lat1).cos(lat2).cos(Δlong))
-        :Parameters:
-          - `pointA: The tuple representing the latitude/longitude for the
-            first point. Latitude and longitude must be in decimal degrees
-          - `pointB: The tuple representing the latitude/longitude for the
-            second point. Latitude and longitude must be in decimal degrees
-        :Returns:
-          The bearing in degrees
-        :Returns Type:
-          float
-        """
-        if (type(pointA) != tuple) or (type(pointB) != tuple):
-            raise TypeError("Only tuples are supported as arguments")
-
-        lat1 = math.radians(pointA[0])
-        lat2 = math.radians(pointB[0])
-
-        diffLong = math.radians(pointB[1] - pointA[1])
-
-        x = math.sin(diffLong) * math.cos(lat2)
-        y = math.cos(lat1) * math.sin(lat2) - (math.sin(lat1)
-                * math.cos(lat2) * math.cos(diffLong))
-
-        initial_bearing = math.atan2(x, y)
-
-        # Now we have the initial bearing but math.atan2 return values
-        # from -180° to + 180° which is not what we want for a compass bearing
-        # The solution is to normalize the initial bearing as shown below
-        initial_bearing = math.degrees(initial_bearing)
-        compass_bearing = (initial_bearing + 360) % 360
-
-        return compass_bearing
-
-
-    def _wind_uv_to_dir(self, U, V):
-        """
-        Calculates the wind direction from the u and v component of wind.
-        Takes into account the wind direction coordinates is different than the
-        trig unit circle coordinate. If the wind directin is 360 then returns zero
-        (by %360)
-        Inputs:
-          U = west/east direction (wind from the west is positive, from the east is negative)
-          V = south/noth direction (wind from the south is positive, from the north is negative)
-        """
-        #WDIR= (270-np.rad2deg(np.arctan2(V,U)))%360
-        WDIR = mpcalc.wind_direction(U, V, convention='to')%360
-        return WDIR
-
-
-    def _wind_uv_to_spd(self, U, V):
-        """
-        Calculates the wind speed from the u and v wind components
-        Inputs:
-          U = west/east direction (wind from the west is positive, from the east is negative)
-          V = south/noth direction (wind from the south is positive, from the north is negative)
-        """
-        #WSPD = np.sqrt(np.square(U)+np.square(V))
-        WSPD = mpcalc.wind_speed(U, V)
-        return WSPD
-
 if __name__ == '__main__':
     from graph import Graph
     graph = Graph()
@@ -0,0 +1,140 @@
+import os
+import hashlib
+import numpy as np
+import pickle
+import time
+import requests
+
+
+class ArrayElevation():
+    """
+    Elevation from a local DEM: a (lat, lon) grid of elevations in meters over
+    ascending 1-D lat and lon axes, looked up at the nearest grid cell.
+    """
+    def __init__(self, lat_axis, lon_axis, elevation):
+        self.lat_axis = np.asarray(lat_axis, dtype=np.float64)
+        self.lon_axis = np.asarray(lon_axis, dtype=np.float64)
+        self.elevation = np.asarray(elevation, dtype=np.float64)
+        assert self.elevation.shape == (len(self.lat_axis), len(self.lon_axis))
+
+    @property
+    def cache_key(self):
+        """ Identifies the elevations this provider returns, for caches of what is built from them. """
+        h = hashlib.sha1()
+        for arr in (self.lat_axis, self.lon_axis, self.elevation):
+            h.update(np.ascontiguousarray(arr).tobytes())
+        return 'dem:' + h.hexdigest()
+
+    @classmethod
+    def from_npz(cls, fp):
+        """ DEM saved with np.savez(fp, lat=..., lon=..., elevation=...). """
+        with np.load(fp) as f:
+            return cls(f['lat'], f['lon'], f['elevation'])
+
+    @staticmethod
+    def _nearest(axis, values):
+        idx = np.clip(np.searchsorted(axis, values), 1, len(axis) - 1)
+        return np.where(np.abs(values - axis[idx - 1]) <= np.abs(axis[idx] - values), idx - 1, idx)
+
+    def __call__(self, lat, lon):
+        lat, lon = np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64)
+        return self.elevation[self._nearest(self.lat_axis, lat), self._nearest(self.lon_axis, lon)]
+
+
+class OpenTopoDataElevation():
+    """
+    Elevation from an opentopodata server, `batch_size` points per request and
+    at least `interval` seconds between requests (the public API allows 100
+    locations and one request per second). Requests that fail to connect, time
+    out or get a 429 or 5xx are retried up to `retries` times, waiting
+    backoff, 2 * backoff, ... seconds in between.
+    """
+    def __init__(self, url='https://api.opentopodata.org/v1/test-dataset', batch_size=100, interval=1.0,
+                 retries=3, backoff=2.0, timeout=30.0):
+        self.url = url
+        self.batch_size = batch_size
+        self.interval = interval
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.last_request = 0.0
+
+    @property
+    def cache_key(self):
+        return 'opentopodata:' + self.url
+
+    def _get(self, locations):
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            wait = self.last_request + self.interval - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                res = requests.get(self.url, params={'locations': locations}, timeout=self.timeout)
+                error = 'HTTP %d' % res.status_code
+                if res.status_code != 429 and res.status_code < 500:
+                    return res.json()
+            except requests.RequestException as e:
+                error = e
+            finally:
+                self.last_request = time.time()
+        raise Exception('opentopodata request failed after %d attempts: %s' % (self.retries + 1, error))
+
+    def __call__(self, lat, lon):
+        lat, lon = np.atleast_1d(lat), np.atleast_1d(lon)
+        alt = np.full(len(lat), 0.0)
+        for a in range(0, len(lat), self.batch_size):
+            locations = '|'.join(str(la) + ',' + str(lo) for la, lo in zip(lat[a:a + self.batch_size], lon[a:a + self.batch_size]))
+            res = self._get(locations)
+            if res.get('status') != 'OK':
+                raise Exception('opentopodata request failed: %s' % res.get('error', res.get('status')))
+            for i, result in enumerate(res['results']):
+                if result['elevation'] is None:
+                    raise Exception('No elevation at %s,%s' % (lat[a + i], lon[a + i]))
+                alt[a + i] = (float)(result['elevation'])
+        return alt
+
+
+class CachedElevation():
+    """
+    Write-through cache in front of another elevation provider. The cache is
+    the {(lat, lon): altitude} dict of alt.pkl; points that are not in it are
+    fetched from the provider in one batch and the pickle is rewritten, so
+    every elevation is requested at most once. The cache_key covers both the
+    provider and the content of alt.pkl, so what was built from other cached
+    elevations is not reused.
+    """
+    def __init__(self, cache_fp, provider=None):
+        self.cache_fp = cache_fp
+        self.provider = provider
+        self.cache = {}
+        if os.path.isfile(cache_fp):
+            with open(cache_fp, 'rb') as f:
+                self.cache = pickle.load(f)
+
+    @property
+    def cache_key(self):
+        h = hashlib.sha1()
+        if os.path.isfile(self.cache_fp):
+            with open(self.cache_fp, 'rb') as f:
+                h.update(f.read())
+        source = getattr(self.provider, 'cache_key', None)
+        return (source + '|' if source else '') + 'pickle:' + h.hexdigest()
+
+    def _save(self):
+        tmp_fp = self.cache_fp + '.tmp'
+        with open(tmp_fp, 'wb') as f:
+            pickle.dump(self.cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_fp, self.cache_fp)
+
+    def __call__(self, lat, lon):
+        keys = list(zip(np.atleast_1d(lat).tolist(), np.atleast_1d(lon).tolist()))
+        missing = list(dict.fromkeys(key for key in keys if key not in self.cache))
+        if missing:
+            if self.provider is None:
+                raise Exception('%d elevations are not in %s and there is no provider' % (len(missing), self.cache_fp))
+            alt = self.provider(np.array([key[0] for key in missing]), np.array([key[1] for key in missing]))
+            self.cache.update(zip(missing, alt.tolist()))
+            self._save()
+        return np.array([self.cache[key] for key in keys], dtype=np.float64)
@@ -0,0 +1,114 @@
+import os
+import sys
+proj_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(proj_dir)
+
+import numpy as np
+import pickle
+
+from frp import fire_arrays
+
+frp_dict_fp = os.path.join(proj_dir, 'data/frp_dict.pkl')
+catalog_fp = os.path.join(proj_dir, 'data/frp_catalog.npz')
+
+
+class FireCatalog():
+    """
+    Columnar store of the fire detections of frp_dict.pkl.
+
+    The fires are kept as contiguous lat, lon, frp and day (UTC,
+    datetime64[D]) arrays sorted by day, with a per-day index: the fires of
+    days[k] are rows offsets[k]:offsets[k+1]. A date range is a slice of the
+    arrays and a bounding box a mask over them, so loading a season of fires
+    does not need the whole pickle.
+    """
+    def __init__(self, lat, lon, frp, day, presorted=False):
+        day = np.asarray(day, dtype='datetime64[D]')
+        order = slice(None) if presorted else np.argsort(day, kind='stable')
+        self.lat = np.asarray(lat, dtype=np.float64)[order]
+        self.lon = np.asarray(lon, dtype=np.float64)[order]
+        self.frp = np.asarray(frp, dtype=np.float64)[order]
+        self.day = day[order]
+        self.days, first = np.unique(self.day, return_index=True)
+        self.offsets = np.append(first, len(self.day)).astype(np.int64)
+
+    @classmethod
+    def from_frp_dict(cls, frp_dict):
+        """ Imports a {'YYYY-MM-DD': {(lat, lon, frp, ...), ...}} dict, keeping the order of every day's fires. """
+        lat, lon, frp, day = [], [], [], []
+        for key in sorted(frp_dict.keys()):
+            latf, lonf, frpf = fire_arrays(frp_dict[key])
+            lat.append(latf)
+            lon.append(lonf)
+            frp.append(frpf)
+            day.append(np.full(len(latf), np.datetime64(key, 'D')))
+        if not day:
+            return cls(np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0, dtype='datetime64[D]'))
+        return cls(np.concatenate(lat), np.concatenate(lon), np.concatenate(frp), np.concatenate(day), presorted=True)
+
+    @classmethod
+    def from_pickle(cls, fp=frp_dict_fp):
+        with open(fp, 'rb') as f:
+            return cls.from_frp_dict(pickle.load(f))
+
+    @classmethod
+    def load(cls, fp=catalog_fp):
+        with np.load(fp) as f:
+            return cls(f['lat'], f['lon'], f['frp'], f['day'], presorted=True)
+
+    @classmethod
+    def open(cls, fp=catalog_fp, pickle_fp=frp_dict_fp):
+        """
+        Loads the catalog at fp, importing it from the frp_dict pickle first
+        when it does not exist yet or the pickle was modified after it.
+        """
+        if os.path.isfile(fp) and not (os.path.isfile(pickle_fp) and os.path.getmtime(pickle_fp) > os.path.getmtime(fp)):
+            return cls.load(fp)
+        catalog = cls.from_pickle(pickle_fp)
+        catalog.save(fp)
+        return catalog
+
+    def save(self, fp=catalog_fp):
+        tmp_fp = fp + '.tmp'
+        with open(tmp_fp, 'wb') as f:
+            np.savez(f, lat=self.lat, lon=self.lon, frp=self.frp, day=self.day)
+        os.replace(tmp_fp, fp)
+
+    def __len__(self):
+        return len(self.day)
+
+    def __contains__(self, day):
+        k = np.searchsorted(self.days, np.datetime64(day[0:10], 'D'))
+        return k < len(self.days) and self.days[k] == np.datetime64(day[0:10], 'D')
+
+    def day_strings(self):
+        """ The days with fires as 'YYYY-MM-DD' strings. """
+        return np.datetime_as_string(self.days, unit='D').tolist()
+
+    def fires(self, day):
+        """ (lat, lon, frp) arrays of the fires of one day ('YYYY-MM-DD'), empty if it has none. """
+        if day not in self:
+            return np.zeros(0), np.zeros(0), np.zeros(0)
+        k = np.searchsorted(self.days, np.datetime64(day[0:10], 'D'))
+        rows = slice(self.offsets[k], self.offsets[k + 1])
+        return self.lat[rows], self.lon[rows], self.frp[rows]
+
+    def between(self, first=None, last=None):
+        """ Catalog of the fires from day first to day last (inclusive), None for an open end. """
+        a = 0 if first is None else self.offsets[np.searchsorted(self.days, np.datetime64(first[0:10], 'D'), side='left')]
+        b = len(self) if last is None else self.offsets[np.searchsorted(self.days, np.datetime64(last[0:10], 'D'), side='right')]
+        return FireCatalog(self.lat[a:b], self.lon[a:b], self.frp[a:b], self.day[a:b], presorted=True)
+
+    def bbox(self, lat_min, lat_max, lon_min, lon_max):
+        """ Catalog of the fires inside a lat/lon bounding box (inclusive). """
+        keep = (self.lat >= lat_min) & (self.lat <= lat_max) & (self.lon >= lon_min) & (self.lon <= lon_max)
+        return FireCatalog(self.lat[keep], self.lon[keep], self.frp[keep], self.day[keep], presorted=True)
+
+
+def main():
+    catalog = FireCatalog.from_pickle(frp_dict_fp)
+    catalog.save(catalog_fp)
+    print('%d fires on %d days -> %s' % (len(catalog), len(catalog.days), catalog_fp))
+
+if __name__ == '__main__':
+    main()
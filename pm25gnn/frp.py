@@ -0,0 +1,370 @@
+import os
+import hashlib
+import multiprocessing
+import numpy as np
+from scipy.spatial import cKDTree
+
+from metcalc import EARTH_RADIUS_KM, compass_bearing, geodesic, wind_direction, wind_speed
+
+FRP_BANDS_KM = (25, 50, 100, 500) # frp_25km_idw, frp_50km_idw, frp_100km_idw, frp_500km_idw
+FRP_CHANNELS = slice(9, 14) # 4 IDW bands followed by numfires in the knowair cube
+
+
+class WindGrid():
+    """
+    Nearest-cell index into the ERA5 wind grids for arrays of fire coordinates.
+
+    Equivalent to looking up grid_dict_lat[find_nearest(lat_grid, lat)] (and
+    the same for longitude) for every fire, but resolved with a binary search
+    over the axes. The optional lat_index/lon_index dicts (dict_wind_grid_*.pkl)
+    are read once at construction into position -> grid index arrays.
+    """
+    def __init__(self, lat_axis, lon_axis, lat_index=None, lon_index=None):
+        self.lat_axis = np.asarray(lat_axis, dtype=np.float64)
+        self.lon_axis = np.asarray(lon_axis, dtype=np.float64)
+        self.lat_pos = self._positions(self.lat_axis, lat_index)
+        self.lon_pos = self._positions(self.lon_axis, lon_index)
+        self.lat_order = np.argsort(self.lat_axis, kind='stable')
+        self.lon_order = np.argsort(self.lon_axis, kind='stable')
+
+    @staticmethod
+    def _positions(axis, index):
+        if index is None:
+            return np.arange(len(axis))
+        return np.array([index[value] for value in axis])
+
+    @staticmethod
+    def _nearest(axis, order, value):
+        # the two axis points around each value, ties go to the lower position like argmin
+        value = np.asarray(value, dtype=np.float64)
+        right = np.clip(np.searchsorted(axis[order], value), 0, len(axis) - 1)
+        left = np.clip(right - 1, 0, len(axis) - 1)
+        cand = np.stack([order[left], order[right]], axis=-1)
+        err = np.abs(axis[cand] - value[..., None])
+        pick = (err[..., 1] < err[..., 0]) | ((err[..., 1] == err[..., 0]) & (cand[..., 1] < cand[..., 0]))
+        return np.where(pick, cand[..., 1], cand[..., 0])
+
+    def index(self, lat, lon):
+        """ (lat_idx, lon_idx) wind grid indices of the cells nearest to each point. """
+        lat_idx = self.lat_pos[self._nearest(self.lat_axis, self.lat_order, lat)]
+        lon_idx = self.lon_pos[self._nearest(self.lon_axis, self.lon_order, lon)]
+        return lat_idx, lon_idx
+
+    def gather(self, field, timeind, lat_idx, lon_idx):
+        """ field[timeind, lat_idx, lon_idx] for every (hour, fire), shape (hours, fires). """
+        timeind = np.asarray(timeind)
+        return field[timeind[:, None], np.asarray(lat_idx)[None, :], np.asarray(lon_idx)[None, :]]
+
+
+def _unit_vectors(lat, lon):
+    lat, lon = np.radians(lat), np.radians(lon)
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+class SpatialIndex():
+    """
+    KD-tree over points on the sphere (as 3D unit vectors) for radius queries
+    in kilometers. The tree distance is spherical, so radii are padded by
+    `margin` and callers check the exact ellipsoidal distance of the returned
+    candidates.
+    """
+    def __init__(self, lat, lon):
+        self.tree = cKDTree(_unit_vectors(np.atleast_1d(lat), np.atleast_1d(lon)))
+
+    def pairs(self, lat, lon, radius_km, margin=0.01):
+        """ (query_idx, point_idx) of the query points within radius_km of the indexed points. """
+        query = cKDTree(_unit_vectors(np.atleast_1d(lat), np.atleast_1d(lon)))
+        chord = 2 * np.sin(radius_km * (1 + margin) / (2 * EARTH_RADIUS_KM))
+        found = query.sparse_distance_matrix(self.tree, chord, output_type='ndarray')
+        return found['i'].astype(np.int64), found['j'].astype(np.int64)
+
+
+def fire_arrays(fires):
+    """ Splits an iterable of (lat, lon, frp, ...) fire tuples into float arrays. """
+    fires = list(fires)
+    lat = np.array([fire[0] for fire in fires], dtype=np.float64)
+    lon = np.array([fire[1] for fire in fires], dtype=np.float64)
+    frp = np.array([fire[2] for fire in fires], dtype=np.float64)
+    return lat, lon, frp
+
+
+def fire_site_geometry(fire_lat, fire_lon, site_lat, site_lon):
+    """
+    Distance (km) and bearing (degrees) from every fire to every site.
+    Returns two arrays of shape (fires, sites).
+    """
+    fire_lat, fire_lon = np.asarray(fire_lat)[:, None], np.asarray(fire_lon)[:, None]
+    site_lat, site_lon = np.asarray(site_lat)[None, :], np.asarray(site_lon)[None, :]
+    dist = geodesic(fire_lat, fire_lon, site_lat, site_lon)
+    bearing = compass_bearing(fire_lat, fire_lon, site_lat, site_lon)
+    return dist, bearing
+
+
+def frp_influence(frp, dist, bearing, wind_u, wind_v, bands=FRP_BANDS_KM):
+    """
+    Wind-weighted inverse distance FRP of a set of fires at every site, with
+    dist and bearing of shape (fires, sites) as from fire_site_geometry.
+    See frp_influence_pairs.
+    """
+    fire_idx, site_idx = np.nonzero(dist <= bands[-1])
+    return frp_influence_pairs(frp, fire_idx, site_idx, dist[fire_idx, site_idx], bearing[fire_idx, site_idx],
+                               wind_u, wind_v, dist.shape[1], bands)
+
+
+def frp_influence_pairs(frp, fire_idx, site_idx, dist, bearing, wind_u, wind_v, n_sites, bands=FRP_BANDS_KM,
+                        fire_masks=None):
+    """
+    Wind-weighted inverse distance FRP at every site from candidate (fire, site) pairs.
+
+    A fire contributes frp * speed * cos(theta) / (4 * pi * dist^2) to a site
+    when the angle theta between the fire->site bearing and the direction the
+    wind at the fire blows towards is below 90 degrees, and it is counted as
+    one fire when it also lies within the largest band. Pairs farther apart
+    than the largest band contribute nothing, so only the pairs found by a
+    SpatialIndex query need to be passed.
+
+    :Parameters:
+      - `frp`: (fires,) fire radiative power
+      - `fire_idx`, `site_idx`: (pairs,) fire and site of each candidate pair
+      - `dist`, `bearing`: (pairs,) distance (km) and bearing (degrees) of each pair
+      - `wind_u`, `wind_v`: (..., fires) wind at the fire locations, any
+        leading dimensions (e.g. hours of the day) are kept in the output
+      - `n_sites`: number of sites
+      - `bands`: radii in km of the IDW channels
+      - `fire_masks`: optional (scenarios, fires) bool, the subsets of the
+        fires to compute the influence of; the pair weights are shared
+    :Returns:
+      Array of shape (..., n_sites, len(bands) + 1), the IDW FRP for each band
+      followed by the number of fires within the largest band, with a leading
+      scenario dimension when fire_masks is given.
+    """
+    wind_u, wind_v = np.asarray(wind_u, dtype=np.float64), np.asarray(wind_v, dtype=np.float64)
+    lead = wind_u.shape[:-1]
+    n_lead = int(np.prod(lead))
+    wind_u, wind_v = wind_u.reshape(n_lead, -1), wind_v.reshape(n_lead, -1)
+
+    theta = np.abs(bearing - (wind_direction(wind_u, wind_v, convention='to') % 360)[:, fire_idx])
+    downwind = theta < 90
+    weight = np.where(downwind,
+                      np.asarray(frp)[fire_idx] * wind_speed(wind_u, wind_v)[:, fire_idx] * np.cos(np.radians(theta)) \
+                      / (dist * dist * 4 * np.pi),
+                      0.0)
+
+    # scatter-add every (lead, pair) onto its (lead, site) cell
+    cell = (np.arange(n_lead)[:, None] * n_sites + site_idx[None, :]).ravel()
+    def scatter(weight, count):
+        out = np.empty((n_lead, n_sites, len(bands) + 1))
+        for k, band in enumerate(bands):
+            out[:, :, k] = np.bincount(cell, (weight * (dist <= band)).ravel(),
+                                       minlength=n_lead * n_sites).reshape(n_lead, n_sites)
+        out[:, :, -1] = np.bincount(cell, (count & (dist <= bands[-1])).ravel(),
+                                    minlength=n_lead * n_sites).reshape(n_lead, n_sites)
+        return out.reshape(lead + (n_sites, len(bands) + 1))
+
+    if fire_masks is None:
+        return scatter(weight, downwind)
+    pair_masks = np.asarray(fire_masks, dtype=bool)[:, fire_idx]
+    return np.stack([scatter(weight * mask, downwind & mask) for mask in pair_masks])
+
+
+_shard_func = None
+
+def _call_shard(args):
+    return _shard_func(*args)
+
+
+def map_shards(func, shards, workers=1):
+    """
+    Runs func(shard_index, shard) for every shard, in a forked process pool
+    when workers > 1. func is handed to the workers through the fork rather
+    than pickled, so it can be a bound method of an object holding large
+    (memory-mapped) arrays; results should be written to a shared memmap.
+    """
+    global _shard_func
+    if workers <= 1 or len(shards) <= 1:
+        return [func(i, shard) for i, shard in enumerate(shards)]
+    _shard_func = func
+    try:
+        with multiprocessing.get_context('fork').Pool(min(workers, len(shards))) as pool:
+            return pool.map(_call_shard, list(enumerate(shards)), chunksize=1)
+    finally:
+        _shard_func = None
+
+
+class GeometryCache():
+    """
+    Persistent fire->site distance and bearing keyed by the fire location
+    rounded to `decimals`. The site geometry is fixed, so rows are computed
+    once per fire location and kept in `cache_dir` as memory-mapped arrays;
+    locations that are not in the cache yet are computed and written through
+    on lookup.
+
+    Files in `cache_dir`:
+      - index.npz: sorted int64 keys, rounded fire coordinates, site coordinates
+      - dist.npy, bearing.npy: (locations, sites) float32
+      - center_<lat>_<lon>.npy: (locations,) distance to a scenario center
+    """
+    def __init__(self, cache_dir, site_lat, site_lon, decimals=5):
+        self.cache_dir = cache_dir
+        self.sites = np.stack([np.asarray(site_lat, dtype=np.float64), np.asarray(site_lon, dtype=np.float64)])
+        self.decimals = decimals
+        self.scale = 10 ** decimals
+        self.centers = {}
+        self.site_index = None
+        self._open()
+
+    def _fp(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def _open(self):
+        index_fp = self._fp('index.npz')
+        if os.path.isfile(index_fp):
+            index = np.load(index_fp)
+            if int(index['decimals']) == self.decimals and np.array_equal(index['sites'], self.sites):
+                self.keys, self.coords = index['keys'], index['coords']
+                self.dist = np.load(self._fp('dist.npy'), mmap_mode='r')
+                self.bearing = np.load(self._fp('bearing.npy'), mmap_mode='r')
+                return
+        # no cache yet, or it was built for another set of sites
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.coords = np.zeros((0, 2), dtype=np.float64)
+        self.dist = np.zeros((0, self.sites.shape[1]), dtype=np.float32)
+        self.bearing = np.zeros((0, self.sites.shape[1]), dtype=np.float32)
+
+    def _save(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        for name, arr in (('dist', self.dist), ('bearing', self.bearing)):
+            np.save(self._fp(name + '.tmp.npy'), arr)
+            os.replace(self._fp(name + '.tmp.npy'), self._fp(name + '.npy'))
+        np.savez(self._fp('index.tmp.npz'), keys=self.keys, coords=self.coords,
+                 sites=self.sites, decimals=self.decimals)
+        os.replace(self._fp('index.tmp.npz'), self._fp('index.npz'))
+        self.dist = np.load(self._fp('dist.npy'), mmap_mode='r')
+        self.bearing = np.load(self._fp('bearing.npy'), mmap_mode='r')
+
+    def _round(self, lat, lon):
+        ilat = np.round(np.asarray(lat, dtype=np.float64) * self.scale).astype(np.int64)
+        ilon = np.round(np.asarray(lon, dtype=np.float64) * self.scale).astype(np.int64)
+        return ilat, ilon, (ilat << 32) + ilon
+
+    def _add(self, ilat, ilon, keys):
+        keys, first = np.unique(keys, return_index=True)
+        coords = np.stack([ilat[first], ilon[first]], axis=-1) / self.scale
+        dist, bearing = fire_site_geometry(coords[:, 0], coords[:, 1], self.sites[0], self.sites[1])
+
+        order = np.argsort(np.concatenate([self.keys, keys]), kind='stable')
+        self.keys = np.concatenate([self.keys, keys])[order]
+        self.coords = np.concatenate([self.coords, coords])[order]
+        self.dist = np.concatenate([self.dist, dist.astype(np.float32)])[order]
+        self.bearing = np.concatenate([self.bearing, bearing.astype(np.float32)])[order]
+        self._save()
+        # center distances are aligned with the old rows
+        for name in os.listdir(self.cache_dir):
+            if name.startswith('center_'):
+                os.remove(self._fp(name))
+        self.centers = {}
+
+    def rows(self, lat, lon):
+        """ Cache rows of the given fire locations, computing any missing ones. """
+        ilat, ilon, keys = self._round(lat, lon)
+        rows = np.searchsorted(self.keys, keys)
+        found = rows < len(self.keys)
+        found[found] = self.keys[rows[found]] == keys[found]
+        if not found.all():
+            self._add(ilat[~found], ilon[~found], keys[~found])
+            rows = np.searchsorted(self.keys, keys)
+        return rows
+
+    def geometry(self, rows):
+        """ Distance (km) and bearing (degrees) arrays of shape (len(rows), sites). """
+        return np.asarray(self.dist[rows], dtype=np.float64), np.asarray(self.bearing[rows], dtype=np.float64)
+
+    def pairs(self, lat, lon, radius_km=FRP_BANDS_KM[-1]):
+        """
+        Candidate (fire, site) pairs within radius_km, found with a SpatialIndex
+        over the sites and checked against the cached distances.
+        Returns (fire_idx, site_idx, dist, bearing), each of shape (pairs,).
+        """
+        if self.site_index is None:
+            self.site_index = SpatialIndex(self.sites[0], self.sites[1])
+        rows = self.rows(lat, lon)
+        fire_idx, site_idx = self.site_index.pairs(lat, lon, radius_km)
+        dist = np.asarray(self.dist[rows[fire_idx], site_idx], dtype=np.float64)
+        bearing = np.asarray(self.bearing[rows[fire_idx], site_idx], dtype=np.float64)
+        keep = dist <= radius_km
+        return fire_idx[keep], site_idx[keep], dist[keep], bearing[keep]
+
+    def center_distance(self, rows, center_lat, center_lon):
+        """ Distance (km) from the cached fire locations to a scenario center. """
+        name = 'center_%.5f_%.5f.npy' % (center_lat, center_lon)
+        if name not in self.centers:
+            fp = self._fp(name)
+            if not os.path.isfile(fp):
+                os.makedirs(self.cache_dir, exist_ok=True)
+                np.save(fp, geodesic(self.coords[:, 0], self.coords[:, 1], center_lat, center_lon))
+            self.centers[name] = np.load(fp, mmap_mode='r')
+        return np.asarray(self.centers[name][rows])
+
+
+def fire_digest(*arrays):
+    """ Content hash of a day's fire list (and any scenario parameters it is applied with). """
+    h = hashlib.sha1()
+    for arr in arrays:
+        h.update(np.ascontiguousarray(arr, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+class ContributionStore():
+    """
+    Per fire day FRP contributions, (hours, sites, 5) float64 deltas of the FRP
+    channels, saved as `day_<key>.npz` in `store_dir` together with the dataset
+    hours they were added to and the fire_digest they were computed from.
+    When the fire catalog changes only the days whose digest differs need to be
+    recomputed, and the dataset is patched by the difference.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+
+    def _fp(self, key):
+        return os.path.join(self.store_dir, 'day_%s.npz' % key)
+
+    def keys(self):
+        return [name[4:-4] for name in os.listdir(self.store_dir) if name.startswith('day_') and name.endswith('.npz')]
+
+    def digest(self, key):
+        fp = self._fp(key)
+        if not os.path.isfile(fp):
+            return None
+        with np.load(fp) as f:
+            return str(f['digest'])
+
+    def load(self, key):
+        """ (hours, contrib) of a stored day, None if it is not stored. """
+        fp = self._fp(key)
+        if not os.path.isfile(fp):
+            return None
+        with np.load(fp) as f:
+            return f['hours'], f['contrib']
+
+    def save(self, key, digest, hours, contrib):
+        tmp_fp = self._fp(key) + '.tmp'
+        with open(tmp_fp, 'wb') as f:
+            np.savez(f, digest=digest, hours=np.asarray(hours, dtype=np.int64), contrib=contrib)
+        os.replace(tmp_fp, self._fp(key))
+
+    def slab(self):
+        """ (start, end) dataset hours of the output the stored days were patched into. """
+        fp = os.path.join(self.store_dir, 'slab.npy')
+        return tuple(int(h) for h in np.load(fp)) if os.path.isfile(fp) else None
+
+    def set_slab(self, start, end):
+        np.save(os.path.join(self.store_dir, 'slab.npy'), np.array([start, end], dtype=np.int64))
+
+    def remove(self, key):
+        if os.path.isfile(self._fp(key)):
+            os.remove(self._fp(key))
+
+    def clear(self):
+        for key in self.keys():
+            self.remove(key)
@@ -2,18 +2,15 @@ import os
 import sys
 proj_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(proj_dir)
+import hashlib
+import json
 import numpy as np
-import torch
 from collections import OrderedDict
-from scipy.spatial import distance
-from torch_geometric.utils import dense_to_sparse, to_dense_adj
-from geopy.distance import geodesic
-from metpy.units import units
-import metpy.calc as mpcalc
-from bresenham import bresenham
-import pickle
-import time
-import requests
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+from elevation import CachedElevation, OpenTopoDataElevation
+from metcalc import geodesic, wind_direction
 
 
 # city_fp = os.path.join(proj_dir, 'data/locations.txt')
@@ -25,61 +22,104 @@ altitude_fp = "/content/drive/MyDrive/smoke-signals/data/alt.pkl"
 # city_fp = "/home/jon/smoke-signals/data/raw/locations.txt"
 # altitude_fp = "/home/jon/smoke-signals/data/raw/alt.pkl"
 
+graph_cache_dir = os.path.join(os.path.dirname(altitude_fp), 'graph_cache')
+# bump when the graph construction changes, so old cache files are not loaded
+GRAPH_CACHE_VERSION = 2
+
 
 class Graph():
-    def __init__(self):
+    """
+    :Parameters:
+        elevation: any callable (lat, lon) -> altitude; by default alt.pkl with missing points fetched from opentopodata.
+        cache_dir: built graphs are saved there as graph_<key>.npz, the key hashing locations.txt, the
+            elevation source (with the content of alt.pkl) and the thresholds; None always builds. Providers without a cache_key are not cached.
+    """
+    def __init__(self, elevation=None, cache_dir=graph_cache_dir):
         self.dist_thres = 3
         self.alti_thres = 1200
         self.factor = 10
         self.use_altitude = True
+        # optional: connect every node to its knn nearest neighbours (within dist_thres), and keep at most
+        # max_degree incoming edges per node, the nearest ones
+        self.knn = None
+        self.max_degree = None
 
         self.count = set()
+        self.elevation = elevation if elevation is not None else CachedElevation(altitude_fp, OpenTopoDataElevation())
         self.alt_dict = self._load_altitude()
-        self.nodes = self._gen_nodes()
-        self.node_attr = self._add_node_attr()
-        self.node_num = len(self.nodes)
-        self.edge_index, self.edge_attr = self._gen_edges()
-        if self.use_altitude:
-            self._update_edges()
+        self.cache_fp = self._cache_fp(cache_dir)
+        if self.cache_fp is not None and os.path.isfile(self.cache_fp):
+            self._load_cache()
+        else:
+            self.nodes = self._gen_nodes()
+            self.node_attr = self._add_node_attr()
+            self.node_num = len(self.nodes)
+            self.edge_index, self.edge_attr = self._gen_edges()
+            if self.use_altitude:
+                self._update_edges()
+            if self.max_degree is not None:
+                self._cap_degree()
+            if self.cache_fp is not None:
+                # elevations fetched while building change the key of a caching provider, save under the new one
+                self.cache_fp = self._cache_fp(cache_dir)
+                self._save_cache()
         self.edge_num = self.edge_index.shape[1]
-        self.adj = to_dense_adj(torch.LongTensor(self.edge_index))[0]
+        # sparse (node_num, node_num) adjacency, adj[src, dest] = 1; edge_index is its COO form
+        self.adj = sparse.csr_matrix((np.ones(self.edge_num, dtype=np.float32), (self.edge_index[0], self.edge_index[1])),
+                                     shape=(self.node_num, self.node_num))
+
+    def _cache_fp(self, cache_dir):
+        source = getattr(self.elevation, 'cache_key', None)
+        if cache_dir is None or source is None:
+            return None
+        h = hashlib.sha1()
+        with open(city_fp, 'rb') as f:
+            h.update(f.read())
+        h.update(json.dumps({'version': GRAPH_CACHE_VERSION, 'elevation': source,
+                             'dist_thres': self.dist_thres, 'alti_thres': self.alti_thres,
+                             'factor': self.factor, 'use_altitude': self.use_altitude,
+                             'knn': self.knn, 'max_degree': self.max_degree}, sort_keys=True).encode())
+        return os.path.join(cache_dir, 'graph_%s.npz' % h.hexdigest()[:16])
+
+    def _save_cache(self):
+        idx = list(self.nodes)
+        os.makedirs(os.path.dirname(self.cache_fp), exist_ok=True)
+        tmp_fp = self.cache_fp + '.tmp'
+        with open(tmp_fp, 'wb') as f:
+            np.savez(f, idx=np.array(idx), city=np.array([self.nodes[i]['city'] for i in idx]),
+                     altitude=np.array([self.nodes[i]['altitude'] for i in idx], dtype=np.float64),
+                     lat=np.array([self.nodes[i]['lat'] for i in idx]), lon=np.array([self.nodes[i]['lon'] for i in idx]),
+                     node_attr=self.node_attr, edge_index=self.edge_index, edge_attr=self.edge_attr,
+                     count=np.array(sorted(self.count)).reshape(-1, 2))
+        os.replace(tmp_fp, self.cache_fp)
+
+    def _load_cache(self):
+        with np.load(self.cache_fp) as f:
+            self.nodes = OrderedDict()
+            for idx, city, alt, lat, lon in zip(f['idx'].tolist(), f['city'].tolist(), f['altitude'], f['lat'].tolist(), f['lon'].tolist()):
+                self.nodes.update({idx: {'city': city, 'altitude': alt, 'lon': lon, 'lat': lat}})
+            self.node_attr = f['node_attr']
+            self.node_num = len(self.nodes)
+            self.edge_index, self.edge_attr = f['edge_index'], f['edge_attr']
+            self.count = set(map(tuple, f['count'].tolist()))
 
     def _load_altitude(self):
-        assert os.path.isfile(altitude_fp)
-        with open(altitude_fp, 'rb') as f:
-            altitude = pickle.load(f)
-        return altitude
+        return getattr(self.elevation, 'cache', {})
 
     def _get_alt(self, latitude, longitude):
-        alt = np.full(len(latitude), 0.0)
-        for i in range(len(latitude)):
-            lat = latitude[i]/self.factor
-            lon = longitude[i]/self.factor
-            if((lat,lon) in self.alt_dict):
-                alt[i] = self.alt_dict[(lat,lon)]
-                continue
-            res = requests.get('https://api.opentopodata.org/v1/test-dataset?locations=' + str(lat)  + ',' + str(lon)).json()
-            x = res["results"][0]["elevation"]
-            alt[i] = (float)(x)
-            time.sleep(1.0)
-        return alt
+        return self.elevation(np.asarray(latitude)/self.factor, np.asarray(longitude)/self.factor)
 
     def _gen_nodes(self):
         nodes = OrderedDict()
+        lines = []
         with open(city_fp, 'r') as f:
             for line in f:
                 idx, city, lat, lon = line.rstrip('\n').split(' ')
-                idx = int(idx)
-                lon = np.full(1, int(float(lon)*self.factor))
-                lat = np.full(1, int(float(lat)*self.factor))
-                if((lat[0]/self.factor, lon[0]/self.factor) not in self.alt_dict.keys()):
-                    altitude = self._get_alt(lat, lon)
-                    altitude = altitude[0]
-                    self.alt_dict[(lat[0]/self.factor, lon[0]/self.factor)] = altitude
-                else:
-                    altitude = self.alt_dict[(lat[0]/self.factor, lon[0]/self.factor)]
-                self.count.add((lat[0]/self.factor, lon[0]/self.factor))
-                nodes.update({idx: {'city': city, 'altitude': altitude, 'lon': lon[0]/self.factor, 'lat': lat[0]/self.factor}})
+                lines.append((int(idx), city, int(float(lat)*self.factor), int(float(lon)*self.factor)))
+        altitude = self._get_alt(np.array([line[2] for line in lines]), np.array([line[3] for line in lines])) # one batched lookup
+        for (idx, city, lat, lon), alt in zip(lines, altitude):
+            self.count.add((lat/self.factor, lon/self.factor))
+            nodes.update({idx: {'city': city, 'altitude': alt, 'lon': lon/self.factor, 'lat': lat/self.factor}})
         return nodes
 
     def _add_node_attr(self):
@@ -117,78 +157,112 @@ class Graph():
         return lines
 
     def _gen_edges(self):
-        coords = []
-        lonlat = {}
-        for i in self.nodes:
-            coords.append([self.nodes[i]['lon'], self.nodes[i]['lat']])
-        dist = distance.cdist(coords, coords, 'euclidean')
-        adj = np.zeros((self.node_num, self.node_num), dtype=np.uint8)
-        adj[dist <= self.dist_thres] = 1
-        assert adj.shape == dist.shape
-        dist = dist * adj
-        edge_index, dist = dense_to_sparse(torch.tensor(dist))
-        edge_index, dist = edge_index.numpy(), dist.numpy()
-
-        direc_arr = []
-        dist_kilometer = []
-        for i in range(edge_index.shape[1]):
-            src, dest = edge_index[0, i], edge_index[1, i]
-            src_lat, src_lon = self.nodes[src]['lat'], self.nodes[src]['lon']
-            dest_lat, dest_lon = self.nodes[dest]['lat'], self.nodes[dest]['lon']
-            src_location = (src_lat, src_lon)
-            dest_location = (dest_lat, dest_lon)
-            dist_km = geodesic(src_location, dest_location).kilometers
-            v, u = src_lat - dest_lat, src_lon - dest_lon
-
-            u = u * units.meter / units.second
-            v = v * units.meter / units.second
-            direc = mpcalc.wind_direction(u, v)._magnitude
+        lat = np.array([self.nodes[i]['lat'] for i in range(self.node_num)])
+        lon = np.array([self.nodes[i]['lon'] for i in range(self.node_num)])
+        coords = np.stack([lon, lat], axis=-1)
+        tree = cKDTree(coords)
+        # both directions of every pair of nodes within dist_thres (euclidean, in degrees)
+        if self.knn is None:
+            pairs = tree.query_pairs(self.dist_thres, output_type='ndarray')
+        else:
+            upper = np.inf if self.dist_thres is None else self.dist_thres * (1 + 1e-12)
+            _, nbr = tree.query(coords, k=self.knn + 1, distance_upper_bound=upper)
+            node = np.repeat(np.arange(self.node_num), nbr.shape[1])
+            nbr = nbr.reshape(-1)
+            pairs = np.stack([node, nbr], axis=-1)[nbr < self.node_num]
+        pairs = pairs.astype(np.int64)
+        code = np.unique(np.concatenate([pairs[:, 0] * self.node_num + pairs[:, 1], pairs[:, 1] * self.node_num + pairs[:, 0]]))
+        src, dest = code // self.node_num, code % self.node_num
+        # coincident nodes get no edge, as zero entries of the old dense distance matrix
+        keep = (lon[src] != lon[dest]) | (lat[src] != lat[dest])
+        edge_index = np.stack([src[keep], dest[keep]])
 
-            direc_arr.append(direc)
-            dist_kilometer.append(dist_km)
-
-        direc_arr = np.stack(direc_arr)
-        dist_arr = np.stack(dist_kilometer)
+        src, dest = edge_index[0], edge_index[1]
+        dist_arr = geodesic(lat[src], lon[src], lat[dest], lon[dest])
+        direc_arr = wind_direction(lon[src] - lon[dest], lat[src] - lat[dest])
         attr = np.stack([dist_arr, direc_arr], axis=-1)
 
         return edge_index, attr
 
-    def _update_edges(self):
-        edge_index = []
-        edge_attr = []
+    def _cap_degree(self):
+        """ Keeps the max_degree nearest incoming edges of every node. """
+        dest, dist = self.edge_index[1], self.edge_attr[:, 0]
+        order = np.lexsort((dist, dest))
+        first = np.searchsorted(dest[order], dest[order])
+        rank = np.arange(len(order)) - first
+        keep = np.zeros(len(order), dtype=bool)
+        keep[order[rank < self.max_degree]] = True
+        self.edge_index = self.edge_index[:, keep]
+        self.edge_attr = self.edge_attr[keep]
 
-        for i in range(self.edge_index.shape[1]):
-            src, dest = self.edge_index[0, i], self.edge_index[1, i]
-            src_lat, src_lon =(int)(self.nodes[src]['lat']*self.factor),(int)(self.nodes[src]['lon']*self.factor)
-            dest_lat, dest_lon = (int)(self.nodes[dest]['lat']*self.factor), (int)(self.nodes[dest]['lon']*self.factor)
-            points = np.asarray(list(bresenham(src_lat, src_lon, dest_lat, dest_lon))).transpose((1,0))
+    def advection_weights(self, feature, wind_mean, wind_std, chunk=24*30):
+        """
+        Advection edge weights relu(3 * speed * cos(theta) / dist) of GraphGNN for
+        normalized features (..., nodes, channels) whose last two channels are the
+        wind speed and direction, in the float32 arithmetic of GraphGNN.forward.
+        Returns (..., edges), computed `chunk` entries of the first axis at a time.
+        """
+        src = self.edge_index[0]
+        city_dist = np.float32(self.edge_attr[:, 0])
+        city_direc = np.float32(self.edge_attr[:, 1])
+        wind_mean, wind_std = np.float32(wind_mean), np.float32(wind_std)
+        out = np.empty(feature.shape[:-2] + (len(src),), dtype=np.float32)
+        for a in range(0, len(feature), chunk):
+            src_wind = np.float32(feature[a:a + chunk][..., src, -2:]) * wind_std + wind_mean
+            theta = np.abs(city_direc - src_wind[..., 1])
+            out[a:a + chunk] = np.maximum(3 * src_wind[..., 0] * np.cos(theta) / city_dist, 0)
+        return out
+
+    def _update_edges(self):
+        src, dest = self.edge_index[0], self.edge_index[1]
+        lat = np.array([(int)(self.nodes[i]['lat']*self.factor) for i in range(self.node_num)])
+        lon = np.array([(int)(self.nodes[i]['lon']*self.factor) for i in range(self.node_num)])
+        # every candidate edge rasterized at once on the factor grid
+        line, points_lat, points_lon = bresenham_lines(lat[src], lon[src], lat[dest], lon[dest])
 
-            altitude_points = self._get_alt(points[0], points[1])
-            for j in range(len(points[0])):
-                self.count.add((points[0][j]/self.factor, points[1][j]/self.factor))
-                self.alt_dict[(points[0][j]/self.factor, points[1][j]/self.factor)] = altitude_points[j]
+        # dense altitude grid over the bounding box of the lines, looked up at the rasterized cells only
+        lat_min, lon_min = points_lat.min(), points_lon.min()
+        width = points_lon.max() - lon_min + 1
+        cell = (points_lat - lat_min) * width + (points_lon - lon_min)
+        cells = np.unique(cell)
+        cells_lat, cells_lon = cells // width + lat_min, cells % width + lon_min
+        grid = np.full((points_lat.max() - lat_min + 1) * width, np.nan)
+        grid[cells] = self._get_alt(cells_lat, cells_lon)
+        self.count.update(zip((cells_lat/self.factor).tolist(), (cells_lon/self.factor).tolist()))
 
-            altitude_src = self._get_alt(np.full(1, src_lat), np.full(1, src_lon))
-            self.alt_dict[(src_lat/self.factor, src_lon/self.factor)] = altitude_src[0]
-            self.count.add((src_lat/self.factor, src_lon/self.factor))
+        altitude_points = grid[cell]
+        altitude_src = grid[(lat[src] - lat_min) * width + (lon[src] - lon_min)][line]
+        altitude_dest = grid[(lat[dest] - lat_min) * width + (lon[dest] - lon_min)][line]
+        blocked_src = np.bincount(line, altitude_points - altitude_src > self.alti_thres, minlength=len(src))
+        blocked_dest = np.bincount(line, altitude_points - altitude_dest > self.alti_thres, minlength=len(src))
+        keep = (blocked_src < 3) & (blocked_dest < 3)
 
-            altitude_dest = self._get_alt(np.full(1, dest_lat), np.full(1, dest_lon))
-            self.alt_dict[(dest_lat/self.factor, dest_lon/self.factor)] = altitude_dest[0]
-            self.count.add((dest_lat/self.factor, dest_lon/self.factor))
+        self.edge_index = self.edge_index[:, keep]
+        self.edge_attr = self.edge_attr[keep]
 
-            if np.sum(altitude_points - altitude_src > self.alti_thres) < 3 and \
-               np.sum(altitude_points - altitude_dest > self.alti_thres) < 3:
-                edge_index.append(self.edge_index[:,i])
-                edge_attr.append(self.edge_attr[i])
 
-        #with open('data/alt.pkl', 'wb') as handle:
-            #pickle.dump(self.alt_dict, handle, protocol=pickle.HIGHEST_PROTOCOL)
+def bresenham_lines(x0, y0, x1, y1):
+    """
+    Bresenham rasterization of many integer lines at once, the same points as
+    bresenham.bresenham for every line. Along the major axis step x of a line
+    with major length m and minor length n lands on minor offset
+    (2 * n * x + m) // (2 * m).
+    Returns (line, x, y) flat arrays, the points of each line in order.
+    """
+    x0, y0, x1, y1 = (np.asarray(a, dtype=np.int64) for a in (x0, y0, x1, y1))
+    dx, dy = x1 - x0, y1 - y0
+    xsign, ysign = np.where(dx > 0, 1, -1), np.where(dy > 0, 1, -1)
+    dx, dy = np.abs(dx), np.abs(dy)
+    x_major = dx > dy
+    major, minor = np.maximum(dx, dy), np.minimum(dx, dy)
 
-        #with open('data/alt.pkl', 'rb') as handle:
-            #b = pickle.load(handle)
+    line = np.repeat(np.arange(len(x0)), major + 1)
+    step = np.arange(len(line)) - np.repeat(np.cumsum(major + 1) - (major + 1), major + 1)
+    offset = (2 * minor[line] * step + major[line]) // np.maximum(2 * major[line], 1)
+    x = x0[line] + xsign[line] * np.where(x_major[line], step, offset)
+    y = y0[line] + ysign[line] * np.where(x_major[line], offset, step)
+    return line, x, y
 
-        self.edge_index = np.stack(edge_index, axis=1)
-        self.edge_attr = np.stack(edge_attr, axis=0)
 
 if __name__ == '__main__':
    graph = Graph()
@@ -0,0 +1,106 @@
+"""
+Plain array versions of the metpy / geopy calculations used by the feature
+engineering. They take bare numpy arrays (or torch tensors) instead of pint
+quantities, broadcast over whole arrays, and return the same values as
+mpcalc.wind_speed, mpcalc.wind_direction and geopy.distance.geodesic.
+"""
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+WGS84_A_KM = 6378.137
+WGS84_F = 1 / 298.257223563
+
+
+def _is_tensor(x):
+    return type(x).__module__.split('.')[0] == 'torch'
+
+
+def wind_speed(u, v):
+    """ Wind speed with the units of the u and v components (mpcalc.wind_speed). """
+    if _is_tensor(u):
+        import torch
+        return torch.hypot(u, v)
+    return np.hypot(u, v)
+
+
+def wind_direction(u, v, convention='from'):
+    """
+    Wind direction in degrees (0, 360], 0 for calm winds, the direction the wind
+    blows from ('from') or towards ('to'), as mpcalc.wind_direction.
+    """
+    if convention not in ('from', 'to'):
+        raise ValueError('Invalid kwarg for "convention". Valid options are "from" or "to".')
+    if _is_tensor(u):
+        import torch
+        wdir = 90. - torch.rad2deg(torch.atan2(-v, -u))
+        if convention == 'to':
+            wdir = wdir - 180.
+        wdir = torch.where(wdir <= 0, wdir + 360., wdir)
+        return torch.where((u == 0) & (v == 0), torch.zeros_like(wdir), wdir)
+
+    u, v = np.asarray(u), np.asarray(v)
+    wdir = 90. - np.degrees(np.arctan2(-v, -u))
+    if convention == 'to':
+        wdir = wdir - 180.
+    wdir = np.where(wdir <= 0, wdir + 360., wdir)
+    return np.where((u == 0) & (v == 0), 0., wdir)
+
+
+def compass_bearing(lat1, lon1, lat2, lon2):
+    """
+    Initial compass bearing in degrees [0, 360) from point 1 to point 2, same
+    formula as calculate_initial_compass_bearing but over broadcastable arrays.
+    """
+    lat1, lat2 = np.radians(lat1), np.radians(lat2)
+    diff_lon = np.radians(np.asarray(lon2) - np.asarray(lon1))
+    x = np.sin(diff_lon) * np.cos(lat2)
+    y = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(diff_lon)
+    return (np.degrees(np.arctan2(x, y)) + 360) % 360
+
+
+def geodesic(lat1, lon1, lat2, lon2, iterations=20):
+    """
+    Distance in kilometers on the WGS-84 ellipsoid between broadcastable arrays
+    of points (Vincenty's inverse formula). Agrees with geopy.distance.distance
+    to well below a meter. Vincenty does not converge for nearly antipodal
+    points, those are handed to geographiclib, which geopy itself uses.
+    """
+    b = WGS84_A_KM * (1 - WGS84_F)
+    u1 = np.arctan((1 - WGS84_F) * np.tan(np.radians(lat1)))
+    u2 = np.arctan((1 - WGS84_F) * np.tan(np.radians(lat2)))
+    big_l = np.radians(np.asarray(lon2) - np.asarray(lon1))
+    sin_u1, cos_u1, sin_u2, cos_u2 = np.sin(u1), np.cos(u1), np.sin(u2), np.cos(u2)
+
+    lam = big_l
+    for _ in range(iterations):
+        sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+        sin_sigma = np.hypot(cos_u2 * sin_lam, cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam)
+        cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+        sigma = np.arctan2(sin_sigma, cos_sigma)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sin_alpha = np.where(sin_sigma == 0, 0.0, cos_u1 * cos_u2 * sin_lam / sin_sigma)
+            cos2_alpha = 1 - sin_alpha ** 2
+            cos_2sm = np.where(cos2_alpha == 0, 0.0, cos_sigma - 2 * sin_u1 * sin_u2 / cos2_alpha)
+        c = WGS84_F / 16 * cos2_alpha * (4 + WGS84_F * (4 - 3 * cos2_alpha))
+        lam_prev = lam
+        lam = big_l + (1 - c) * WGS84_F * sin_alpha * \
+            (sigma + c * sin_sigma * (cos_2sm + c * cos_sigma * (-1 + 2 * cos_2sm ** 2)))
+        converged = np.abs(lam - lam_prev) < 1e-12
+        if np.all(converged):
+            break
+
+    u_sq = cos2_alpha * (WGS84_A_KM ** 2 - b ** 2) / b ** 2
+    big_a = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+    big_b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+    delta_sigma = big_b * sin_sigma * (cos_2sm + big_b / 4 * (cos_sigma * (-1 + 2 * cos_2sm ** 2) -
+                  big_b / 6 * cos_2sm * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sm ** 2)))
+    dist = b * big_a * (sigma - delta_sigma)
+    if np.all(converged):
+        return dist
+
+    from geographiclib.geodesic import Geodesic
+    lat1, lon1, lat2, lon2, dist = np.broadcast_arrays(lat1, lon1, lat2, lon2, dist)
+    dist = np.array(dist, dtype=np.float64)
+    for i in map(tuple, np.argwhere(~np.broadcast_to(converged, dist.shape))):
+        dist[i] = Geodesic.WGS84.Inverse(float(lat1[i]), float(lon1[i]), float(lat2[i]), float(lon2[i]))['s12'] / 1000
+    return dist
@@ -31,7 +31,8 @@ class GraphGNN(nn.Module):
                                    Sigmoid(),
                                    )
 
-    def forward(self, x):
+    def forward(self, x, edge_weight=None):
+        # edge_weight: (batch, edges) advection weights precomputed by Graph.advection_weights, or None to compute them from x
         self.edge_index = self.edge_index.to(self.device)
         self.edge_attr = self.edge_attr.to(self.device)
         self.w = self.w.to(self.device)
@@ -41,15 +42,16 @@ class GraphGNN(nn.Module):
         node_src = x[:, edge_src]
         node_target = x[:, edge_target]
 
-        src_wind = node_src[:,:,-2:] * self.wind_std[None,None,:] + self.wind_mean[None,None,:]
-        src_wind_speed = src_wind[:, :, 0]
-        src_wind_direc = src_wind[:,:,1]
-        self.edge_attr_ = self.edge_attr[None, :, :].repeat(node_src.size(0), 1, 1)
-        city_dist = self.edge_attr_[:,:,0]
-        city_direc = self.edge_attr_[:,:,1]
+        if edge_weight is None:
+            src_wind = node_src[:,:,-2:] * self.wind_std[None,None,:] + self.wind_mean[None,None,:]
+            src_wind_speed = src_wind[:, :, 0]
+            src_wind_direc = src_wind[:,:,1]
+            self.edge_attr_ = self.edge_attr[None, :, :].repeat(node_src.size(0), 1, 1)
+            city_dist = self.edge_attr_[:,:,0]
+            city_direc = self.edge_attr_[:,:,1]
 
-        theta = torch.abs(city_direc - src_wind_direc)
-        edge_weight = torch.relu(3 * src_wind_speed * torch.cos(theta) / city_dist)
+            theta = torch.abs(city_direc - src_wind_direc)
+            edge_weight = torch.relu(3 * src_wind_speed * torch.cos(theta) / city_dist)
         edge_weight = edge_weight.to(self.device)
         edge_attr_norm = self.edge_attr_norm[None, :, :].repeat(node_src.size(0), 1, 1).to(self.device)
         out = torch.cat([node_src, node_target, edge_attr_norm, edge_weight[:,:,None]], dim=-1)
@@ -85,7 +87,8 @@ class PM25_GNN(nn.Module):
         self.gru_cell = GRUCell(self.in_dim + self.gnn_out, self.hid_dim)
         self.fc_out = nn.Linear(self.hid_dim, self.out_dim)
 
-    def forward(self, pm25_hist, feature):
+    def forward(self, pm25_hist, feature, edge_weight=None):
+        # edge_weight: optional (batch, hist_len + pred_len, edges) advection weights of the feature hours
         pm25_pred = []
         h0 = torch.zeros(self.batch_size * self.city_num, self.hid_dim).to(self.device)
         hn = h0
@@ -95,7 +98,7 @@ class PM25_GNN(nn.Module):
 
             xn_gnn = x
             xn_gnn = xn_gnn.contiguous()
-            xn_gnn = self.graph_gnn(xn_gnn)
+            xn_gnn = self.graph_gnn(xn_gnn, None if edge_weight is None else edge_weight[:, self.hist_len + i])
             x = torch.cat([xn_gnn, x], dim=-1)
 
             hn = self.gru_cell(x, hn)
@@ -0,0 +1,132 @@
+import os
+import sys
+proj_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(proj_dir)
+
+import numpy as np
+import yaml
+
+from scenario import Scenario
+from timeaxis import HourAxis
+from util import file_dir
+
+overlay_fp = os.path.join(proj_dir, 'overlays.yaml')
+
+
+class Overlay():
+    """
+    Hours [start, end) of the dataset replaced by rows of `source` starting at
+    `source_start`, for all channels or only `channels` (e.g. [-1] for PM2.5).
+    `source` is anything indexable by hour, typically a memory-mapped .npy.
+    """
+    def __init__(self, source, start, end, source_start=0, channels=None):
+        self.source = source
+        self.start = start
+        self.end = end
+        self.source_start = source_start
+        self.channels = slice(None) if channels is None else channels
+
+    def read(self, start, end):
+        """ Source rows for dataset hours [start, end), which must lie in the overlay. """
+        a = self.source_start + start - self.start
+        return np.asarray(self.source[a:a + end - start])[..., self.channels]
+
+
+class HourIndexed():
+    """
+    Numpy-style [hours, ...] indexing for classes that read hours [start, end)
+    as an ndarray with read(start, end) and have a shape: every index reads
+    only the hours it uses.
+    """
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        index = index if isinstance(index, tuple) else (index,)
+        hours, rest = index[0], index[1:]
+        if isinstance(hours, (int, np.integer)):
+            hours = hours + len(self) if hours < 0 else hours
+            return self.read(hours, hours + 1)[(0,) + rest]
+        if isinstance(hours, slice) and (hours.step is None or hours.step > 0):
+            start, stop, step = hours.indices(len(self))
+            return self.read(start, max(start, stop))[(slice(None, None, step),) + rest]
+        if hours is Ellipsis:
+            return self.read(0, len(self))[index]
+        # index arrays, masks and reversed slices: read each run of consecutive hours they use once
+        hours = np.arange(len(self))[hours]
+        if hours.size == 0:
+            return self.read(0, 0)[(hours,) + rest]
+        used, inverse = np.unique(hours, return_inverse=True)
+        runs = np.split(used, np.flatnonzero(np.diff(used) != 1) + 1)
+        rows = np.concatenate([self.read(int(run[0]), int(run[-1]) + 1) for run in runs])
+        return rows[(inverse.reshape(hours.shape),) + rest]
+
+    def __array__(self, dtype=None, copy=None):
+        out = self.read(0, len(self))
+        return out if dtype is None else out.astype(dtype)
+
+
+class OverlayDataset(HourIndexed):
+    """
+    A base dataset (hours, sites, channels) with an ordered list of Overlays
+    applied on read, so a simulation scenario is a few memory-mapped slabs
+    instead of a full copy of the cube. Indexing with [hours, ...] reads the
+    hours from the memory-mapped base, applies the overlays that intersect
+    them and returns an ndarray, as np.load of the composed file would;
+    materialize() writes the composed cube to disk.
+    """
+    def __init__(self, base, overlays=(), output=None):
+        self.base = np.load(base, mmap_mode='r') if isinstance(base, str) else base
+        self.overlays = list(overlays)
+        self.output = output
+        self.shape = self.base.shape
+        self.dtype = self.base.dtype
+        self.ndim = self.base.ndim
+
+    @classmethod
+    def from_yaml(cls, name, fp=overlay_fp):
+        """
+        Builds the named overlay spec of overlays.yaml. Times are
+        'YYYY-MM-DD HH:MM' labels of dataset hours, paths are relative to the pm25gnn directory and a null base
+        is the knowair_fp of the config.
+        """
+        with open(fp) as f:
+            spec = yaml.load(f, Loader=yaml.FullLoader)[name]
+        axis = HourAxis.from_config()
+        index = lambda label: int(axis.index(label))
+        base = np.load(os.path.join(proj_dir, spec['base']) if spec.get('base') else file_dir['knowair_fp'], mmap_mode='r')
+
+        overlays = []
+        for entry in spec.get('overlays', []):
+            if 'scenario' in entry:
+                # slab written by scenario.py, pasted at the start of the scenario target
+                scenario = Scenario.from_yaml(entry['scenario'])
+                source = np.load(scenario.output, mmap_mode='r')
+                start = index(scenario.target[0])
+                overlays.append(Overlay(source, start, start + source.shape[0], channels=entry.get('channels')))
+                continue
+            source = base if entry['source'] == 'base' else np.load(os.path.join(proj_dir, entry['source']), mmap_mode='r')
+            start, end = index(entry['start']), index(entry['end'])
+            source_start = index(entry['source_start']) if 'source_start' in entry else 0
+            overlays.append(Overlay(source, start, end, source_start, entry.get('channels')))
+        return cls(base, overlays, os.path.join(proj_dir, spec['output']) if spec.get('output') else None)
+
+    def read(self, start, end):
+        """ Hours [start, end) with the overlays applied, as an ndarray. """
+        out = np.array(self.base[start:end])
+        for overlay in self.overlays:
+            a, b = max(start, overlay.start), min(end, overlay.end)
+            if a < b:
+                out[a - start:b - start, ..., overlay.channels] = overlay.read(a, b)
+        return out
+
+    def materialize(self, fp=None, chunk_hours=24*30):
+        """ Writes the composed dataset to fp (.npy, the spec output by default) chunk by chunk. """
+        fp = fp if fp else self.output
+        out = np.lib.format.open_memmap(fp, mode='w+', dtype=self.dtype, shape=self.shape)
+        for a in range(0, len(self), chunk_hours):
+            b = min(a + chunk_hours, len(self))
+            out[a:b] = self.read(a, b)
+        out.flush()
+        return fp
+
@@ -0,0 +1,126 @@
+import os
+import sys
+proj_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(proj_dir)
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+class WindowSampler(Sampler):
+    """
+    Samples the windows (dataset indices) offset, offset + stride, ... of a
+    dataset of n windows, restricted to the windows where the boolean
+    `eligible` mask is True, in order or reshuffled every epoch. Ineligible
+    windows are never loaded.
+    """
+    def __init__(self, n, stride=1, offset=0, eligible=None, shuffle=False, generator=None):
+        self.index = np.arange(offset, n, stride)
+        if eligible is not None:
+            self.index = self.index[np.asarray(eligible, dtype=bool)[self.index]]
+        self.shuffle = shuffle
+        self.generator = generator
+
+    def __iter__(self):
+        if not self.shuffle:
+            return iter(self.index.tolist())
+        order = torch.randperm(len(self.index), generator=self.generator).numpy()
+        return iter(self.index[order].tolist())
+
+    def __len__(self):
+        return len(self.index)
+
+
+class WeightedWindowSampler(WindowSampler):
+    """
+    Draws num_samples windows per epoch (by default as many as there are
+    eligible windows) among the strided eligible windows, with probability
+    proportional to the per-window `weights`.
+    """
+    def __init__(self, n, weights, num_samples=None, replacement=True, stride=1, offset=0, eligible=None, generator=None):
+        super(WeightedWindowSampler, self).__init__(n, stride, offset, eligible, generator=generator)
+        self.weights = torch.as_tensor(np.asarray(weights, dtype=np.float64)[self.index])
+        self.num_samples = len(self.index) if num_samples is None else num_samples
+        self.replacement = replacement
+
+    def __iter__(self):
+        draw = torch.multinomial(self.weights, self.num_samples, self.replacement, generator=self.generator)
+        return iter(self.index[draw.numpy()].tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+
+def season_weights(times, months, weight):
+    """ `weight` for the windows whose (UTC timestamp) time falls in one of `months`, 1 for the others. """
+    month = np.asarray(times).astype('datetime64[s]').astype('datetime64[M]').astype(np.int64) % 12 + 1
+    return np.where(np.isin(month, months), float(weight), 1.0)
+
+
+def window_sampler(dataset, sampler_conf, shuffle=True):
+    """
+    Training sampler of a dataset.py HazeData from the `sampler` section of the
+    config:
+        stride: keep every stride-th window
+        frp_thresh: windows where dataset.frp500, the data.frp_col channel
+            (frp_100km_idw by default), exceeds it at any site and hour are
+            never sampled (null keeps them)
+        season_months, season_weight: windows ending in season_months are
+            drawn season_weight times as often
+    """
+    sampler_conf = sampler_conf or {}
+    eligible = None
+    if sampler_conf.get('frp_thresh') is not None:
+        eligible = ~dataset.window_any((dataset.frp500 > sampler_conf['frp_thresh']).reshape(len(dataset.frp500), -1).any(axis=1))
+    stride = sampler_conf.get('stride', 1)
+    if sampler_conf.get('season_weight', 1) != 1:
+        weights = season_weights(dataset.time_arr, sampler_conf.get('season_months', []), sampler_conf['season_weight'])
+        return WeightedWindowSampler(len(dataset), weights, stride=stride, eligible=eligible)
+    return WindowSampler(len(dataset), stride, eligible=eligible, shuffle=shuffle)
+
+
+class EndIndexBatchSampler(Sampler):
+    """
+    Groups the dataset indices drawn from `sampler` into batches of batch_size
+    and yields each batch as an int64 array of end indices, the index + offset
+    of the last hour of every window in the dataset's _full arrays.
+    """
+    def __init__(self, sampler, batch_size, drop_last=False, offset=0):
+        self.sampler = sampler
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.offset = offset
+
+    def __iter__(self):
+        batch = []
+        for index in self.sampler:
+            batch.append(index)
+            if len(batch) == self.batch_size:
+                yield np.asarray(batch, dtype=np.int64) + self.offset
+                batch = []
+        if batch and not self.drop_last:
+            yield np.asarray(batch, dtype=np.int64) + self.offset
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.sampler) // self.batch_size
+        return (len(self.sampler) + self.batch_size - 1) // self.batch_size
+
+
+class WindowBatches():
+    """
+    The batches of a dataset.py HazeData for the windows drawn from `sampler`
+    (any iterable of dataset indices), each gathered by HazeData.gather in one
+    indexing operation per array instead of collated item by item.
+    """
+    def __init__(self, dataset, sampler, batch_size, drop_last=False):
+        self.dataset = dataset
+        self.batch_sampler = EndIndexBatchSampler(sampler, batch_size, drop_last, offset=dataset.hist_len + dataset.pred_len)
+
+    def __iter__(self):
+        for end in self.batch_sampler:
+            yield self.dataset.gather(end)
+
+    def __len__(self):
+        return len(self.batch_sampler)
@@ -0,0 +1,295 @@
+import os
+import sys
+proj_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(proj_dir)
+
+import argparse
+import numpy as np
+import pandas as pd
+import pickle
+import yaml
+from tqdm import tqdm
+
+from fire_catalog import FireCatalog
+from frp import FRP_CHANNELS, ContributionStore, GeometryCache, WindGrid, fire_digest, frp_influence_pairs, map_shards
+from timeaxis import HourAxis
+
+wind_u_fp = os.path.join(proj_dir, 'data/wind_u_10_grid.npy')
+wind_v_fp = os.path.join(proj_dir, 'data/wind_v_10_grid.npy')
+lat_wind_fp = os.path.join(proj_dir,'data/lat_wind.npy')
+lon_wind_fp = os.path.join(proj_dir,'data/lon_wind.npy')
+
+location_fp = os.path.join(proj_dir, 'data/latlon.csv')
+dataset_fp = os.path.join(proj_dir, 'data/dataset_fire_wind_aligned.npy')
+alldates_fp = os.path.join(proj_dir, 'data/alltimes_pst.npy')
+grid_dict_lat_fp = os.path.join(proj_dir, 'data/dict_wind_grid_lat.pkl')
+grid_dict_lon_fp = os.path.join(proj_dir, 'data/dict_wind_grid_lon.pkl')
+geometry_cache_dir = os.path.join(proj_dir, 'data/geometry_cache')
+frp_contrib_dir = os.path.join(proj_dir, 'data/frp_contrib')
+scenario_fp = os.path.join(proj_dir, 'scenarios.yaml')
+
+
+class Scenario():
+    """
+    A prescribed-fire counterfactual: which fires are added to or removed from
+    the FRP channels of which dataset hours. See scenarios.yaml for the fields.
+    """
+    def __init__(self, name,
+                       sign=1,
+                       scale=1,
+                       center=None,
+                       radius_km=None,
+                       date_mapping='same_day',
+                       source=None,
+                       target=None,
+                       output=None,
+                       utc_offset_hours=7,
+                       ):
+        if date_mapping not in ('same_day', 'month_day'):
+            raise Exception('Wrong date_mapping: %s' % date_mapping)
+        self.name = name
+        self.sign = sign
+        self.scale = scale
+        self.center = center
+        self.radius_km = radius_km
+        self.date_mapping = date_mapping
+        self.source = source
+        self.target = target
+        self.output = os.path.join(proj_dir, output if output else 'data/dataset_%s.npy' % name)
+        self.utc_offset_hours = utc_offset_hours # fire catalog days are UTC, dataset hours are PST
+
+    @classmethod
+    def from_yaml(cls, name, fp=scenario_fp):
+        with open(fp) as f:
+            scenarios = yaml.load(f, Loader=yaml.FullLoader)
+        return cls(name, **scenarios[name])
+
+    def day_key(self, day):
+        """ Key matching a fire day (YYYY-MM-DD) to the simulated days it is used on. """
+        return day[0:10] if self.date_mapping == 'same_day' else day[5:10]
+
+
+class ScenarioEngine():
+    """
+    Rewrites the FRP channels of a slab of the dataset for a Scenario.
+
+    The dataset and wind grids are memory-mapped and the slab is streamed to
+    the output one fire day at a time, so only the hours a scenario touches
+    are read and written.
+    """
+    def __init__(self):
+        self.wu, self.wv = np.load(wind_u_fp, mmap_mode='r'), np.load(wind_v_fp, mmap_mode='r')
+        self.axis = HourAxis.from_config() # dataset hours, the time_dict.pkl indices
+        self.catalog = FireCatalog.open()
+        self.alldates = np.load(alldates_fp)
+        self.alldates_index = self.axis.index(self.alldates) # dataset hour of every alldates label
+        self.dataset = np.load(dataset_fp, mmap_mode='r')
+
+        grid_dict_lat = pickle.load( open(grid_dict_lat_fp, "rb" ) )
+        grid_dict_lon = pickle.load( open(grid_dict_lon_fp, "rb" ) )
+        self.wind_grid = WindGrid(np.load(lat_wind_fp), np.load(lon_wind_fp), grid_dict_lat, grid_dict_lon)
+
+        self.siteloc = np.asarray( pd.read_csv(location_fp).drop("Unnamed: 0", axis=1) )
+        self.geometry = GeometryCache(geometry_cache_dir, self.siteloc[0], self.siteloc[1])
+
+    def _target_hours(self, scenario):
+        start = int(self.axis.index(scenario.target[0]))
+        if scenario.target[1] is None:
+            end = self.dataset.shape[0] - scenario.utc_offset_hours
+        else:
+            end = int(self.axis.index(scenario.target[1]))
+        return start, end
+
+    def _fires(self, scenario, keys):
+        """
+        (lat, lon, frp) arrays of the fires every simulated day key draws from,
+        before the center filter, so scenarios that only differ in their center
+        and radius share them.
+        """
+        catalog = self.catalog if scenario.source is None else self.catalog.between(*scenario.source)
+        fires = {}
+        for day in catalog.day_strings():
+            if scenario.day_key(day) in keys:
+                fires.setdefault(scenario.day_key(day), []).append(catalog.fires(day))
+        fires = {key: tuple(np.concatenate(col) for col in zip(*arrs)) for key, arrs in fires.items()}
+        if fires:
+            # one batched lookup so the cache is written at most once
+            self.geometry.rows(np.concatenate([f[0] for f in fires.values()]), np.concatenate([f[1] for f in fires.values()]))
+        return fires
+
+    def _center_mask(self, scenario, latf, lonf):
+        """ Which of the fires are used by the scenario. """
+        if scenario.center is None:
+            return np.ones(len(latf), dtype=bool)
+        rows = self.geometry.rows(latf, lonf)
+        return self.geometry.center_distance(rows, scenario.center[0], scenario.center[1]) <= scenario.radius_km
+
+    def _hours_by_key(self, scenario, start, end):
+        """ Simulated hours grouped by the fire day key they draw from. """
+        hours_by_key = {}
+        for i in range(start, end):
+            hours_by_key.setdefault(scenario.day_key(self.alldates[i + scenario.utc_offset_hours]), []).append(i)
+        return hours_by_key
+
+    def _digest(self, scenario, fires, hours):
+        latf, lonf, frp = fires
+        return fire_digest(latf, lonf, frp, [scenario.sign, scenario.scale], hours)
+
+    def _patch_shard(self, shard, job):
+        group, start, keys, hours_by_key, fires, masks, todo = job
+        stores = [ContributionStore(os.path.join(frp_contrib_dir, scenario.name)) for scenario in group]
+        outs = [np.load(scenario.output, mmap_mode='r+') for scenario in group]
+        for key in tqdm(keys, desc='shard %d' % shard, position=shard, leave=False):
+            needed = [m for m in range(len(group)) if key in todo[m]]
+            for m in needed:
+                old = stores[m].load(key)
+                if old is not None:
+                    outs[m][old[0] - start, :, FRP_CHANNELS] -= old[1]
+            live = [m for m in needed if key in fires and masks[key][m].any()]
+            for m in needed:
+                if m not in live:
+                    stores[m].remove(key)
+            if not live:
+                continue
+
+            # geometry and wind of the day's fires are shared by the whole group
+            latf, lonf, frp = fires[key]
+            hours = hours_by_key[key]
+            fire_idx, site_idx, dist, bearing = self.geometry.pairs(latf, lonf) # only the fire-site pairs within 500KM
+
+            timeind = self.alldates_index[hours] # wind values collected at actual time, not simulated
+            latind, lonind = self.wind_grid.index(latf, lonf)
+            firewindu = self.wind_grid.gather(self.wu, timeind, latind, lonind)
+            firewindv = self.wind_grid.gather(self.wv, timeind, latind, lonind)
+
+            # one kernel pass per distinct fire subset, scenarios differing only in sign/scale share it
+            subsets, which = np.unique(masks[key][live], axis=0, return_inverse=True)
+            influence = frp_influence_pairs(frp, fire_idx, site_idx, dist, bearing, firewindu, firewindv,
+                                            len(self.siteloc[0]), fire_masks=subsets)
+            for j, m in enumerate(live):
+                scenario = group[m]
+                contrib = influence[np.ravel(which)[j]].copy()
+                contrib[..., :-1] *= scenario.sign * scenario.scale # FRP 25/50/100/500KM
+                contrib[..., -1] *= scenario.sign # Number of fires within 500KM
+                outs[m][np.asarray(hours) - start, :, FRP_CHANNELS] += contrib
+                mask = masks[key][m]
+                stores[m].save(key, self._digest(scenario, (latf[mask], lonf[mask], frp[mask]), hours), hours, contrib)
+        for out in outs:
+            out.flush()
+
+    def _synthesize(self, scenarios, workers=1, changed_only=False):
+        """
+        Adds the FRP of every scenario to its output. Scenarios with the same
+        date mapping, source and target are computed together: the fire days,
+        geometry and wind gathers are shared and every scenario is a mask over
+        the fires of the group.
+        """
+        groups = {}
+        for scenario in scenarios:
+            group_key = (scenario.date_mapping, tuple(scenario.source or ()), tuple(scenario.target), scenario.utc_offset_hours)
+            groups.setdefault(group_key, []).append(scenario)
+
+        jobs = []
+        for group in groups.values():
+            start, end = self._target_hours(group[0])
+            hours_by_key = self._hours_by_key(group[0], start, end)
+            fires, masks = {}, {}
+            for key, (latf, lonf, frp) in self._fires(group[0], hours_by_key.keys()).items():
+                mask = np.stack([self._center_mask(scenario, latf, lonf) for scenario in group])
+                used = mask.any(axis=0)
+                if used.any():
+                    fires[key], masks[key] = (latf[used], lonf[used], frp[used]), mask[:, used]
+
+            # fire days each scenario has to (re)compute
+            todo = []
+            for m, scenario in enumerate(group):
+                digests = {}
+                for key, (latf, lonf, frp) in fires.items():
+                    mask = masks[key][m]
+                    if mask.any():
+                        digests[key] = self._digest(scenario, (latf[mask], lonf[mask], frp[mask]), hours_by_key[key])
+                if changed_only:
+                    store = ContributionStore(os.path.join(frp_contrib_dir, scenario.name))
+                    keys = {key for key in hours_by_key if store.digest(key) != digests.get(key)}
+                    keys |= {key for key in store.keys() if key not in hours_by_key}
+                    print('%s: %d of %d fire days changed' % (scenario.name, len(keys), len(hours_by_key)))
+                else:
+                    keys = set(digests)
+                todo.append(keys)
+
+            keys = sorted(set().union(*todo))
+            for k in range(max(1, workers)):
+                shard = keys[k::max(1, workers)]
+                if shard:
+                    jobs.append((group, start, shard, {key: hours_by_key[key] for key in shard if key in fires},
+                                 {key: fires[key] for key in shard if key in fires},
+                                 {key: masks[key] for key in shard if key in masks},
+                                 [keys_m & set(shard) for keys_m in todo]))
+        map_shards(self._patch_shard, jobs, workers)
+
+    def run(self, scenarios, workers=1, chunk_hours=24*30):
+        """
+        Writes the slab of each scenario (a Scenario or a list of them) to its
+        scenario.output and returns the output path(s). With workers > 1 the
+        fire days are sharded across a process pool, each shard writing its
+        own hours of the output memmaps. The contribution of every fire day is
+        kept in a ContributionStore for update().
+        """
+        batch = [scenarios] if isinstance(scenarios, Scenario) else list(scenarios)
+        for scenario in batch:
+            start, end = self._target_hours(scenario)
+            out = np.lib.format.open_memmap(scenario.output, mode='w+', dtype=self.dataset.dtype,
+                                            shape=(end - start,) + self.dataset.shape[1:])
+            for a in range(start, end, chunk_hours):
+                b = min(a + chunk_hours, end)
+                out[a - start:b - start] = self.dataset[a:b]
+            out.flush()
+            del out
+
+            store = ContributionStore(os.path.join(frp_contrib_dir, scenario.name))
+            store.clear()
+            store.set_slab(start, end)
+        self._synthesize(batch, workers)
+        return scenarios.output if isinstance(scenarios, Scenario) else [scenario.output for scenario in batch]
+
+    def update(self, scenarios, workers=1):
+        """
+        Brings the output of each scenario up to date with the current fire
+        catalog, recomputing only the fire days whose fires changed since the
+        last run or update. Scenarios without an output for the same slab yet
+        are run in full.
+        """
+        batch = [scenarios] if isinstance(scenarios, Scenario) else list(scenarios)
+        fresh, stale = [], []
+        for scenario in batch:
+            store = ContributionStore(os.path.join(frp_contrib_dir, scenario.name))
+            if os.path.isfile(scenario.output) and store.slab() == self._target_hours(scenario):
+                stale.append(scenario)
+            else:
+                fresh.append(scenario)
+        if fresh:
+            self.run(fresh, workers)
+        if stale:
+            self._synthesize(stale, workers, changed_only=True)
+        return scenarios.output if isinstance(scenarios, Scenario) else [scenario.output for scenario in batch]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rewrite the FRP channels of the dataset for the given scenarios, '
+                                                 'computing scenarios with the same dates together.')
+    parser.add_argument('scenarios', nargs='+', help='scenario names from scenarios.yaml')
+    parser.add_argument('--workers', type=int, default=1, help='processes to shard the fire days across')
+    parser.add_argument('--update', action='store_true', help='only recompute the fire days that changed since the last run')
+    args = parser.parse_args()
+
+    engine = ScenarioEngine()
+    scenarios = [Scenario.from_yaml(name) for name in args.scenarios]
+    if args.update:
+        outputs = engine.update(scenarios, workers=args.workers)
+    else:
+        outputs = engine.run(scenarios, workers=args.workers)
+    for output in outputs:
+        print(output)
+
+if __name__ == '__main__':
+    main()
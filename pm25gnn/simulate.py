@@ -4,8 +4,10 @@ proj_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(proj_dir)
 from util import config, file_dir
 from graph import Graph
+from dataset import find_norm_stats
 from dataset_exp1 import HazeData # for Experiment 1
 # from dataset import HazeData # for Experiment 2
+# from sampler import WindowBatches # for Experiment 2
 
 from model.MLP import MLP
 from model.LSTM import LSTM
@@ -15,7 +17,7 @@ from model.nodesFC_GRU import nodesFC_GRU
 from model.PM25_GNN import PM25_GNN
 from model.PM25_GNN_nosub import PM25_GNN_nosub
 
-import arrow
+from datetime import datetime
 import torch
 from torch import nn
 from tqdm import tqdm
@@ -24,6 +26,7 @@ import pickle
 import glob
 import shutil
 import numpy as np
+import warnings
 
 torch.set_num_threads(1)
 use_cuda = torch.cuda.is_available()
@@ -45,13 +48,30 @@ dataset_num = config['experiments']['dataset_num']
 exp_model = config['experiments']['model']
 exp_repeat = config['train']['exp_repeat']
 save_npy = config['experiments']['save_npy']
+storage_dtype = config['train'].get('storage_dtype', 'float32') # of the saved predictions and labels
+model_fp = file_dir.get('model_fp', 'model.pth')
 criterion = nn.MSELoss()
 
 test_data = HazeData(graph, hist_len, pred_len, dataset_num, flag='Test')
 
 in_dim = test_data.feature.shape[-1] + test_data.pm25.shape[-1]
-wind_mean_fp, wind_std_fp = os.path.join(proj_dir, 'data/train_wind_mean.npy'), os.path.join(proj_dir, 'data/train_wind_std.npy')
-wind_mean, wind_std = np.load(wind_mean_fp), np.load(wind_std_fp) 
+
+
+def train_wind_stats():
+    """
+    The wind statistics the model was trained with (see dataset.find_norm_stats),
+    the npy files of runs from before norm_stats.npz if there are none.
+    """
+    train_stats = find_norm_stats(graph, 'Train', dataset_num, model_fp)
+    if train_stats is not None:
+        return train_stats.wind_mean, train_stats.wind_std
+    wind_mean_fp, wind_std_fp = os.path.join(proj_dir, 'data/train_wind_mean.npy'), os.path.join(proj_dir, 'data/train_wind_std.npy')
+    warnings.warn('No Train normalization statistics next to %s or for the data of this config, '
+                  'using %s and %s' % (model_fp, wind_mean_fp, wind_std_fp))
+    return np.load(wind_mean_fp), np.load(wind_std_fp)
+
+
+wind_mean, wind_std = train_wind_stats()
 pm25_mean, pm25_std = test_data.pm25_mean, test_data.pm25_std 
 feature_mean, feature_std = test_data.feature_mean, test_data.feature_std 
 
@@ -94,41 +114,13 @@ def get_model():
         raise Exception('Wrong model name!')
 
 
-def prepare(pm25, feature, time_arr, flag):
-    pm25_hist = np.full((pm25.shape[0], hist_len, pm25.shape[1], pm25.shape[2]), -1.0, dtype=np.float)#double)
-    pm25_label = np.full((pm25.shape[0], pred_len, pm25.shape[1], pm25.shape[2]), -1.0, dtype=np.float)#double)
-    feature = np.full((feature.shape[0], hist_len+pred_len, feature.shape[1], feature.shape[2]), -1.0, dtype=np.float)#double)
-    pm = np.full((pm25.shape[0], hist_len+pred_len, pm25.shape[1], pm25.shape[2]), -1.0, dtype=np.float)#double)
-
-    for i in range(np.asarray(time_arr).shape[0]):
-        if flag == "Train":
-            end = train_data.time_index[np.asarray(time_arr)[i]]
-            pm25_hist[i,:,:,:] = train_data.pm25_full[end-seq_len+1:end-pred_len+1, :, :]
-            pm25_label[i,:,:,:] = train_data.pm25_full[end-pred_len+1:end+1, :, :]
-            feature[i,:,:,:] = train_data.feature_full[end-seq_len+1:end+1, :, :]
-            pm[i,:,:,:] = train_data.pm25_full[end-seq_len+1:end+1, :, :]
-        elif flag == "Val":
-            end = val_data.time_index[np.asarray(time_arr)[i]]
-            pm25_hist[i,:,:,:] = val_data.pm25_full[end-seq_len+1:end-pred_len+1, :, :]
-            pm25_label[i,:,:,:] = val_data.pm25_full[end-pred_len+1:end+1, :, :]
-            feature[i,:,:,:] = val_data.feature_full[end-seq_len+1:end+1, :, :]
-            pm[i,:,:,:] = val_data.pm25_full[end-seq_len+1:end+1, :, :]
-        else:
-            end = test_data.time_index[np.asarray(time_arr)[i]]
-            pm25_hist[i,:,:,:] = test_data.pm25_full[end-seq_len+1:end-pred_len+1, :, :]
-            pm25_label[i,:,:,:] = test_data.pm25_full[end-pred_len+1:end+1, :, :]
-            feature[i,:,:,:] = test_data.feature_full[end-seq_len+1:end+1, :, :]
-            pm[i,:,:,:] = test_data.pm25_full[end-seq_len+1:end+1, :, :]
-
-    return torch.tensor(pm25_hist, dtype=torch.float), torch.tensor(pm25_label, dtype=torch.float), torch.tensor(feature, dtype=torch.float), pm
-
 def test_data_saving(test_loader, model):
     model.eval()
     predict_list, label_list, time_list = [], [], []
     test_loss = 0
     for batch_idx, data in enumerate(test_loader):
-        pm25, feature, time_arr = data
-        pm25_hist, pm25_label, feature, pm25 = prepare(pm25, feature, time_arr, "Test")
+        # batches of dataset.HazeData.gather, see main()
+        pm25_hist, pm25_label, feature, pm25, _, _, time_arr = data
         feature = feature.to(device)
         pm25_hist = pm25_hist.to(device)
         pm25_label = pm25_label.to(device)
@@ -138,7 +130,7 @@ def test_data_saving(test_loader, model):
         test_loss += loss.item()
 
         pm25_pred = np.concatenate([pm25_hist.cpu().detach().numpy(), pm25_pred.cpu().detach().numpy()], axis=1) * pm25_std + pm25_mean
-        pm25_label = pm25 * pm25_std + pm25_mean
+        pm25_label = pm25.numpy() * pm25_std + pm25_mean
         predict_list.append(pm25_pred)
         label_list.append(pm25_label)
         time_list.append(time_arr.cpu().detach().numpy())
@@ -190,7 +182,7 @@ def get_mean_std(data_list):
 
 def main():
     model = PM25_GNN(hist_len, pred_len, in_dim, city_num, batch_size, device, graph.edge_index, graph.edge_attr, wind_mean, wind_std).cuda()
-    model.load_state_dict(torch.load("model.pth", map_location=device))
+    model.load_state_dict(torch.load(model_fp, map_location=device))
     model.eval()
     print(model.eval())
     test_loader = torch.utils.data.DataLoader(test_data, batch_size=batch_size, shuffle=False, drop_last=True, num_workers = 0)
@@ -199,13 +191,13 @@ def main():
     test_loss, predict_epoch, label_epoch, time_epoch = test(test_loader, model) 
     
     # Run this line for Experiment 2
-    #test_loss, predict_epoch, label_epoch, time_epoch = test_data_saving(test_loader, model) 
+    #test_loss, predict_epoch, label_epoch, time_epoch = test_data_saving(WindowBatches(test_data, range(len(test_data)), batch_size, drop_last=True), model) 
     
-    exp_model_dir = os.path.join("simulate_results", str(arrow.now().format('YYYYMMDDHHmmss')))
+    exp_model_dir = os.path.join("simulate_results", str(datetime.now().strftime('%Y%m%d%H%M%S')))
     if not os.path.exists(exp_model_dir):
         os.makedirs(exp_model_dir)
-    np.save(os.path.join(exp_model_dir, 'predict.npy'), predict_epoch)
-    np.save(os.path.join(exp_model_dir, 'label.npy'), label_epoch)
+    np.save(os.path.join(exp_model_dir, 'predict.npy'), predict_epoch.astype(storage_dtype))
+    np.save(os.path.join(exp_model_dir, 'label.npy'), label_epoch.astype(storage_dtype))
     np.save(os.path.join(exp_model_dir, 'time.npy'), time_epoch)
     print(exp_model_dir)
 
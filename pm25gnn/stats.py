@@ -0,0 +1,150 @@
+import os
+import sys
+proj_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(proj_dir)
+
+import numpy as np
+
+from util import config
+
+# bump when what is saved changes, artifacts of other versions are ignored
+STATS_VERSION = 2
+norm_stats_fp = os.path.join(proj_dir, 'data/norm_stats.npz')
+
+
+def model_stats_fp(model_fp):
+    """ norm_stats.npz next to a model, where train.py saves the statistics it was trained and tested with. """
+    return os.path.join(os.path.dirname(os.path.abspath(model_fp)), 'norm_stats.npz')
+
+
+class RunningStats():
+    """
+    Streaming mean and variance per site and channel of (hours, sites, channels)
+    chunks: each chunk's moments are merged into the running ones with Chan et
+    al.'s parallel update, in float64, so the data is read once, a chunk at a
+    time. pooled() merges the sites into per-channel statistics.
+    """
+    def __init__(self, count=0, mean=0.0, m2=0.0):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+
+    def update(self, chunk):
+        chunk = np.asarray(chunk, dtype=np.float64)
+        if len(chunk) == 0:
+            return self
+        mean = chunk.mean(axis=0)
+        return self.merge(len(chunk), mean, np.square(chunk - mean).sum(axis=0))
+
+    def merge(self, count, mean, m2):
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * count / total
+        self.m2 = self.m2 + m2 + np.square(delta) * self.count * count / total
+        self.count = total
+        return self
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / self.count)
+
+    def pooled(self):
+        """ (mean, std) per channel over all hours and sites. """
+        mean = self.mean.mean(axis=0)
+        m2 = self.m2.sum(axis=0) + self.count * np.square(self.mean - mean).sum(axis=0)
+        return mean, np.sqrt(m2 / (self.count * len(self.mean)))
+
+
+class NormStats():
+    """
+    Normalization statistics of a dataset split: mean and std of every feature
+    and of PM2.5, over the split and per site. wind_mean/std are those of the
+    u/v_component_of_wind+950 features, which the PM25_GNN models are given.
+    Splits are saved side by side in one versioned artifact, norm_stats.npz,
+    under the key of the data and hours they were computed from
+    (dataset.norm_stats_key), so runs with other configs or data keep theirs.
+    """
+    def __init__(self, feature, pm25, key=''):
+        self.feature = feature
+        self.pm25 = pm25
+        self.key = key
+        feature_mean, feature_std = feature.pooled()
+        pm25_mean, pm25_std = pm25.pooled()
+        self.feature_mean, self.feature_std = np.float32(feature_mean), np.float32(feature_std)
+        self.pm25_mean, self.pm25_std = np.float32(pm25_mean[0]), np.float32(pm25_std[0])
+        self.feature_site_mean, self.feature_site_std = np.float32(feature.mean), np.float32(feature.std)
+        self.pm25_site_mean, self.pm25_site_std = np.float32(pm25.mean[:, 0]), np.float32(pm25.std[:, 0])
+        metero_use = config['experiments']['metero_use']
+        self.wind_idx = [metero_use.index('u_component_of_wind+950'), metero_use.index('v_component_of_wind+950')]
+        self.wind_mean = self.feature_mean[self.wind_idx]
+        self.wind_std = self.feature_std[self.wind_idx]
+
+    @classmethod
+    def compute(cls, read, hours, chunk_hours=24*30, key=''):
+        """ Statistics of the (feature, pm25) rows read(start, end) returns for hours [0, hours), in one pass. """
+        feature, pm25 = RunningStats(), RunningStats()
+        for a in range(0, hours, chunk_hours):
+            feature_rows, pm25_rows = read(a, min(a + chunk_hours, hours))
+            feature.update(feature_rows)
+            pm25.update(pm25_rows)
+        return cls(feature, pm25, key)
+
+    @staticmethod
+    def _entries(fp):
+        if not os.path.isfile(fp):
+            return {}
+        with np.load(fp) as f:
+            if int(f['version']) != STATS_VERSION:
+                return {}
+            return {name: f[name] for name in f.files}
+
+    @staticmethod
+    def _keys(entries, split):
+        return sorted({name.split('/')[1] for name in entries if name.startswith(split + '/')})
+
+    @classmethod
+    def load(cls, split, key, fp=norm_stats_fp):
+        """
+        Statistics of split ('Train', 'Val' or 'Test') saved in fp under key, None if there are none.
+        With key None, the statistics of split if fp has those of one key only, as model_stats_fp files.
+        """
+        entries = cls._entries(fp)
+        if key is None:
+            keys = cls._keys(entries, split)
+            if len(keys) != 1:
+                return None
+            key = keys[0]
+        prefix = '%s/%s/' % (split, key)
+        if prefix + 'feature_count' not in entries:
+            return None
+        moments = [RunningStats(int(entries[prefix + name + '_count']), entries[prefix + name + '_mean'], entries[prefix + name + '_m2'])
+                   for name in ('feature', 'pm25')]
+        return cls(moments[0], moments[1], key)
+
+    @classmethod
+    def find(cls, split, key, model_fp=None, fp=norm_stats_fp):
+        """
+        Statistics of split a model was trained or tested with, for running it on
+        other data (a simulated cube, an overlay): those train.py saved next to
+        model_fp, else those of fp under key; None if neither has them.
+        """
+        if model_fp is not None:
+            stats = cls.load(split, None, model_stats_fp(model_fp))
+            if stats is not None:
+                return stats
+        return cls.load(split, key, fp)
+
+    def save(self, split, fp=norm_stats_fp):
+        """ Saves the statistics as those of split under their key, keeping everything else in fp. """
+        entries = self._entries(fp)
+        entries['version'] = np.array(STATS_VERSION)
+        prefix = '%s/%s/' % (split, self.key)
+        for name, stats in (('feature', self.feature), ('pm25', self.pm25)):
+            entries[prefix + name + '_count'] = np.array(stats.count)
+            entries[prefix + name + '_mean'] = stats.mean
+            entries[prefix + name + '_m2'] = stats.m2
+        os.makedirs(os.path.dirname(os.path.abspath(fp)), exist_ok=True)
+        tmp_fp = fp + '.tmp.npz'
+        np.savez(tmp_fp, **entries)
+        os.replace(tmp_fp, fp)
+        return fp
@@ -0,0 +1,98 @@
+import os
+import sys
+proj_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(proj_dir)
+
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+from util import config
+
+HOUR = np.timedelta64(1, 'h')
+
+
+def to_hours(times):
+    """
+    datetime64[h] of datetime64s, datetimes or time labels 'YYYY-MM-DD HH...'
+    (the keys of time_dict.pkl, e.g. '2021-08-14 00:00'), truncated to the hour.
+    """
+    times = np.asarray(times)
+    if times.dtype.kind == 'O' and times.size and isinstance(times.flat[0], str):
+        times = times.astype(str)
+    if times.dtype.kind in 'US':
+        times = np.char.replace(times.astype('U13'), ' ', 'T')
+    return times.astype('datetime64[h]')
+
+
+def config_hour(time_yaml, fields=3):
+    """
+    UTC datetime64[h] of a config time [[YYYY, M, D, H, M], tz]. Only the first
+    `fields` date fields are used: dataset.py reads the day, dataset_exp1.py all of them.
+    """
+    dt = datetime(*time_yaml[0][:fields], tzinfo=ZoneInfo(time_yaml[1]))
+    return np.datetime64(dt.astimezone(timezone.utc).replace(tzinfo=None), 'h')
+
+
+class HourAxis():
+    """
+    Hourly time axis: index i is the UTC hour start + i, for `length` hours.
+    Indices are converted to and from datetime64, unix timestamps and time
+    labels, and to hour of day and weekday, with array arithmetic on int64
+    hour offsets, so nothing holds one datetime object per hour.
+    """
+    def __init__(self, start, length=None):
+        self.start = to_hours(start)
+        self.length = length
+
+    @classmethod
+    def from_config(cls, data_start=None, data_end=None, fields=3):
+        """ Hours of the dataset: data_start through one hour past data_end of the config. """
+        start = config_hour(config['dataset']['data_start'] if data_start is None else data_start, fields)
+        end = config_hour(config['dataset']['data_end'] if data_end is None else data_end, fields)
+        return cls(start, int((end - start) // HOUR) + 2)
+
+    @classmethod
+    def from_timestamps(cls, time_arr):
+        """ Axis of consecutive hours starting at the first unix timestamp of time_arr. """
+        return cls(np.datetime64(int(time_arr[0]), 's'), len(time_arr))
+
+    def __len__(self):
+        return self.length
+
+    def _index(self, index):
+        return np.arange(self.length) if index is None else np.asarray(index, dtype=np.int64)
+
+    def hours(self, index=None):
+        """ datetime64[h] of indices, all hours of the axis by default. """
+        return self.start + self._index(index) * HOUR
+
+    def timestamps(self, index=None):
+        """ Unix timestamps (float seconds) of indices. """
+        return self.hours(index).astype('datetime64[s]').astype(np.int64).astype(np.float64)
+
+    def labels(self, index=None, minutes=False):
+        """ 'YYYY-MM-DD HH' labels of indices, 'YYYY-MM-DD HH:MM' with minutes. """
+        labels = np.datetime_as_string(self.hours(index).astype('datetime64[m]' if minutes else 'datetime64[h]'))
+        return np.char.replace(labels, 'T', ' ')
+
+    def index(self, times):
+        """ Indices of datetime64s, datetimes or time labels (see to_hours). """
+        return ((to_hours(times) - self.start) // HOUR).astype(np.int64)
+
+    def timestamp_index(self, time_arr):
+        """ Indices of unix timestamps, -1 for those that are not an hour of the axis. """
+        offset = (np.asarray(time_arr, dtype=np.float64) - self.timestamps(0)) / 3600
+        index = np.floor(offset).astype(np.int64)
+        valid = (index == offset) & (index >= 0) & (index < self.length)
+        return np.where(valid, index, -1)
+
+    def hour(self, index=None):
+        """ Hour of day, 0 to 23. """
+        return self.hours(index).astype(np.int64) % 24
+
+    def isoweekday(self, index=None):
+        """ Monday=1 to Sunday=7 (1970-01-01 was a Thursday). """
+        days = self.hours(index).astype('datetime64[D]').astype(np.int64)
+        return (days + 3) % 7 + 1
@@ -7,6 +7,8 @@ from util import config, file_dir
 from graph import Graph
 import pdb
 from dataset import HazeData
+from stats import model_stats_fp
+from sampler import WindowBatches, window_sampler
 
 from model.MLP import MLP
 from model.LSTM import LSTM
@@ -16,7 +18,7 @@ from model.nodesFC_GRU import nodesFC_GRU
 from model.PM25_GNN import PM25_GNN
 from model.PM25_GNN_nosub import PM25_GNN_nosub
 
-import arrow
+from datetime import datetime, timezone
 import torch
 from torch import nn
 from tqdm import tqdm
@@ -41,6 +43,9 @@ seq_len = hist_len + pred_len
 weight_decay = config['train']['weight_decay']
 early_stop = config['train']['early_stop']
 lr = config['train']['lr']
+mmap = config['train'].get('mmap', False)
+feature_store = config['train'].get('feature_store', False)
+storage_dtype = config['train'].get('storage_dtype', 'float32')
 results_dir = file_dir['results_dir']
 dataset_num = config['experiments']['dataset_num']
 exp_model = config['experiments']['model']
@@ -48,14 +53,20 @@ exp_repeat = config['train']['exp_repeat']
 save_npy = config['experiments']['save_npy']
 criterion = nn.MSELoss()
 
-train_data = HazeData(graph, hist_len, pred_len, dataset_num, flag='Train')
-val_data = HazeData(graph, hist_len, pred_len, dataset_num, flag='Val')
-test_data = HazeData(graph, hist_len, pred_len, dataset_num, flag='Test')
+train_data = HazeData(graph, hist_len, pred_len, dataset_num, flag='Train', mmap=mmap, feature_store=feature_store, storage_dtype=storage_dtype)
+val_data = HazeData(graph, hist_len, pred_len, dataset_num, flag='Val', mmap=mmap, feature_store=feature_store, storage_dtype=storage_dtype)
+test_data = HazeData(graph, hist_len, pred_len, dataset_num, flag='Test', mmap=mmap, feature_store=feature_store, storage_dtype=storage_dtype)
 
 in_dim = train_data.feature.shape[-1] + train_data.pm25.shape[-1]
 wind_mean, wind_std = train_data.wind_mean, train_data.wind_std
 pm25_mean, pm25_std = test_data.pm25_mean, test_data.pm25_std
 
+# PM25_GNN advection weights are computed once per hour here instead of at every step of every batch
+use_edge_weight = exp_model in ('PM25_GNN', 'PM25_GNN_nosub')
+if use_edge_weight:
+    for data in (train_data, val_data, test_data):
+        data.edge_weights(wind_mean, wind_std)
+
 def get_metric(predict_epoch, label_epoch):
     haze_threshold = 75
     predict_haze = predict_epoch >= haze_threshold
@@ -113,45 +124,21 @@ def get_model():
     else:
         raise Exception('Wrong model name!')
 
-def prepare(pm25, feature, time_arr, flag):
-    pm25_hist = np.full((pm25.shape[0], hist_len, pm25.shape[1], pm25.shape[2]), -1.0, dtype=np.float)#double)
-    pm25_label = np.full((pm25.shape[0], pred_len, pm25.shape[1], pm25.shape[2]), -1.0, dtype=np.float)#double)
-    feature = np.full((feature.shape[0], hist_len+pred_len, feature.shape[1], feature.shape[2]), -1.0, dtype=np.float)#double)
-    pm = np.full((pm25.shape[0], hist_len+pred_len, pm25.shape[1], pm25.shape[2]), -1.0, dtype=np.float)#double)
-
-    for i in range(np.asarray(time_arr).shape[0]):
-        if flag == "Train":
-            end = train_data.time_index[np.asarray(time_arr)[i]]
-            pm25_hist[i,:,:,:] = train_data.pm25_full[end-seq_len+1:end-pred_len+1, :, :]
-            pm25_label[i,:,:,:] = train_data.pm25_full[end-pred_len+1:end+1, :, :]
-            feature[i,:,:,:] = train_data.feature_full[end-seq_len+1:end+1, :, :]
-            pm[i,:,:,:] = train_data.pm25_full[end-seq_len+1:end+1, :, :]
-        elif flag == "Val":
-            end = val_data.time_index[np.asarray(time_arr)[i]]
-            pm25_hist[i,:,:,:] = val_data.pm25_full[end-seq_len+1:end-pred_len+1, :, :]
-            pm25_label[i,:,:,:] = val_data.pm25_full[end-pred_len+1:end+1, :, :]
-            feature[i,:,:,:] = val_data.feature_full[end-seq_len+1:end+1, :, :]
-            pm[i,:,:,:] = val_data.pm25_full[end-seq_len+1:end+1, :, :]
-        else:
-            end = test_data.time_index[np.asarray(time_arr)[i]]
-            pm25_hist[i,:,:,:] = test_data.pm25_full[end-seq_len+1:end-pred_len+1, :, :]
-            pm25_label[i,:,:,:] = test_data.pm25_full[end-pred_len+1:end+1, :, :]
-            feature[i,:,:,:] = test_data.feature_full[end-seq_len+1:end+1, :, :]
-            pm[i,:,:,:] = test_data.pm25_full[end-seq_len+1:end+1, :, :]
-
-    return torch.tensor(pm25_hist, dtype=torch.float), torch.tensor(pm25_label, dtype=torch.float), torch.tensor(feature, dtype=torch.float), pm.astype('float')
+def run_model(model, pm25_hist, feature, edge_weight):
+    if edge_weight is None:
+        return model(pm25_hist, feature)
+    return model(pm25_hist, feature, edge_weight.to(device))
 
 
 def train(train_loader, model, optimizer):
     model.train()
     train_loss = 0
     for batch_idx, data in tqdm(enumerate(train_loader)):
-        pm25,feature, time_arr = data
-        pm25_hist, pm25_label, feature, pm25 = prepare(pm25, feature, time_arr, "Train")
+        pm25_hist, pm25_label, feature, pm25, edge_weight, frp500, time_arr = data
         feature = feature.to(device)
         pm25_hist = pm25_hist.to(device)
         pm25_label = pm25_label.to(device)
-        pm25_pred = model(pm25_hist, feature)
+        pm25_pred = run_model(model, pm25_hist, feature, edge_weight)
         loss = criterion(pm25_pred, pm25_label)
         loss.backward()
         optimizer.step()
@@ -163,11 +150,10 @@ def val(val_loader, model):
     model.eval()
     val_loss = 0
     for batch_idx, data in tqdm(enumerate(val_loader)):
-        pm25, feature, time_arr = data
-        pm25_hist, pm25_label, feature, pm25 = prepare(pm25, feature, time_arr, "Val")
+        pm25_hist, pm25_label, feature, pm25, edge_weight, frp500, time_arr = data
         feature = feature.to(device)
         pm25_hist = pm25_hist.to(device)
-        pm25_pred = model(pm25_hist, feature)
+        pm25_pred = run_model(model, pm25_hist, feature, edge_weight)
         pm25_label = pm25_label.to(device)
         loss = criterion(pm25_pred, pm25_label)
         val_loss += loss.item()
@@ -182,18 +168,17 @@ def test(test_loader, model):
     time_list = []
     test_loss = 0
     for batch_idx, data in enumerate(test_loader):
-        pm25, feature, time_arr = data
-        pm25_hist, pm25_label, feature, pm25 = prepare(pm25, feature, time_arr, "Test")
+        pm25_hist, pm25_label, feature, pm25, edge_weight, frp500, time_arr = data
         feature = feature.to(device)
         pm25_hist = pm25_hist.to(device)
         pm25_label = pm25_label.to(device)
-        pm25_pred = model(pm25_hist, feature)
+        pm25_pred = run_model(model, pm25_hist, feature, edge_weight)
 
         loss = criterion(pm25_pred, pm25_label)
         test_loss += loss.item()
 
         pm25_pred = np.concatenate([pm25_hist.cpu().detach().numpy(), pm25_pred.cpu().detach().numpy()], axis=1) * pm25_std + pm25_mean
-        pm25_label = pm25 * pm25_std + pm25_mean
+        pm25_label = pm25.numpy() * pm25_std + pm25_mean
         predict_list.append(pm25_pred)
         label_list.append(pm25_label)
         time_list.append(time_arr.cpu().detach().numpy())
@@ -211,16 +196,17 @@ def main():
     exp_info = get_exp_info()
     print(exp_info)
 
-    exp_time = arrow.now().format('YYYYMMDDHHmmss')
+    exp_time = datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')
 
     train_loss_list, val_loss_list, test_loss_list, rmse_list, mae_list, csi_list, pod_list, far_list = [], [], [], [], [], [], [], []
 
     for exp_idx in range(exp_repeat):
         print('\nNo.%2d experiment ~~~' % exp_idx)
 
-        train_loader = torch.utils.data.DataLoader(train_data, batch_size=batch_size, shuffle=True, drop_last=True)
-        val_loader = torch.utils.data.DataLoader(val_data, batch_size=batch_size, shuffle=False, drop_last=True)
-        test_loader = torch.utils.data.DataLoader(test_data, batch_size=batch_size, shuffle=False, drop_last=True)
+        # batches of window end indices, each gathered from the _full arrays in one go
+        train_loader = WindowBatches(train_data, window_sampler(train_data, config.get('sampler')), batch_size, drop_last=True)
+        val_loader = WindowBatches(val_data, range(len(val_data)), batch_size, drop_last=True)
+        test_loader = WindowBatches(test_data, range(len(test_data)), batch_size, drop_last=True)
 
         model = get_model()
         model = model.to(device)
@@ -234,6 +220,9 @@ def main():
         if not os.path.exists(exp_model_dir):
             os.makedirs(exp_model_dir)
         model_fp = os.path.join(exp_model_dir, 'model.pth')
+        # the statistics the model is trained and tested with, found there by simulate.py and dataset_exp1.py
+        train_data.stats.save('Train', model_stats_fp(model_fp))
+        test_data.stats.save('Test', model_stats_fp(model_fp))
 
         val_loss_min = 100000
         best_epoch = 0
@@ -265,8 +254,8 @@ def main():
                 print('Train loss: %0.4f, Val loss: %0.4f, Test loss: %0.4f, RMSE: %0.2f, MAE: %0.2f, CSI: %0.4f, POD: %0.4f, FAR: %0.4f' % (train_loss_, val_loss_, test_loss, rmse, mae, csi, pod, far))
 
                 if save_npy:
-                    np.save(os.path.join(exp_model_dir, 'predict.npy'), predict_epoch)
-                    np.save(os.path.join(exp_model_dir, 'label.npy'), label_epoch)
+                    np.save(os.path.join(exp_model_dir, 'predict.npy'), predict_epoch.astype(storage_dtype))
+                    np.save(os.path.join(exp_model_dir, 'label.npy'), label_epoch.astype(storage_dtype))
                     np.save(os.path.join(exp_model_dir, 'time.npy'), time_epoch)
 
         train_loss_list.append(train_loss_)
@@ -17,6 +17,8 @@ from graph import Graph
 # Removed pdb import here as set_trace is commented out
 # import pdb
 from dataset import HazeData # Assuming HazeData is correctly defined in dataset.py
+from stats import model_stats_fp
+from sampler import WindowBatches, window_sampler
 
 # Import models - ensure these files exist in ./model/
 try:
@@ -33,7 +35,7 @@ except ImportError as e:
     sys.exit(1)
 
 
-import arrow
+from datetime import datetime, timezone
 import torch
 from torch import nn
 from tqdm import tqdm
@@ -64,12 +66,16 @@ try:
     weight_decay = config['train']['weight_decay']
     early_stop = config['train']['early_stop']
     lr = config['train']['lr']
+    mmap = config['train'].get('mmap', False) # memory-mapped HazeData
+    feature_store = config['train'].get('feature_store', False) # preprocessed features shared by the splits
+    storage_dtype = config['train'].get('storage_dtype', 'float32') # of the feature store and the saved predictions
     exp_repeat = config['train']['exp_repeat']
     results_dir = file_dir['results_dir'] # Ensure this path is correct in config.yaml
     dataset_num = config['experiments']['dataset_num']
     exp_model = config['experiments']['model']
     save_npy = config['experiments']['save_npy']
     metero_use = config['experiments']['metero_use'] # Get metero list
+    sampler_conf = config.get('sampler', {'frp_thresh': 0.15}) # Training window selection, see sampler.py
 except KeyError as e:
     print(f"Error: Missing key in config.yaml: {e}")
     sys.exit(1)
@@ -81,11 +87,11 @@ criterion = nn.MSELoss() # Mean Squared Error Loss
 # Wrap data loading in try-except blocks for better error handling
 try:
     print("Loading Training Data...")
-    train_data = HazeData(graph, hist_len, pred_len, dataset_num, flag='Train')
+    train_data = HazeData(graph, hist_len, pred_len, dataset_num, flag='Train', mmap=mmap, feature_store=feature_store, storage_dtype=storage_dtype)
     print("Loading Validation Data...")
-    val_data = HazeData(graph, hist_len, pred_len, dataset_num, flag='Val')
+    val_data = HazeData(graph, hist_len, pred_len, dataset_num, flag='Val', mmap=mmap, feature_store=feature_store, storage_dtype=storage_dtype)
     print("Loading Test Data...")
-    test_data = HazeData(graph, hist_len, pred_len, dataset_num, flag='Test')
+    test_data = HazeData(graph, hist_len, pred_len, dataset_num, flag='Test', mmap=mmap, feature_store=feature_store, storage_dtype=storage_dtype)
 except Exception as e:
     print(f"Error loading HazeData: {e}")
     print("Check dataset.py and the underlying data files (e.g., knowair.npy).")
@@ -100,6 +106,11 @@ if 'train_data' in locals() and 'test_data' in locals():
     # Use test_data mean/std for un-normalizing test predictions, as is common practice
     pm25_mean_test, pm25_std_test = test_data.pm25_mean, test_data.pm25_std
     print(f"Test Data PM2.5 Stats for Un-normalization: mean {pm25_mean_test:.6f} std {pm25_std_test:.6f}")
+    # PM25_GNN advection weights are computed once per hour here instead of at every step of every batch
+    use_edge_weight = exp_model in ('PM25_GNN', 'PM25_GNN_nosub')
+    if use_edge_weight:
+        for split_data in (train_data, val_data, test_data):
+            split_data.edge_weights(wind_mean, wind_std)
 else:
     print("Error: Datasets not loaded successfully. Exiting.")
     sys.exit(1)
@@ -232,94 +243,11 @@ def get_model():
     return model.to(device) # Ensure model is on the correct device
 
 
-def prepare_batch(time_arr_batch, flag, dataset_obj):
-    """
-    Prepares history and label sequences for a batch using the dataset's full arrays.
-
-    Args:
-        time_arr_batch (torch.Tensor): Tensor of timestamps for the current batch.
-        flag (str): 'Train', 'Val', or 'Test'.
-        dataset_obj (HazeData): The corresponding dataset object (train_data, val_data, or test_data).
-
-    Returns:
-        tuple: Tensors for (pm25_hist, pm25_label, feature_seq, pm25_seq, [frp500_seq - only for Train])
-               Returns None for a sample if data is insufficient.
-    """
-    B = time_arr_batch.shape[0]
-    T_hist = dataset_obj.hist_len
-    T_pred = dataset_obj.pred_len
-    T_seq = T_hist + T_pred
-    N = dataset_obj.graph.node_num
-    F_feat = dataset_obj.feature_full.shape[-1]
-    F_pm = dataset_obj.pm25_full.shape[-1] # Should be 1
-
-    # Initialize tensors for the batch on CPU first
-    pm25_hist_batch = torch.zeros((B, T_hist, N, F_pm), dtype=torch.float)
-    pm25_label_batch = torch.zeros((B, T_pred, N, F_pm), dtype=torch.float)
-    feature_seq_batch = torch.zeros((B, T_seq, N, F_feat), dtype=torch.float)
-    pm25_seq_batch = torch.zeros((B, T_seq, N, F_pm), dtype=torch.float)
-    if flag == "Train":
-        # Assuming frp500 shape is (Time, Nodes)
-        F_frp = dataset_obj.frp500.shape[-1] if dataset_obj.frp500.ndim > 1 else N # Adjust if frp500 is just (Time,)
-        frp500_seq_batch = torch.zeros((B, T_seq, F_frp), dtype=torch.float) # Adjust shape if needed
-
-    valid_indices = [] # Keep track of samples with enough data
-
-    for i in range(B):
-        current_time = time_arr_batch[i].item()
-        try:
-            end_idx = dataset_obj.time_index[current_time]
-        except KeyError:
-            print(f"Warning: Timestamp {current_time} not found in {flag} dataset time_index. Skipping sample {i}.")
-            continue # Skip this sample
-
-        seq_start_idx = end_idx - T_seq + 1
-        hist_end_idx = end_idx - T_pred + 1
-        label_end_idx = end_idx + 1
-
-        if seq_start_idx < 0:
-            # print(f"Warning: Not enough history for index {end_idx} (time {current_time}) in {flag} dataset. Skipping sample {i}.")
-            continue # Skip this sample
-
-        # Slice numpy arrays and convert to tensors
-        pm25_hist_batch[i] = torch.from_numpy(dataset_obj.pm25_full[seq_start_idx:hist_end_idx, :, :])
-        pm25_label_batch[i] = torch.from_numpy(dataset_obj.pm25_full[hist_end_idx:label_end_idx, :, :])
-        feature_seq_batch[i] = torch.from_numpy(dataset_obj.feature_full[seq_start_idx:label_end_idx, :, :])
-        pm25_seq_batch[i] = torch.from_numpy(dataset_obj.pm25_full[seq_start_idx:label_end_idx, :, :])
-        if flag == "Train":
-             # Ensure frp500 slicing matches its dimensions
-            if dataset_obj.frp500.ndim == 2: # Shape (Time, Nodes)
-                 frp500_seq_batch[i] = torch.from_numpy(dataset_obj.frp500[seq_start_idx:label_end_idx, :])
-            elif dataset_obj.frp500.ndim == 1: # Shape (Time,) - Broadcast? Or error?
-                 # This case needs clarification on how single FRP value applies to nodes
-                 print(f"Warning: frp500 has unexpected shape {dataset_obj.frp500.shape}. Assuming broadcast needed.")
-                 frp_slice = torch.from_numpy(dataset_obj.frp500[seq_start_idx:label_end_idx])
-                 frp500_seq_batch[i] = frp_slice.unsqueeze(1).expand(-1, F_frp) # Example broadcast
-            else:
-                 raise ValueError(f"Unexpected frp500 shape: {dataset_obj.frp500.shape}")
-
-
-        valid_indices.append(i)
-
-    # Filter batch tensors to include only valid samples
-    if not valid_indices: # Handle case where no samples in the batch are valid
-        print(f"Warning: No valid samples found in batch for {flag}.")
-        if flag == "Train":
-            return None, None, None, None, None
-        else:
-            return None, None, None, None
-
-    valid_indices_tensor = torch.tensor(valid_indices, dtype=torch.long)
-    pm25_hist_batch = pm25_hist_batch[valid_indices_tensor]
-    pm25_label_batch = pm25_label_batch[valid_indices_tensor]
-    feature_seq_batch = feature_seq_batch[valid_indices_tensor]
-    pm25_seq_batch = pm25_seq_batch[valid_indices_tensor]
-
-    if flag == "Train":
-        frp500_seq_batch = frp500_seq_batch[valid_indices_tensor]
-        return pm25_hist_batch, pm25_label_batch, feature_seq_batch, pm25_seq_batch, frp500_seq_batch
-    else:
-        return pm25_hist_batch, pm25_label_batch, feature_seq_batch, pm25_seq_batch
+def run_model(model, pm25_hist, feature_seq, edge_weight_seq):
+    """ Forward pass, with the precomputed advection edge weights when the batch has them. """
+    if edge_weight_seq is None:
+        return model(pm25_hist, feature_seq)
+    return model(pm25_hist, feature_seq, edge_weight_seq.to(device))
 
 
 # --- Training, Validation, Testing Functions ---
@@ -334,34 +262,18 @@ def train(train_loader, model, optimizer, criterion):
     # Use tqdm for progress bar
     pbar = tqdm(train_loader, desc="Train Epoch", leave=False)
     for batch_idx, data in enumerate(pbar):
-        # Data from DataLoader is already a batch of tensors (pm25_now, feature_now, time_now)
-        _, _, time_arr_batch = data # We only need time_arr to fetch sequences
-
-        # Prepare history and labels for the batch
-        prepared_data = prepare_batch(time_arr_batch, "Train", train_data)
-        if prepared_data[0] is None: # Skip if batch preparation failed
-            continue
-        pm25_hist, pm25_label, feature_seq, _, frp500_seq = prepared_data
+        # Each batch is gathered by HazeData.gather from the end indices of its windows
+        pm25_hist, pm25_label, feature_seq, _, edge_weight_seq, frp500_seq, _ = data
 
         # Move data to the target device
         feature_seq = feature_seq.to(device)
         pm25_hist = pm25_hist.to(device)
         pm25_label = pm25_label.to(device)
-        frp500_seq = frp500_seq.to(device) # Move fire data too
-
-        # --- Fire condition check (Example) ---
-        # Adapt this logic based on how fire data should influence training
-        thresh = 0.15
-        # Check if *any* value in the sequence for *any* sample in the batch exceeds thresh
-        exceed = (frp500_seq > thresh).any()
-
-        if exceed:
-             # print(f"Skipping training batch {batch_idx} due to fire condition.")
-             continue # Skip this batch if fire condition met
+        # Windows with fire (frp500 above the sampler's frp_thresh) are excluded by the train sampler, see main()
 
         # --- Forward and Backward Pass ---
         optimizer.zero_grad()
-        pm25_pred = model(pm25_hist, feature_seq) # Pass history PM2.5 and feature sequence
+        pm25_pred = run_model(model, pm25_hist, feature_seq, edge_weight_seq) # Pass history PM2.5 and feature sequence
         loss = criterion(pm25_pred, pm25_label)
 
         # Check for NaN loss
@@ -401,17 +313,7 @@ def evaluate(loader, model, criterion, flag, dataset_obj):
     # Use tqdm for progress bar
     pbar = tqdm(loader, desc=f"{flag} Epoch", leave=False)
     for batch_idx, data in enumerate(pbar):
-        _, _, time_arr_batch = data
-
-        prepared_data = prepare_batch(time_arr_batch, flag, dataset_obj)
-        if prepared_data[0] is None:
-            continue
-
-        if flag == "Val":
-             pm25_hist, pm25_label, feature_seq, _ = prepared_data
-        else: # Test - also need the full pm25 sequence for un-normalization later
-             pm25_hist, pm25_label, feature_seq, pm25_seq = prepared_data
-
+        pm25_hist, pm25_label, feature_seq, pm25_seq, edge_weight_seq, _, time_arr_batch = data
 
         # Move data to device
         feature_seq = feature_seq.to(device)
@@ -419,7 +321,7 @@ def evaluate(loader, model, criterion, flag, dataset_obj):
         pm25_label_dev = pm25_label.to(device) # Keep label on CPU for loss calc if needed, move copy
 
         # --- Forward Pass ---
-        pm25_pred = model(pm25_hist, feature_seq)
+        pm25_pred = run_model(model, pm25_hist, feature_seq, edge_weight_seq)
         loss = criterion(pm25_pred, pm25_label_dev)
 
         if torch.isnan(loss):
@@ -436,7 +338,7 @@ def evaluate(loader, model, criterion, flag, dataset_obj):
             # Un-normalize using test set mean/std
             # Prediction is only for pred_len, prepend hist for context if needed by metric fn
             pred_unnorm = pm25_pred.cpu().numpy() * pm25_std_test + pm25_mean_test
-            # Label needs to be un-normalized too (it came from prepare_batch normalized)
+            # Label needs to be un-normalized too (HazeData.gather returns it normalized)
             label_unnorm = pm25_label.cpu().numpy() * pm25_std_test + pm25_mean_test
 
             predict_list.append(pred_unnorm)
@@ -479,7 +381,7 @@ def main():
     print(exp_info)
 
     # Use UTC time for unique experiment identifier
-    exp_time = arrow.utcnow().format('YYYYMMDDHHmmss')
+    exp_time = datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')
 
     # Lists to store metrics across repeats
     all_metrics = {'train_loss': [], 'val_loss': [], 'test_loss': [],
@@ -488,10 +390,12 @@ def main():
     for exp_idx in range(exp_repeat):
         print(f'\n--- Experiment Repeat {exp_idx + 1}/{exp_repeat} ---')
 
-        # DataLoaders - consider num_workers > 0 if I/O is bottleneck, but start with 0
-        train_loader = torch.utils.data.DataLoader(train_data, batch_size=batch_size, shuffle=True, drop_last=True, num_workers=0)
-        val_loader = torch.utils.data.DataLoader(val_data, batch_size=batch_size, shuffle=False, drop_last=True, num_workers=0)
-        test_loader = torch.utils.data.DataLoader(test_data, batch_size=batch_size, shuffle=False, drop_last=True, num_workers=0)
+        # Windows with frp500 > frp_thresh anywhere are never sampled (the ambient model is trained on fire-free windows)
+        train_sampler = window_sampler(train_data, sampler_conf)
+        # Batches of window end indices, each gathered from the _full arrays with one index per array
+        train_loader = WindowBatches(train_data, train_sampler, batch_size, drop_last=True)
+        val_loader = WindowBatches(val_data, range(len(val_data)), batch_size, drop_last=True)
+        test_loader = WindowBatches(test_data, range(len(test_data)), batch_size, drop_last=True)
 
         model = get_model()
         model_name = type(model).__name__
@@ -506,6 +410,9 @@ def main():
         os.makedirs(exp_model_dir, exist_ok=True)
         print(f"Results will be saved in: {exp_model_dir}")
         model_fp = os.path.join(exp_model_dir, 'model_best.pth') # Save best model
+        # the statistics the model is trained and tested with, found there by simulate.py and dataset_exp1.py
+        train_data.stats.save('Train', model_stats_fp(model_fp))
+        test_data.stats.save('Test', model_stats_fp(model_fp))
 
         # --- Training Loop ---
         val_loss_min = float('inf')
@@ -543,8 +450,8 @@ def main():
 
                      if save_npy:
                          print("Saving test predictions and labels...")
-                         np.save(os.path.join(exp_model_dir, 'predict_best.npy'), predict_epoch)
-                         np.save(os.path.join(exp_model_dir, 'label_best.npy'), label_epoch)
+                         np.save(os.path.join(exp_model_dir, 'predict_best.npy'), predict_epoch.astype(storage_dtype))
+                         np.save(os.path.join(exp_model_dir, 'label_best.npy'), label_epoch.astype(storage_dtype))
                          np.save(os.path.join(exp_model_dir, 'time_best.npy'), time_epoch)
                 else:
                      print("Test evaluation skipped as no valid batches were processed.")
@@ -0,0 +1,124 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('requests')
+import dataset as dataset_module
+from dataset import HazeData
+from graph import Graph
+from stats import NormStats
+from util import config, file_dir
+
+N_SITES = 6
+HIST_LEN, PRED_LEN = 4, 6
+MODES = {'eager': {}, 'mmap': {'mmap': True},
+         'store': {'feature_store': True}, 'store_mmap': {'feature_store': True, 'mmap': True},
+         'float16': {'feature_store': True, 'storage_dtype': 'float16'},
+         'float16_mmap': {'feature_store': True, 'mmap': True, 'storage_dtype': 'float16'}}
+
+
+def synthetic_cube(hours, seed=0):
+    """ float32 (hours, sites, metero_var + PM2.5) cube, every channel on the scale of the real one. """
+    rng = np.random.default_rng(seed)
+    scale = {'2m_dewpoint_temperature': (270, 10), '2m_temperature': (285, 10), 'boundary_layer_height': (600, 300),
+             'total_precipitation': (0, 1e-4), 'surface_pressure': (95000, 3000), 'julian_date': (180, 100),
+             'time_of_day': (12, 7), 'numfires': (5, 5)}
+    metero_var = config['data']['metero_var']
+    cube = np.empty((hours, N_SITES, len(metero_var) + 1), dtype=np.float32)
+    for c, var in enumerate(metero_var):
+        loc, std = scale.get(var, (0, 5))
+        cube[:, :, c] = rng.normal(loc, std, (hours, N_SITES))
+    cube[:, :, -1] = rng.gamma(2.0, 10.0, (hours, N_SITES))
+    return cube
+
+
+def small_graph():
+    # only what HazeData and Graph.advection_weights use
+    graph = Graph.__new__(Graph)
+    graph.node_num = N_SITES
+    graph.edge_index = np.array([[0, 1, 2, 3, 4, 5, 0], [1, 0, 3, 2, 5, 4, 5]])
+    rng = np.random.default_rng(1)
+    graph.edge_attr = np.stack([rng.uniform(20, 200, 7), rng.uniform(0, 2 * np.pi, 7)], axis=-1)
+    graph.edge_num = graph.edge_index.shape[1]
+    return graph
+
+
+@pytest.fixture
+def build(tmp_path, monkeypatch):
+    """
+    HazeData of the Test split of a synthetic knowair cube starting 2020-12-01,
+    in any of MODES; every dataset computes its own normalization statistics.
+    """
+    monkeypatch.setitem(config['dataset'], 'data_start', [[2020, 12, 1, 0, 0], 'GMT'])
+    knowair_fp = str(tmp_path / 'knowair.npy')
+    np.save(knowair_fp, synthetic_cube(len(dataset_module.HourAxis.from_config())))
+    monkeypatch.setitem(file_dir, 'knowair_fp', knowair_fp)
+    monkeypatch.delitem(file_dir, 'knowair_overlay', raising=False)
+    graph = small_graph()
+
+    def _build(mode):
+        fp = str(tmp_path / ('norm_stats_%s.npz' % mode))
+        monkeypatch.setattr(NormStats.load.__func__, '__defaults__', (fp,))
+        monkeypatch.setattr(NormStats.save, '__defaults__', (fp,))
+        return HazeData(graph, HIST_LEN, PRED_LEN, 1, flag='Test', **MODES[mode])
+    return _build
+
+
+def gathered(data, end):
+    pm25_hist, pm25_label, feature, pm25, edge_weight, frp500, time = data.gather(end)
+    assert edge_weight is None
+    data.edge_weights(data.wind_mean, data.wind_std)
+    edge_weight = data.gather(end)[4]
+    return {'pm25_hist': pm25_hist, 'pm25_label': pm25_label, 'feature': feature, 'pm25': pm25,
+            'edge_weight': edge_weight, 'frp500': frp500, 'time': time}
+
+
+def window_ends(data):
+    seq_len = HIST_LEN + PRED_LEN
+    return np.array([0, 1, 500, 3000, len(data) - 1]) + seq_len
+
+
+def test_modes_gather_the_same_windows(build):
+    eager = build('eager')
+    ends = window_ends(eager)
+    expected = gathered(eager, ends)
+    assert expected['feature'].shape == (len(ends), HIST_LEN + PRED_LEN, N_SITES, len(config['experiments']['metero_use']) + 4)
+    for mode in ('mmap', 'store', 'store_mmap'):
+        data = build(mode)
+        assert len(data) == len(eager)
+        np.testing.assert_array_equal(data.time_arr, eager.time_arr)
+        got = gathered(data, ends)
+        for name, value in expected.items():
+            np.testing.assert_allclose(got[name].numpy(), value.numpy(), rtol=1e-5, atol=1e-5, err_msg='%s %s' % (mode, name))
+
+
+def test_modes_compute_the_same_statistics(build):
+    eager = build('eager')
+    for mode in ('mmap', 'store', 'store_mmap'):
+        data = build(mode)
+        for name in ('feature_mean', 'feature_std', 'pm25_mean', 'pm25_std', 'wind_mean', 'wind_std'):
+            np.testing.assert_allclose(getattr(data, name), getattr(eager, name), rtol=1e-6, err_msg='%s %s' % (mode, name))
+        np.testing.assert_allclose(data.stats.feature_site_mean, eager.stats.feature_site_mean, rtol=1e-6)
+        np.testing.assert_allclose(data.stats.feature_site_std, eager.stats.feature_site_std, rtol=1e-6)
+
+
+@pytest.mark.parametrize('mode', ['float16', 'float16_mmap'])
+def test_float16_store_within_rescale_tolerance(build, mode):
+    eager, data = build('eager'), build(mode)
+    # every channel is stored rescaled to [-1, 1] over its range: within half a float16 ulp of 1,
+    # 2**-11 * scale in raw units, on top of float32 rounding
+    scale = data.store['feature_scale'][1]
+    tolerance = 2.0 ** -11 * scale
+    for name in ('feature_mean', 'feature_std'):
+        diff = np.abs(getattr(data, name) - getattr(eager, name))
+        assert (diff <= tolerance + 1e-6 * np.abs(getattr(eager, name))).all(), (name, diff / tolerance)
+    np.testing.assert_array_equal(data.pm25_mean, eager.pm25_mean) # PM2.5 is kept float32
+    np.testing.assert_array_equal(data.pm25_std, eager.pm25_std)
+
+    ends = window_ends(eager)
+    got, expected = data.gather(ends), eager.gather(ends)
+    feature_tolerance = 2 * tolerance / eager.feature_std + 1e-5 # in normalized units, with the statistics' own error
+    diff = np.abs(got[2].numpy() - expected[2].numpy())
+    assert (diff <= feature_tolerance).all(), (diff / feature_tolerance).max(axis=(0, 1, 2))
+    for k in (0, 1, 3, 5, 6): # PM2.5, frp500 and time are not rescaled
+        np.testing.assert_allclose(got[k].numpy(), expected[k].numpy(), rtol=1e-6, atol=1e-6)
@@ -0,0 +1,176 @@
+import json
+import pickle
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pytest
+
+pytest.importorskip('requests')
+from elevation import ArrayElevation, CachedElevation, OpenTopoDataElevation
+
+
+def fake_alt(lat, lon):
+    return round(lat * 100 + lon, 3)
+
+
+class FakeOpenTopoData():
+    """
+    Local stand-in for an opentopodata server on a free port. Every request is
+    recorded with its time and number of locations; the first `fail` requests
+    get a `fail_status` response.
+    """
+    def __init__(self, fail=0, fail_status=503):
+        self.requests = []
+        self.fail = fail
+        self.fail_status = fail_status
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                locations = parse_qs(urlparse(self.path).query)['locations'][0].split('|')
+                server.requests.append((time.time(), len(locations)))
+                if len(server.requests) <= server.fail:
+                    return self._send(server.fail_status, {'status': 'SERVER_ERROR'})
+                results = []
+                for location in locations:
+                    lat, lon = map(float, location.split(','))
+                    results.append({'elevation': fake_alt(lat, lon), 'location': {'lat': lat, 'lng': lon}})
+                self._send(200, {'status': 'OK', 'results': results})
+
+            def _send(self, code, body):
+                data = json.dumps(body).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d/v1/test-dataset' % self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def server():
+    s = FakeOpenTopoData()
+    yield s
+    s.close()
+
+
+def random_points(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.round(rng.uniform(20, 50, n), 1), np.round(rng.uniform(100, 130, n), 1)
+
+
+def test_opentopodata_batches_points(server):
+    lat, lon = random_points(250)
+    alt = OpenTopoDataElevation(server.url, interval=0)(lat, lon)
+    np.testing.assert_allclose(alt, [fake_alt(a, b) for a, b in zip(lat, lon)])
+    assert [n for _, n in server.requests] == [100, 100, 50]
+
+
+def test_opentopodata_single_request_per_batch(server):
+    lat, lon = random_points(80)
+    OpenTopoDataElevation(server.url, interval=0)(lat, lon)
+    assert len(server.requests) == 1
+
+
+def test_opentopodata_rate_limit(server):
+    lat, lon = random_points(40)
+    OpenTopoDataElevation(server.url, batch_size=10, interval=0.2)(lat, lon)
+    times = [t for t, _ in server.requests]
+    assert len(times) == 4
+    assert min(np.diff(times)) >= 0.19
+
+
+def test_opentopodata_retries_failed_requests():
+    server = FakeOpenTopoData(fail=2)
+    try:
+        lat, lon = random_points(5)
+        alt = OpenTopoDataElevation(server.url, interval=0, retries=2, backoff=0.05)(lat, lon)
+        np.testing.assert_allclose(alt, [fake_alt(a, b) for a, b in zip(lat, lon)])
+        assert len(server.requests) == 3
+        assert server.requests[2][0] - server.requests[1][0] >= 0.09 # backoff doubles
+    finally:
+        server.close()
+
+
+def test_opentopodata_gives_up_after_retries():
+    server = FakeOpenTopoData(fail=10, fail_status=429)
+    try:
+        with pytest.raises(Exception, match='HTTP 429'):
+            OpenTopoDataElevation(server.url, interval=0, retries=1, backoff=0)(*random_points(5))
+        assert len(server.requests) == 2
+    finally:
+        server.close()
+
+
+def test_opentopodata_unreachable_server():
+    server = FakeOpenTopoData()
+    server.close()
+    with pytest.raises(Exception, match='after 2 attempts'):
+        OpenTopoDataElevation(server.url, interval=0, retries=1, backoff=0, timeout=1)(*random_points(5))
+
+
+def test_cached_elevation_writes_through(server, tmp_path):
+    cache_fp = str(tmp_path / 'alt.pkl')
+    lat, lon = random_points(150)
+    alt = CachedElevation(cache_fp, OpenTopoDataElevation(server.url, interval=0))(lat, lon)
+    n = len(server.requests)
+    assert n == 2
+
+    with open(cache_fp, 'rb') as f:
+        cache = pickle.load(f)
+    assert cache == {(a, b): fake_alt(a, b) for a, b in zip(lat.tolist(), lon.tolist())}
+
+    # a new instance serves the same points from alt.pkl without any request
+    cached = CachedElevation(cache_fp, OpenTopoDataElevation(server.url, interval=0))
+    np.testing.assert_array_equal(cached(lat, lon), alt)
+    assert len(server.requests) == n
+
+    # only the missing points are fetched, in one batch
+    lat2, lon2 = random_points(30, seed=1)
+    cached(np.concatenate([lat, lat2]), np.concatenate([lon, lon2]))
+    assert len(server.requests) == n + 1
+    assert server.requests[-1][1] == len(set(zip(lat2.tolist(), lon2.tolist())) - set(cache))
+
+
+def test_cached_elevation_without_provider(tmp_path):
+    cache_fp = str(tmp_path / 'alt.pkl')
+    with open(cache_fp, 'wb') as f:
+        pickle.dump({(30.0, 110.0): 5.0}, f)
+    cached = CachedElevation(cache_fp)
+    assert cached(30.0, 110.0).tolist() == [5.0]
+    with pytest.raises(Exception, match='no provider'):
+        cached(31.0, 110.0)
+
+
+def test_cached_elevation_key_tracks_cache_content(server, tmp_path):
+    cache_fp = str(tmp_path / 'alt.pkl')
+    cached = CachedElevation(cache_fp, OpenTopoDataElevation(server.url, interval=0))
+    empty_key = cached.cache_key
+    assert empty_key.startswith('opentopodata:' + server.url)
+
+    cached(*random_points(10))
+    key = cached.cache_key
+    assert key != empty_key
+    assert CachedElevation(cache_fp, OpenTopoDataElevation(server.url, interval=0)).cache_key == key
+    # the same alt.pkl behind another dataset is another source
+    assert CachedElevation(cache_fp, OpenTopoDataElevation(server.url + '2', interval=0)).cache_key != key
+
+
+def test_array_elevation_nearest_cell():
+    lat_axis, lon_axis = np.arange(20.0, 30.0), np.arange(100.0, 110.0)
+    grid = lat_axis[:, None] * 1000 + lon_axis[None, :]
+    elevation = ArrayElevation(lat_axis, lon_axis, grid)
+    np.testing.assert_array_equal(elevation([20.2, 25.6, 35.0], [100.4, 103.5, 90.0]), [20100, 26103, 29100])
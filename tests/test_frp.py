@@ -0,0 +1,183 @@
+import math
+
+import numpy as np
+import pytest
+
+from frp import (FRP_BANDS_KM, GeometryCache, SpatialIndex, WindGrid, fire_site_geometry, frp_influence,
+                 frp_influence_pairs)
+from metcalc import geodesic
+
+mpcalc = pytest.importorskip('metpy.calc')
+units = pytest.importorskip('metpy.units').units
+distance = pytest.importorskip('geopy.distance')
+
+
+def calculate_initial_compass_bearing(pointA, pointB):
+    # as in the original exclude_fires.py / transpose_pfire.py
+    lat1 = math.radians(pointA[0])
+    lat2 = math.radians(pointB[0])
+    diffLong = math.radians(pointB[1] - pointA[1])
+    x = math.sin(diffLong) * math.cos(lat2)
+    y = math.cos(lat1) * math.sin(lat2) - (math.sin(lat1) * math.cos(lat2) * math.cos(diffLong))
+    return (math.degrees(math.atan2(x, y)) + 360) % 360
+
+
+def scalar_influence(fires, sites, wind_u, wind_v):
+    """
+    The hour x site x fire loop of the original scripts for one hour: fires are
+    (lat, lon, frp) and wind_u/wind_v the wind at each fire. Returns
+    (sites, 5), the 25/50/100/500 km bands and the number of fires.
+    """
+    out = np.zeros((len(sites), 5))
+    for j, (latsite, lonsite) in enumerate(sites):
+        for (latf, lonf, frp), u, v in zip(fires, wind_u, wind_v):
+            firewindu = u * units.meter / units.second
+            firewindv = v * units.meter / units.second
+            bearingangle = calculate_initial_compass_bearing((latf, lonf), (latsite, lonsite))
+            wind_fire_angle = (mpcalc.wind_direction(firewindu, firewindv, convention='to') % 360)._magnitude
+            if abs(bearingangle - wind_fire_angle) < 90:
+                weight1 = mpcalc.wind_speed(firewindu, firewindv)._magnitude
+                dist = distance.distance((latf, lonf), (latsite, lonsite)).km
+                weight2 = 1 / (dist * dist * 4 * math.pi)
+                weight3 = math.cos(math.radians(abs(bearingangle - wind_fire_angle)))
+                for k, band in enumerate(FRP_BANDS_KM):
+                    if dist <= band:
+                        out[j, k] += frp * weight1 * weight2 * weight3
+                if dist <= 500:
+                    out[j, 4] += 1
+    return out
+
+
+def random_case(n_fires=60, n_sites=12, seed=0):
+    # fires spread over a few degrees around the sites, so every band gets fires and some are beyond 500 km
+    rng = np.random.default_rng(seed)
+    site_lat, site_lon = rng.uniform(36, 40, n_sites), rng.uniform(-123, -118, n_sites)
+    fire_lat, fire_lon = rng.uniform(33, 43, n_fires), rng.uniform(-127, -114, n_fires)
+    # a few fires right next to sites, inside the 25 km band
+    fire_lat[:n_sites // 2] = site_lat[:n_sites // 2] + rng.uniform(-0.1, 0.1, n_sites // 2)
+    fire_lon[:n_sites // 2] = site_lon[:n_sites // 2] + rng.uniform(-0.1, 0.1, n_sites // 2)
+    frp = rng.gamma(2.0, 20.0, n_fires)
+    wind_u, wind_v = rng.normal(0, 5, (2, n_fires))
+    wind_u[-1] = wind_v[-1] = 0.0 # calm wind at a fire, which then contributes nothing
+    return fire_lat, fire_lon, frp, site_lat, site_lon, wind_u, wind_v
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_frp_influence_matches_scalar_loop(seed):
+    fire_lat, fire_lon, frp, site_lat, site_lon, wind_u, wind_v = random_case(seed=seed)
+    expected = scalar_influence(list(zip(fire_lat, fire_lon, frp)), list(zip(site_lat, site_lon)), wind_u, wind_v)
+    assert (expected[:, 0] > 0).any() and (expected[:, 4] > 0).any()
+
+    dist, bearing = fire_site_geometry(fire_lat, fire_lon, site_lat, site_lon)
+    got = frp_influence(frp, dist, bearing, wind_u, wind_v)
+    assert got.shape == (len(site_lat), len(FRP_BANDS_KM) + 1)
+    np.testing.assert_allclose(got, expected, rtol=1e-9, atol=1e-12)
+
+
+def test_frp_influence_keeps_leading_hour_dimension():
+    fire_lat, fire_lon, frp, site_lat, site_lon, wind_u, wind_v = random_case(n_fires=20, n_sites=5)
+    rng = np.random.default_rng(3)
+    hours_u, hours_v = rng.normal(0, 5, (2, 4, len(frp)))
+    dist, bearing = fire_site_geometry(fire_lat, fire_lon, site_lat, site_lon)
+    got = frp_influence(frp, dist, bearing, hours_u, hours_v)
+    assert got.shape == (4, len(site_lat), len(FRP_BANDS_KM) + 1)
+    fires, sites = list(zip(fire_lat, fire_lon, frp)), list(zip(site_lat, site_lon))
+    for h in range(4):
+        np.testing.assert_allclose(got[h], scalar_influence(fires, sites, hours_u[h], hours_v[h]), rtol=1e-9, atol=1e-12)
+
+
+def test_frp_influence_without_fires():
+    dist, bearing = fire_site_geometry(np.zeros(0), np.zeros(0), np.array([37.0]), np.array([-120.0]))
+    got = frp_influence(np.zeros(0), dist, bearing, np.zeros(0), np.zeros(0))
+    np.testing.assert_array_equal(got, np.zeros((1, len(FRP_BANDS_KM) + 1)))
+
+
+def find_nearest(array, value):
+    # as in the original scripts
+    array = np.asarray(array)
+    idx = (np.abs(array - value)).argmin()
+    return array[idx]
+
+
+def wind_axes():
+    # ERA5 style: latitude descending, longitude ascending, 0.25 degree cells; the dicts map a grid value to
+    # its index in a larger grid, as dict_wind_grid_*.pkl do
+    lat_grid, lon_grid = np.arange(43.0, 32.0, -0.25), np.arange(-125.0, -113.0, 0.25)
+    lat_dict = {value: i + 7 for i, value in enumerate(lat_grid)}
+    lon_dict = {value: i + 3 for i, value in enumerate(lon_grid)}
+    return lat_grid, lon_grid, lat_dict, lon_dict
+
+
+def test_wind_grid_matches_find_nearest():
+    lat_grid, lon_grid, lat_dict, lon_dict = wind_axes()
+    rng = np.random.default_rng(0)
+    lat = np.concatenate([rng.uniform(31, 44, 500),
+                          lat_grid[:10] - 0.125, # halfway between two cells, a tie
+                          lat_grid[:5], [50.0, 20.0]]) # on a cell and outside the grid
+    lon = np.concatenate([rng.uniform(-126, -112, 500), lon_grid[:10] + 0.125, lon_grid[:5], [-130.0, -100.0]])
+    lat_idx, lon_idx = WindGrid(lat_grid, lon_grid, lat_dict, lon_dict).index(lat, lon)
+    np.testing.assert_array_equal(lat_idx, [lat_dict[find_nearest(lat_grid, v)] for v in lat])
+    np.testing.assert_array_equal(lon_idx, [lon_dict[find_nearest(lon_grid, v)] for v in lon])
+
+
+def test_wind_grid_without_dicts_indexes_positions():
+    lat_grid, lon_grid, _, _ = wind_axes()
+    lat = np.array([lat_grid[3] - 0.125, 37.01, 31.0])
+    lon = np.array([lon_grid[4] + 0.125, -120.3, -112.0])
+    lat_idx, lon_idx = WindGrid(lat_grid, lon_grid).index(lat, lon)
+    np.testing.assert_array_equal(lat_idx, [np.abs(lat_grid - v).argmin() for v in lat])
+    np.testing.assert_array_equal(lon_idx, [np.abs(lon_grid - v).argmin() for v in lon])
+
+
+def test_wind_grid_gather():
+    lat_grid, lon_grid, lat_dict, lon_dict = wind_axes()
+    field = np.random.default_rng(1).normal(size=(24, 60, 60))
+    grid = WindGrid(lat_grid, lon_grid, lat_dict, lon_dict)
+    lat_idx, lon_idx = grid.index(np.array([37.1, 40.0, 35.3]), np.array([-120.2, -119.0, -117.6]))
+    timeind = np.array([0, 5, 23])
+    got = grid.gather(field, timeind, lat_idx, lon_idx)
+    assert got.shape == (3, 3)
+    for h, t in enumerate(timeind):
+        for f in range(3):
+            assert got[h, f] == field[t][lat_idx[f]][lon_idx[f]]
+
+
+@pytest.mark.parametrize('radius_km', [25, 100, 500])
+def test_spatial_index_finds_every_pair_within_radius(radius_km):
+    fire_lat, fire_lon, _, site_lat, site_lon, _, _ = random_case(n_fires=300, n_sites=40, seed=4)
+    fire_idx, site_idx = SpatialIndex(site_lat, site_lon).pairs(fire_lat, fire_lon, radius_km)
+    found = set(zip(fire_idx.tolist(), site_idx.tolist()))
+    dist = geodesic(fire_lat[:, None], fire_lon[:, None], site_lat[None, :], site_lon[None, :])
+    within = set(zip(*[a.tolist() for a in np.nonzero(dist <= radius_km)]))
+    assert within and within <= found
+    # the padding only lets in pairs just outside the radius
+    assert all(dist[f, s] <= radius_km * 1.02 for f, s in found)
+
+
+def test_pairs_kernel_matches_unfiltered_kernel(tmp_path):
+    fire_lat, fire_lon, frp, site_lat, site_lon, _, _ = random_case(n_fires=200, n_sites=30, seed=5)
+    rng = np.random.default_rng(5)
+    wind_u, wind_v = rng.normal(0, 5, (2, 6, len(frp)))
+    cache = GeometryCache(str(tmp_path / 'geometry'), site_lat, site_lon)
+    # the dense kernel over the same cached (float32) geometry, every fire against every site
+    dist, bearing = cache.geometry(cache.rows(fire_lat, fire_lon))
+    expected = frp_influence(frp, dist, bearing, wind_u, wind_v)
+
+    fire_idx, site_idx, pair_dist, pair_bearing = cache.pairs(fire_lat, fire_lon)
+    assert len(fire_idx) < dist.size # the index did filter pairs out
+    got = frp_influence_pairs(frp, fire_idx, site_idx, pair_dist, pair_bearing, wind_u, wind_v, len(site_lat))
+    np.testing.assert_allclose(got, expected, rtol=1e-12, atol=1e-15)
+    np.testing.assert_array_equal(got[..., -1], expected[..., -1])
+
+
+def test_geometry_cache_matches_direct_geometry(tmp_path):
+    fire_lat, fire_lon, _, site_lat, site_lon, _, _ = random_case(n_fires=50, n_sites=10, seed=6)
+    cache = GeometryCache(str(tmp_path / 'geometry'), site_lat, site_lon)
+    rows = cache.rows(fire_lat[:30], fire_lon[:30])
+    # a second instance reads the cache and adds the remaining fires
+    cache = GeometryCache(str(tmp_path / 'geometry'), site_lat, site_lon)
+    rows = cache.rows(fire_lat, fire_lon)
+    dist, bearing = cache.geometry(rows)
+    expected_dist, expected_bearing = fire_site_geometry(np.round(fire_lat, 5), np.round(fire_lon, 5), site_lat, site_lon)
+    np.testing.assert_allclose(dist, expected_dist, rtol=1e-6)
+    np.testing.assert_allclose(bearing, expected_bearing, rtol=1e-6, atol=1e-4)
@@ -0,0 +1,130 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('requests')
+import graph as graph_module
+from elevation import ArrayElevation
+from graph import Graph, bresenham_lines
+
+
+def bresenham(x0, y0, x1, y1):
+    # as in the bresenham package the original _update_edges used
+    dx, dy = x1 - x0, y1 - y0
+    xsign = 1 if dx > 0 else -1
+    ysign = 1 if dy > 0 else -1
+    dx, dy = abs(dx), abs(dy)
+    if dx > dy:
+        xx, xy, yx, yy = xsign, 0, 0, ysign
+    else:
+        dx, dy = dy, dx
+        xx, xy, yx, yy = 0, ysign, xsign, 0
+    D = 2 * dy - dx
+    y = 0
+    for x in range(dx + 1):
+        yield x0 + x * xx + y * yx, y0 + x * xy + y * yy
+        if D >= 0:
+            y += 1
+            D -= 2 * dx
+        D += 2 * dy
+
+
+def points_of(lines, k):
+    line, x, y = lines
+    return list(zip(x[line == k].tolist(), y[line == k].tolist()))
+
+
+@pytest.mark.parametrize('line, expected', [
+    ((0, 0, 3, 0), [(0, 0), (1, 0), (2, 0), (3, 0)]),
+    ((3, 0, 0, 0), [(3, 0), (2, 0), (1, 0), (0, 0)]), # reversed
+    ((2, 3, 2, 3), [(2, 3)]), # single point
+    ((0, 0, 5, 2), [(0, 0), (1, 0), (2, 1), (3, 1), (4, 2), (5, 2)]),
+    ((0, 0, 1, 4), [(0, 0), (0, 1), (1, 2), (1, 3), (1, 4)]), # steep
+    ((1, 4, 0, 0), [(1, 4), (1, 3), (0, 2), (0, 1), (0, 0)]), # steep and reversed
+    ((0, 0, -3, 3), [(0, 0), (-1, 1), (-2, 2), (-3, 3)]), # diagonal
+    ((300, 1000, 296, 1009), [(300, 1000), (300, 1001), (299, 1002), (299, 1003), (298, 1004), (298, 1005),
+                              (297, 1006), (297, 1007), (296, 1008), (296, 1009)]),
+])
+def test_bresenham_lines_hand_written(line, expected):
+    assert points_of(bresenham_lines(*[[v] for v in line]), 0) == expected
+
+
+def test_bresenham_lines_matches_bresenham_per_line():
+    rng = np.random.default_rng(0)
+    x0, y0, x1, y1 = rng.integers(-30, 30, (4, 300))
+    x1[:10], y1[:10] = x0[:10], y0[:10]
+    lines = bresenham_lines(x0, y0, x1, y1)
+    assert np.all(np.diff(lines[0]) >= 0)
+    for k in range(len(x0)):
+        assert points_of(lines, k) == list(bresenham(x0[k], y0[k], x1[k], y1[k]))
+
+
+def write_locations(fp, nodes):
+    with open(fp, 'w') as f:
+        for idx, (lat, lon) in enumerate(nodes):
+            f.write('%d city%d %s %s\n' % (idx, idx, lat, lon))
+
+
+def dem(lat_range=(28.0, 34.0), lon_range=(98.0, 105.0)):
+    # 0.1 degree cells, the graph's factor grid
+    lat_axis = np.round(np.arange(lat_range[0], lat_range[1] + 0.05, 0.1), 1)
+    lon_axis = np.round(np.arange(lon_range[0], lon_range[1] + 0.05, 0.1), 1)
+    return lat_axis, lon_axis, np.zeros((len(lat_axis), len(lon_axis)))
+
+
+def edges(graph):
+    return set(zip(graph.edge_index[0].tolist(), graph.edge_index[1].tolist()))
+
+
+def test_update_edges_prunes_edges_across_ridges(tmp_path, monkeypatch):
+    monkeypatch.setattr(graph_module, 'city_fp', str(tmp_path / 'locations.txt'))
+    # A (30, 100) - B (30, 102) and C (31, 100) - D (31, 102)
+    write_locations(graph_module.city_fp, [(30.0, 100.0), (30.0, 102.0), (31.0, 100.0), (31.0, 102.0)])
+    lat_axis, lon_axis, alt = dem()
+    on = lambda axis, lo, hi: (axis >= lo - 1e-9) & (axis <= hi + 1e-9)
+    alt[np.ix_(on(lat_axis, 29.5, 30.2), on(lon_axis, 100.9, 101.1))] = 3000 # 3 cells high on A-B
+    alt[np.ix_(on(lat_axis, 30.8, 31.5), on(lon_axis, 101.0, 101.1))] = 3000 # only 2 cells on C-D
+    alt[np.ix_(on(lat_axis, 30.4, 30.6), on(lon_axis, 99.0, 99.5))] = 1000 # below alti_thres, off every line
+    graph = Graph(elevation=ArrayElevation(lat_axis, lon_axis, alt), cache_dir=None)
+
+    every = {(s, d) for s in range(4) for d in range(4) if s != d}
+    assert edges(graph) == every - {(0, 1), (1, 0)}
+    assert graph.edge_attr.shape == (len(every) - 2, 2)
+    assert graph.adj.nnz == graph.edge_num == len(every) - 2
+
+
+def update_edges_loop(graph, edge_index, edge_attr):
+    """ The per-edge loop of the original _update_edges, on the same elevation provider. """
+    keep = []
+    for i in range(edge_index.shape[1]):
+        src, dest = edge_index[0, i], edge_index[1, i]
+        src_lat, src_lon = int(graph.nodes[src]['lat'] * graph.factor), int(graph.nodes[src]['lon'] * graph.factor)
+        dest_lat, dest_lon = int(graph.nodes[dest]['lat'] * graph.factor), int(graph.nodes[dest]['lon'] * graph.factor)
+        points = np.asarray(list(bresenham(src_lat, src_lon, dest_lat, dest_lon))).transpose((1, 0))
+        altitude_points = graph._get_alt(points[0], points[1])
+        altitude_src = graph._get_alt(np.full(1, src_lat), np.full(1, src_lon))
+        altitude_dest = graph._get_alt(np.full(1, dest_lat), np.full(1, dest_lon))
+        keep.append(np.sum(altitude_points - altitude_src > graph.alti_thres) < 3 and
+                    np.sum(altitude_points - altitude_dest > graph.alti_thres) < 3)
+    return edge_index[:, keep], edge_attr[keep]
+
+
+def test_update_edges_matches_per_edge_loop(tmp_path, monkeypatch):
+    monkeypatch.setattr(graph_module, 'city_fp', str(tmp_path / 'locations.txt'))
+    rng = np.random.default_rng(0)
+    write_locations(graph_module.city_fp, zip(np.round(rng.uniform(29, 33, 25), 2), np.round(rng.uniform(99, 104, 25), 2)))
+    lat_axis, lon_axis, _ = dem()
+    alt = rng.gamma(1.0, 500.0, (len(lat_axis), len(lon_axis)))
+    elevation = ArrayElevation(lat_axis, lon_axis, alt)
+
+    unpruned = Graph.__new__(Graph)
+    unpruned.dist_thres, unpruned.alti_thres, unpruned.factor, unpruned.knn = 3, 1200, 10, None
+    unpruned.count, unpruned.elevation = set(), elevation
+    unpruned.nodes = unpruned._gen_nodes()
+    unpruned.node_num = len(unpruned.nodes)
+    edge_index, edge_attr = unpruned._gen_edges()
+    expected_index, expected_attr = update_edges_loop(unpruned, edge_index, edge_attr)
+    assert 0 < expected_index.shape[1] < edge_index.shape[1]
+
+    graph = Graph(elevation=elevation, cache_dir=None)
+    np.testing.assert_array_equal(graph.edge_index, expected_index)
+    np.testing.assert_array_equal(graph.edge_attr, expected_attr)
@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+
+import metcalc
+
+mpcalc = pytest.importorskip('metpy.calc')
+units = pytest.importorskip('metpy.units').units
+distance = pytest.importorskip('geopy.distance')
+
+
+def random_wind(n=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    u, v = rng.normal(0, 8, n), rng.normal(0, 8, n)
+    # calm winds and winds along the axes, where the direction wraps around
+    u[:4], v[:4] = 0.0, 0.0
+    u[4:8], v[4:8] = [0.0, 0.0, 3.0, -3.0], [3.0, -3.0, 0.0, 0.0]
+    return u, v
+
+
+def random_points(n=500, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.uniform(-90, 90, n), rng.uniform(-180, 180, n), rng.uniform(-90, 90, n), rng.uniform(-180, 180, n)
+
+
+def test_wind_speed_matches_metpy():
+    u, v = random_wind()
+    expected = mpcalc.wind_speed(u * units('m/s'), v * units('m/s')).m_as('m/s')
+    np.testing.assert_array_equal(metcalc.wind_speed(u, v), expected)
+
+
+@pytest.mark.parametrize('convention', ['from', 'to'])
+def test_wind_direction_matches_metpy(convention):
+    u, v = random_wind()
+    expected = mpcalc.wind_direction(u * units('m/s'), v * units('m/s'), convention=convention).m_as('degree')
+    direction = metcalc.wind_direction(u, v, convention)
+    np.testing.assert_allclose(direction, expected, rtol=0, atol=1e-12)
+    assert (direction[:4] == 0).all()
+
+
+def test_wind_direction_rejects_unknown_convention():
+    with pytest.raises(ValueError):
+        metcalc.wind_direction(1.0, 1.0, 'towards')
+
+
+def test_wind_torch_branch_matches_numpy():
+    torch = pytest.importorskip('torch')
+    u, v = random_wind()
+    tu, tv = torch.from_numpy(u), torch.from_numpy(v)
+    speed = metcalc.wind_speed(tu, tv)
+    assert isinstance(speed, torch.Tensor)
+    np.testing.assert_allclose(speed.numpy(), metcalc.wind_speed(u, v), rtol=0, atol=1e-12)
+    for convention in ('from', 'to'):
+        direction = metcalc.wind_direction(tu, tv, convention)
+        assert isinstance(direction, torch.Tensor)
+        np.testing.assert_allclose(direction.numpy(), metcalc.wind_direction(u, v, convention), rtol=0, atol=1e-9)
+
+
+def test_compass_bearing_reaches_destination():
+    # following the initial bearing along the great circle for the great circle distance ends at point 2
+    lat1, lon1, lat2, lon2 = random_points()
+    bearing = metcalc.compass_bearing(lat1, lon1, lat2, lon2)
+    assert ((bearing >= 0) & (bearing < 360)).all()
+    for i in range(len(lat1)):
+        d = distance.great_circle((lat1[i], lon1[i]), (lat2[i], lon2[i])).km
+        if d > 19000:
+            continue # nearly antipodal, the bearing is ill-conditioned
+        dest = distance.great_circle(kilometers=d).destination((lat1[i], lon1[i]), bearing[i])
+        assert distance.great_circle(dest, (lat2[i], lon2[i])).km < 1e-6
+
+
+def test_compass_bearing_cardinal_directions():
+    bearing = metcalc.compass_bearing(0.0, 0.0, np.array([1.0, 0.0, -1.0, 0.0]), np.array([0.0, 1.0, 0.0, -1.0]))
+    np.testing.assert_allclose(bearing, [0, 90, 180, 270], atol=1e-12)
+
+
+def test_geodesic_matches_geopy():
+    lat1, lon1, lat2, lon2 = random_points()
+    expected = [distance.geodesic((a, b), (c, d)).km for a, b, c, d in zip(lat1, lon1, lat2, lon2)]
+    np.testing.assert_allclose(metcalc.geodesic(lat1, lon1, lat2, lon2), expected, rtol=0, atol=1e-6)
+
+
+@pytest.mark.parametrize('points', [
+    (0.0, 0.0, 0.0, 180.0), # antipodal on the equator
+    (0.0, 0.0, 0.5, 179.7), # nearly antipodal
+    (10.0, 20.0, -10.0, -160.0),
+    (89.9, 10.0, -89.9, -170.0),
+    (90.0, 0.0, -90.0, 0.0), # pole to pole
+    (89.99, 0.0, 89.99, 180.0), # across the north pole
+    (-90.0, 0.0, 89.0, 30.0),
+    (45.0, 10.0, 45.0, 10.0), # the same point
+])
+def test_geodesic_edge_cases_match_geopy(points):
+    lat1, lon1, lat2, lon2 = points
+    assert abs(float(metcalc.geodesic(lat1, lon1, lat2, lon2)) - distance.geodesic((lat1, lon1), (lat2, lon2)).km) < 1e-6
+
+
+def test_geodesic_broadcasts():
+    lat1, lon1, lat2, lon2 = random_points(20)
+    # one site against many, with antipodal points mixed in
+    lat2, lon2 = np.append(lat2, -lat1[0]), np.append(lon2, lon1[0] + 180)
+    dist = metcalc.geodesic(lat1[0], lon1[0], lat2, lon2)
+    assert dist.shape == lat2.shape
+    expected = [distance.geodesic((lat1[0], lon1[0]), (c, d)).km for c, d in zip(lat2, lon2)]
+    np.testing.assert_allclose(dist, expected, rtol=0, atol=1e-6)
@@ -0,0 +1,260 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('tqdm')
+pytest.importorskip('pandas')
+import scenario as scenario_module
+from fire_catalog import FireCatalog
+from frp import FRP_BANDS_KM, GeometryCache, WindGrid
+from metcalc import compass_bearing, geodesic, wind_direction, wind_speed
+from scenario import Scenario, ScenarioEngine
+from timeaxis import HourAxis
+
+CENTER = [38.586, -120.537833]
+UTC_OFFSET = 7
+
+
+def find_nearest(array, value):
+    array = np.asarray(array)
+    return array[(np.abs(array - value)).argmin()]
+
+
+def fires_around(rng, day, n_near, n_far):
+    """ Fires of one day: n_near within ~20 km of CENTER, n_far up to a few degrees away, on 5-decimal coordinates. """
+    lat = np.concatenate([CENTER[0] + rng.uniform(-0.12, 0.12, n_near), rng.uniform(36, 41, n_far)])
+    lon = np.concatenate([CENTER[1] + rng.uniform(-0.12, 0.12, n_near), rng.uniform(-123, -118, n_far)])
+    return np.round(lat, 5), np.round(lon, 5), np.round(rng.gamma(2.0, 20.0, n_near + n_far), 3), [day] * (n_near + n_far)
+
+
+def make_catalog(days, seed=0):
+    rng = np.random.default_rng(seed)
+    cols = [fires_around(rng, day, 3, 4) for day in days]
+    return FireCatalog(*[np.concatenate([c[k] for c in cols]) for k in range(3)],
+                       np.array(sum([c[3] for c in cols], []), dtype='datetime64[D]'))
+
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    """
+    A ScenarioEngine over a synthetic dataset of the hours of 2021: 5 sites
+    around CENTER, random FRP channels and wind, a 0.25 degree wind grid with a
+    descending latitude axis, and alldates the PST labels (UTC - 7h) of the
+    dataset hours, as alltimes_pst.npy.
+    """
+    monkeypatch.setattr(scenario_module, 'frp_contrib_dir', str(tmp_path / 'frp_contrib'))
+    rng = np.random.default_rng(0)
+    eng = ScenarioEngine.__new__(ScenarioEngine)
+    eng.axis = HourAxis('2021-01-01 00', 24 * 365)
+    n = len(eng.axis)
+    lat_grid, lon_grid = np.arange(42.0, 35.0, -0.25), np.arange(-124.0, -117.0, 0.25)
+    eng.lat_dict = {value: i + 2 for i, value in enumerate(lat_grid)}
+    eng.lon_dict = {value: i + 5 for i, value in enumerate(lon_grid)}
+    eng.wu = rng.normal(0, 5, (n, len(lat_grid) + 2, len(lon_grid) + 5)).astype(np.float32)
+    eng.wv = rng.normal(0, 5, eng.wu.shape).astype(np.float32)
+    eng.wind_grid = WindGrid(lat_grid, lon_grid, eng.lat_dict, eng.lon_dict)
+    eng.alldates = eng.axis.labels(np.arange(n) - UTC_OFFSET, minutes=True)
+    eng.alldates_index = eng.axis.index(eng.alldates)
+    eng.dataset = rng.normal(0, 1, (n, 5, 15))
+    eng.siteloc = np.stack([CENTER[0] + rng.uniform(-1.5, 1.5, 5), CENTER[1] + rng.uniform(-1.5, 1.5, 5)])
+    eng.geometry = GeometryCache(str(tmp_path / 'geometry'), eng.siteloc[0], eng.siteloc[1])
+    eng.lat_grid, eng.lon_grid = lat_grid, lon_grid
+    eng.tmp_path = tmp_path
+    return eng
+
+
+def make_scenario(engine, name, **kw):
+    return Scenario(name, output=str(engine.tmp_path / ('%s.npy' % name)), utc_offset_hours=UTC_OFFSET, **kw)
+
+
+def reference(engine, sc):
+    """
+    The hour x site x fire loop of the original exclude_fires.py and
+    transpose_pfire.py, generalized to a Scenario's sign, scale, center,
+    radius, date mapping, source and target.
+    """
+    start = int(engine.axis.index(sc.target[0]))
+    end = len(engine.dataset) - UTC_OFFSET if sc.target[1] is None else int(engine.axis.index(sc.target[1]))
+    out = np.array(engine.dataset[start:end])
+    catalog = engine.catalog if sc.source is None else engine.catalog.between(*sc.source)
+    by_key = {}
+    for day in catalog.day_strings():
+        by_key.setdefault(sc.day_key(day), []).extend(zip(*catalog.fires(day)))
+    for i in range(start, end):
+        fires = by_key.get(sc.day_key(engine.alldates[i + UTC_OFFSET]), []) # +7: fire days are UTC, alldates PST
+        timeind = int(engine.axis.index(engine.alldates[i][0:13])) # wind at the actual time
+        for j in range(engine.siteloc.shape[1]):
+            latsite, lonsite = engine.siteloc[0][j], engine.siteloc[1][j]
+            for latf, lonf, frp in fires:
+                latind = engine.lat_dict[find_nearest(engine.lat_grid, latf)]
+                lonind = engine.lon_dict[find_nearest(engine.lon_grid, lonf)]
+                u, v = float(engine.wu[timeind][latind][lonind]), float(engine.wv[timeind][latind][lonind])
+                bearingangle = float(compass_bearing(latf, lonf, latsite, lonsite))
+                wind_fire_angle = float(wind_direction(u, v, convention='to')) % 360
+                if abs(bearingangle - wind_fire_angle) < 90:
+                    dist = float(geodesic(latf, lonf, latsite, lonsite))
+                    if sc.center is not None and float(geodesic(latf, lonf, *sc.center)) > sc.radius_km:
+                        continue
+                    w = frp * float(wind_speed(u, v)) / (dist * dist * 4 * np.pi) * np.cos(np.radians(abs(bearingangle - wind_fire_angle)))
+                    for k, band in enumerate(FRP_BANDS_KM):
+                        if dist <= band:
+                            out[i - start, j, 9 + k] += sc.sign * sc.scale * w
+                    if dist <= 500:
+                        out[i - start, j, 13] += sc.sign
+    return out
+
+
+def exclude_caldor(engine, name='exclude_caldor', **kw):
+    params = dict(sign=-1, scale=1, center=CENTER, radius_km=25, date_mapping='same_day',
+                  target=['2021-06-01 05', '2021-06-05 00'])
+    params.update(kw)
+    return make_scenario(engine, name, **params)
+
+
+def transpose_100x(engine, name='pfire_transpose_100x', **kw):
+    params = dict(sign=1, scale=100, center=CENTER, radius_km=25, date_mapping='month_day',
+                  source=['2018-03-21', '2020-12-31'], target=['2021-03-21 00', '2021-03-24 17'])
+    params.update(kw)
+    return make_scenario(engine, name, **params)
+
+
+def assert_output(sc, expected):
+    got = np.load(sc.output)
+    assert got.shape == expected.shape
+    # the geometry cache is float32, the reference float64
+    np.testing.assert_allclose(got, expected, rtol=1e-5, atol=1e-7)
+
+
+def test_exclude_matches_original_semantics(engine):
+    # fires on the UTC days of the target, and before and after it
+    engine.catalog = make_catalog(['2021-05-30', '2021-06-01', '2021-06-02', '2021-06-04', '2021-06-05', '2021-06-07'])
+    sc = exclude_caldor(engine)
+    expected = reference(engine, sc)
+    assert not np.allclose(expected, engine.dataset[int(engine.axis.index(sc.target[0])):][:len(expected)])
+    engine.run(sc)
+    assert_output(sc, expected)
+
+
+def test_transpose_matches_original_semantics(engine):
+    # fires of the same month-day in several source years, and on days outside the source range
+    engine.catalog = make_catalog(['2017-03-22', '2018-03-21', '2018-03-22', '2019-03-22', '2020-03-23',
+                                   '2020-06-01', '2021-03-22'])
+    sc = transpose_100x(engine)
+    expected = reference(engine, sc)
+    engine.run(sc)
+    assert_output(sc, expected)
+    # numfires moves by whole fires, it is not scaled
+    start = int(engine.axis.index(sc.target[0]))
+    delta = np.load(sc.output)[..., 13] - engine.dataset[start:start + len(expected), :, 13]
+    np.testing.assert_allclose(delta, np.round(delta), atol=1e-9)
+    assert delta.max() >= 1
+
+
+def test_scenario_without_center_uses_every_fire(engine):
+    engine.catalog = make_catalog(['2021-06-01', '2021-06-02'])
+    sc = exclude_caldor(engine, center=None, radius_km=None, scale=3)
+    engine.run(sc)
+    assert_output(sc, reference(engine, sc))
+
+
+def test_open_ended_target(engine):
+    engine.catalog = make_catalog(['2021-12-30', '2021-12-31'])
+    sc = exclude_caldor(engine, target=['2021-12-29 00', None])
+    engine.run(sc)
+    expected = reference(engine, sc)
+    # the slab ends 7 hours before the dataset, whose last hours have no UTC fire day
+    assert len(expected) == len(engine.dataset) - UTC_OFFSET - int(engine.axis.index('2021-12-29 00'))
+    assert_output(sc, expected)
+
+
+def changed_catalog(catalog, day, seed=1):
+    """ The catalog with the fires of one day replaced by new ones. """
+    keep = catalog.day != np.datetime64(day, 'D')
+    lat, lon, frp, days = fires_around(np.random.default_rng(seed), day, 4, 2)
+    return FireCatalog(np.concatenate([catalog.lat[keep], lat]), np.concatenate([catalog.lon[keep], lon]),
+                       np.concatenate([catalog.frp[keep], frp]),
+                       np.concatenate([catalog.day[keep], np.array(days, dtype='datetime64[D]')]))
+
+
+def test_update_after_one_changed_day_equals_full_run(engine, capsys):
+    days = ['2021-06-01', '2021-06-02', '2021-06-03', '2021-06-04']
+    engine.catalog = make_catalog(days)
+    sc = exclude_caldor(engine)
+    engine.run(sc)
+    before = np.load(sc.output)
+
+    engine.catalog = changed_catalog(engine.catalog, '2021-06-03')
+    capsys.readouterr()
+    engine.update(sc)
+    assert 'exclude_caldor: 1 of 4 fire days changed' in capsys.readouterr().out
+    fresh = exclude_caldor(engine, name='fresh')
+    engine.run(fresh)
+    updated = np.load(sc.output)
+    np.testing.assert_allclose(updated, np.load(fresh.output), rtol=1e-12, atol=1e-12)
+    # only the hours drawing from 2021-06-03 UTC moved
+    moved = np.nonzero((updated != before).any(axis=(1, 2)))[0]
+    start = int(engine.axis.index(sc.target[0]))
+    assert set(engine.alldates[moved + start + UTC_OFFSET].astype('U10')) == {'2021-06-03'}
+
+
+def test_update_with_removed_and_added_days(engine):
+    engine.catalog = make_catalog(['2021-06-01', '2021-06-02'])
+    sc = exclude_caldor(engine)
+    engine.run(sc)
+
+    catalog = engine.catalog.between(None, '2021-06-01') # 2021-06-02 loses its fires
+    engine.catalog = changed_catalog(catalog, '2021-06-04') # and 2021-06-04 gets some
+    engine.update(sc)
+    fresh = exclude_caldor(engine, name='fresh')
+    engine.run(fresh)
+    np.testing.assert_allclose(np.load(sc.output), np.load(fresh.output), rtol=1e-12, atol=1e-12)
+    assert_output(sc, reference(engine, sc))
+
+
+def test_update_without_changes_keeps_output(engine, capsys):
+    engine.catalog = make_catalog(['2021-03-22', '2019-03-23'])
+    sc = transpose_100x(engine)
+    engine.run(sc)
+    before = np.load(sc.output)
+    engine.update(sc)
+    assert ': 0 of' in capsys.readouterr().out
+    np.testing.assert_array_equal(np.load(sc.output), before)
+
+
+def test_update_of_a_new_scenario_runs_it(engine):
+    engine.catalog = make_catalog(['2021-06-02'])
+    sc = exclude_caldor(engine)
+    engine.update(sc)
+    assert_output(sc, reference(engine, sc))
+
+
+def batch_scenarios(engine, prefix):
+    # one group differing in sign, scale, center and radius, and a scenario of another group
+    return [exclude_caldor(engine, name=prefix + 'exclude'),
+            exclude_caldor(engine, name=prefix + 'add_10x', sign=1, scale=10),
+            exclude_caldor(engine, name=prefix + 'exclude_wide', radius_km=150),
+            exclude_caldor(engine, name=prefix + 'exclude_all', center=None, radius_km=None),
+            transpose_100x(engine, name=prefix + 'transpose')]
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_batch_equals_scenarios_one_at_a_time(engine, workers):
+    engine.catalog = make_catalog(['2019-03-21', '2020-03-23', '2021-03-22', '2021-06-01', '2021-06-02', '2021-06-04'])
+    batch = batch_scenarios(engine, 'batch_')
+    assert engine.run(batch, workers=workers) == [sc.output for sc in batch]
+    for sc, single in zip(batch, batch_scenarios(engine, 'single_')):
+        engine.run(single)
+        np.testing.assert_allclose(np.load(sc.output), np.load(single.output), rtol=1e-12, atol=1e-12)
+        assert_output(sc, reference(engine, sc))
+
+
+def test_batch_update_equals_single_updates(engine):
+    engine.catalog = make_catalog(['2021-03-22', '2021-06-01', '2021-06-02'])
+    batch, singles = batch_scenarios(engine, 'batch_'), batch_scenarios(engine, 'single_')
+    engine.run(batch)
+    for single in singles:
+        engine.run(single)
+    engine.catalog = changed_catalog(changed_catalog(engine.catalog, '2021-06-02'), '2020-03-22', seed=2)
+    engine.update(batch)
+    for sc, single in zip(batch, singles):
+        engine.update(single)
+        np.testing.assert_allclose(np.load(sc.output), np.load(single.output), rtol=1e-12, atol=1e-12)
@@ -0,0 +1,101 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+pytest.importorskip('torch')
+from dataset import find_norm_stats, norm_stats_key
+from stats import NormStats, model_stats_fp
+from util import config, file_dir
+
+N_SITES = 6
+
+
+def random_stats(seed, key=''):
+    rng = np.random.default_rng(seed)
+    n_feature = len(config['experiments']['metero_use'])
+    feature = rng.normal(5, 2, (200, N_SITES, n_feature))
+    pm25 = rng.gamma(2.0, 10.0, (200, N_SITES, 1))
+    return NormStats.compute(lambda a, b: (feature[a:b], pm25[a:b]), len(feature), 64, key=key)
+
+
+@pytest.fixture
+def cubes(tmp_path, monkeypatch):
+    """ An observed and a simulated knowair cube, knowair_fp set to the observed one. """
+    observed, simulated = str(tmp_path / 'knowair.npy'), str(tmp_path / 'knowair_sim_100x.npy')
+    np.save(observed, np.zeros((4, N_SITES, 3), dtype=np.float32))
+    np.save(simulated, np.ones((4, N_SITES, 3), dtype=np.float32))
+    monkeypatch.setitem(file_dir, 'knowair_fp', observed)
+    monkeypatch.delitem(file_dir, 'knowair_overlay', raising=False)
+    return observed, simulated
+
+
+def assert_same_stats(got, expected):
+    for name in ('feature_mean', 'feature_std', 'pm25_mean', 'pm25_std', 'wind_mean', 'wind_std',
+                 'feature_site_mean', 'pm25_site_std'):
+        np.testing.assert_array_equal(getattr(got, name), getattr(expected, name))
+
+
+def test_find_norm_stats_of_this_configs_data(tmp_path, cubes):
+    graph = SimpleNamespace(node_num=N_SITES)
+    fp = str(tmp_path / 'norm_stats.npz')
+    train = random_stats(0, norm_stats_key(graph, 'Train'))
+    train.save('Train', fp)
+    assert_same_stats(find_norm_stats(graph, 'Train', fp=fp), train)
+    assert find_norm_stats(graph, 'Test', fp=fp) is None
+    assert find_norm_stats(graph, 'Train', fp=str(tmp_path / 'missing.npz')) is None
+
+
+def test_find_norm_stats_with_another_knowair_fp(tmp_path, cubes):
+    # simulate.py / dataset_exp1.py run on the simulated cube with the statistics of the observed one
+    observed, simulated = cubes
+    graph = SimpleNamespace(node_num=N_SITES)
+    fp = str(tmp_path / 'norm_stats.npz')
+    train, test = random_stats(0, norm_stats_key(graph, 'Train')), random_stats(1, norm_stats_key(graph, 'Test'))
+    train.save('Train', fp)
+    model_fp = str(tmp_path / 'results' / 'model.pth')
+    (tmp_path / 'results').mkdir()
+    train.save('Train', model_stats_fp(model_fp))
+    test.save('Test', model_stats_fp(model_fp))
+
+    file_dir['knowair_fp'] = simulated
+    assert norm_stats_key(graph, 'Train') != train.key
+    # no statistics for the simulated cube: None for the legacy npy fallback, no exception
+    assert find_norm_stats(graph, 'Train', fp=fp) is None
+    # those saved next to the model, whatever the cube
+    assert_same_stats(find_norm_stats(graph, 'Train', model_fp=model_fp, fp=fp), train)
+    assert_same_stats(find_norm_stats(graph, 'Test', model_fp=model_fp, fp=fp), test)
+    # a model without saved statistics falls back to those of the data
+    file_dir['knowair_fp'] = observed
+    assert_same_stats(find_norm_stats(graph, 'Train', model_fp=str(tmp_path / 'model.pth'), fp=fp), train)
+
+
+def test_load_without_key(tmp_path):
+    fp = str(tmp_path / 'norm_stats.npz')
+    assert NormStats.load('Train', None, fp) is None
+    first = random_stats(0, 'a')
+    first.save('Train', fp)
+    assert_same_stats(NormStats.load('Train', None, fp), first)
+    # ambiguous with the statistics of two keys
+    random_stats(1, 'b').save('Train', fp)
+    assert NormStats.load('Train', None, fp) is None
+    assert_same_stats(NormStats.load('Train', 'a', fp), first)
+
+
+def test_exp1_statistics_per_site():
+    # as the original dataset_exp1.py: mean(axis=(0,1)) of the (samples, seq_len, sites, channels) windows
+    dataset_exp1 = pytest.importorskip('dataset_exp1')
+    rng = np.random.default_rng(0)
+    n_feature = len(config['experiments']['metero_use'])
+    haze = dataset_exp1.HazeData.__new__(dataset_exp1.HazeData)
+    haze.feature = rng.normal(5, 2, (150, 12, N_SITES, n_feature)).astype(np.float32)
+    haze.pm25 = rng.gamma(2.0, 10.0, (150, 12, N_SITES, 1)).astype(np.float32)
+    haze._calc_mean_std()
+    feature, pm25 = haze.feature.astype(np.float64), haze.pm25.astype(np.float64)
+    np.testing.assert_allclose(haze.feature_mean, feature.mean(axis=(0, 1)), rtol=1e-6)
+    np.testing.assert_allclose(haze.feature_std, feature.std(axis=(0, 1)), rtol=1e-6)
+    assert haze.feature_mean.shape == (N_SITES, n_feature)
+    wind_idx = [config['experiments']['metero_use'].index(name) for name in ('u_component_of_wind+950', 'v_component_of_wind+950')]
+    np.testing.assert_allclose(haze.wind_mean, feature.mean(axis=(0, 1))[:, wind_idx], rtol=1e-6)
+    np.testing.assert_allclose(haze.pm25_mean, pm25.mean(), rtol=1e-6)
+    np.testing.assert_allclose(haze.pm25_std, pm25.std(), rtol=1e-6)
@@ -0,0 +1,103 @@
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+import numpy as np
+import pytest
+
+from timeaxis import HourAxis, config_hour
+from util import config
+
+UTC_OFFSET = 7
+
+
+def reference_hours(time_start, time_end, fields=3):
+    """
+    The hours the original datasets iterated, without arrow:
+    arrow.Arrow.interval('hour', start, end.shift(hours=+1)) from
+    arrow.get(datetime(*time_yaml[0][:fields]), tz), i.e. every hour from
+    start through one hour past end.
+    """
+    start = datetime(*time_start[0][:fields], tzinfo=ZoneInfo(time_start[1]))
+    end = datetime(*time_end[0][:fields], tzinfo=ZoneInfo(time_end[1])) + timedelta(hours=1)
+    hours = []
+    while start <= end:
+        hours.append(start)
+        start = start + timedelta(hours=1)
+    return hours
+
+
+@pytest.fixture(scope='module', params=[3, 5], ids=['dataset', 'dataset_exp1'])
+def case(request):
+    # dataset.py reads the day of data_start/data_end, dataset_exp1.py all five fields
+    fields = request.param
+    return HourAxis.from_config(fields=fields), reference_hours(config['dataset']['data_start'],
+                                                                  config['dataset']['data_end'], fields)
+
+
+def test_hour_axis_matches_reference_hours(case):
+    axis, hours = case
+    assert len(axis) == len(hours)
+    np.testing.assert_array_equal(axis.timestamps(), [t.timestamp() for t in hours])
+    np.testing.assert_array_equal(axis.hour(), [t.hour for t in hours])
+    np.testing.assert_array_equal(axis.isoweekday(), [t.isoweekday() for t in hours])
+    idx = np.array([0, 1, 5000, len(hours) - 1])
+    np.testing.assert_array_equal(axis.timestamps(idx), [hours[i].timestamp() for i in idx])
+    np.testing.assert_array_equal(axis.hour(idx), [hours[i].hour for i in idx])
+    np.testing.assert_array_equal(axis.isoweekday(idx), [hours[i].isoweekday() for i in idx])
+
+
+def test_hour_axis_index_matches_time_dict(case):
+    axis, hours = case
+    # time_dict.pkl: 'YYYY-MM-DD HH:MM' UTC labels of the dataset hours, looked up with all 16 or the first 13 characters
+    time_dict = {str(datetime.fromtimestamp(t.timestamp(), timezone.utc).replace(tzinfo=None))[0:16]: i
+                 for i, t in enumerate(hours)}
+    labels = list(time_dict)
+    np.testing.assert_array_equal(axis.labels(minutes=True), labels)
+    np.testing.assert_array_equal(axis.labels(), [label[0:13] for label in labels])
+    np.testing.assert_array_equal(axis.index(labels), list(time_dict.values()))
+    np.testing.assert_array_equal(axis.index([label[0:13] for label in labels]), list(time_dict.values()))
+    assert axis.index('2021-01-01 00:00') == time_dict['2021-01-01 00:00']
+    assert axis.index(datetime(2021, 3, 21)) == time_dict['2021-03-21 00:00']
+    np.testing.assert_array_equal(axis.index(axis.hours()), np.arange(len(axis)))
+
+
+def test_hour_axis_timestamp_index(case):
+    axis, hours = case
+    stamps = np.array([t.timestamp() for t in hours])
+    np.testing.assert_array_equal(axis.timestamp_index(stamps), np.arange(len(hours)))
+    # off the hour grid or outside the axis
+    outside = [stamps[3] + 1800, stamps[0] - 3600, stamps[-1] + 3600]
+    np.testing.assert_array_equal(axis.timestamp_index(outside), [-1, -1, -1])
+    assert HourAxis.from_timestamps(stamps[10:20]).index(hours[15].replace(tzinfo=None)) == 5
+
+
+def test_utc_offset_of_scenario_dates(case):
+    axis, hours = case
+    # alltimes_pst.npy labels the dataset hours 7 hours behind UTC
+    pst = timezone(timedelta(hours=-UTC_OFFSET))
+    alldates = np.array([t.astimezone(pst).strftime('%Y-%m-%d %H:%M') for t in hours])
+    np.testing.assert_array_equal(alldates, axis.labels(np.arange(len(axis)) - UTC_OFFSET, minutes=True))
+    i = np.arange(len(axis) - UTC_OFFSET)
+    # the fire day of hour i is the UTC day of alldates[i + 7], its wind the hour of alldates[i] on the axis
+    np.testing.assert_array_equal(alldates[i + UTC_OFFSET].astype('U10'),
+                                  [t.astimezone(timezone.utc).strftime('%Y-%m-%d') for t in hours[:len(i)]])
+    np.testing.assert_array_equal(axis.index(alldates), np.arange(len(axis)) - UTC_OFFSET)
+
+
+def test_config_hour_converts_to_utc():
+    assert config_hour([[2021, 8, 14, 0, 0], 'America/Los_Angeles'], 5) == np.datetime64('2021-08-14T07', 'h') # PDT
+    assert config_hour([[2021, 1, 14, 0, 0], 'America/Los_Angeles'], 5) == np.datetime64('2021-01-14T08', 'h') # PST
+    assert config_hour([[2021, 8, 14, 5, 0], 'GMT'], 3) == np.datetime64('2021-08-14T00', 'h')
+
+
+def test_reference_hours_match_arrow():
+    arrow = pytest.importorskip('arrow')
+    time_start, time_end = [[2021, 3, 10, 1, 0], 'GMT'], [[2021, 3, 20, 16, 0], 'GMT']
+    for fields in (3, 5):
+        start = arrow.get(datetime(*time_start[0][:fields]), time_start[1])
+        end = arrow.get(datetime(*time_end[0][:fields]), time_end[1])
+        expected = [span[0] for span in arrow.Arrow.interval('hour', start, end.shift(hours=+1), 1)]
+        assert [t.timestamp() for t in reference_hours(time_start, time_end, fields)] == [t.timestamp() for t in expected]
+        axis = HourAxis.from_config(time_start, time_end, fields)
+        np.testing.assert_array_equal(axis.hour(), [t.hour for t in expected])
+        np.testing.assert_array_equal(axis.isoweekday(), [t.isoweekday() for t in expected])